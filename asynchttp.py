@@ -0,0 +1,127 @@
+'''
+A minimal HTTP/1.1 client built on asyncio streams, used by the asyncio engine to send requests without blocking the
+event loop or needing any extra dependencies.
+'''
+
+import asyncio
+from urllib.parse import urlsplit
+
+
+class HTTPClientError(Exception):
+    pass
+
+
+class Response:
+    def __init__(self, code, reason, headers, body):
+        self.code = code
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+
+_ssl_context_cache = None
+
+
+def _ssl_context():
+    # ssl is slow to import, so it is left until the first HTTPS request. Creating a context loads the CA
+    # certificates, so the one context is shared by every request
+    global _ssl_context_cache
+    if _ssl_context_cache is None:
+        import ssl
+        _ssl_context_cache = ssl.create_default_context()
+    return _ssl_context_cache
+
+
+def _build_request(method, url, body, headers):
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+        raise HTTPClientError(f'Unsupported URL scheme {parts.scheme!r}')
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+
+    host_header = parts.hostname
+    if ':' in host_header:
+        host_header = f'[{host_header}]'
+    if parts.port is not None:
+        host_header += f':{parts.port}'
+
+    all_headers = {'Host': host_header, 'Connection': 'close', 'Accept-Encoding': 'identity'}
+    if body is not None:
+        all_headers['Content-Length'] = str(len(body))
+    all_headers.update(headers or {})
+
+    lines = [f'{method} {path} HTTP/1.1'] + [f'{k}: {v}' for k, v in all_headers.items()]
+    request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+    if body is not None:
+        request += body
+    return parts, request
+
+
+async def _read_headers(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise HTTPClientError('Remote end closed connection without response')
+    try:
+        version, code, *reason = status_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        code = int(code)
+    except ValueError:
+        raise HTTPClientError(f'Bad status line {status_line!r}')
+    if not version.startswith('HTTP/'):
+        raise HTTPClientError(f'Bad status line {status_line!r}')
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return code, reason[0] if reason else '', headers
+
+
+async def _read_body(reader, method, code, headers):
+    if method == 'HEAD' or code in (204, 304) or 100 <= code < 200:
+        return b''
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        body = b''
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await reader.readline()
+                return body
+            body += await reader.readexactly(size)
+            await reader.readline()
+    if 'content-length' in headers:
+        return await reader.readexactly(int(headers['content-length']))
+    return await reader.read()
+
+
+async def request(method, url, body=None, headers=None, timeout=None, resolver=None):
+    '''
+    Send a single request and return the Response. The cached addresses from `resolver` are used for the host when
+    there are any.
+    Raises HTTPClientError for protocol errors, OSError for connection failures and asyncio.TimeoutError if the
+    response isn't received within `timeout` seconds.
+    '''
+    method = method or ('GET' if body is None else 'POST')
+    parts, req = _build_request(method, url, body, headers)
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    ssl_context = _ssl_context() if parts.scheme == 'https' else None
+    host = parts.hostname
+    addresses = resolver.lookup(host, port) if resolver is not None else None
+    if addresses:
+        host = addresses[0]
+
+    async def do_request():
+        reader, writer = await asyncio.open_connection(host, port, ssl=ssl_context, server_hostname=parts.hostname if ssl_context else None)
+        try:
+            writer.write(req)
+            await writer.drain()
+            code, reason, resp_headers = await _read_headers(reader)
+            body = await _read_body(reader, method, code, resp_headers)
+            return Response(code, reason, resp_headers, body)
+        finally:
+            writer.close()
+
+    return await asyncio.wait_for(do_request(), timeout)
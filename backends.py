@@ -0,0 +1,165 @@
+'''
+Targets that send the rendered body straight over a socket instead of making an HTTP request, for local services
+where HTTP framing and a new connection for each press would be most of the time taken.
+
+    udp://host:port      the body is sent as a single datagram
+    tcp://host:port      the body is sent as a line over a connection that is kept open
+    unix:///path/to/sock the body is sent as a line over a Unix domain stream socket that is kept open
+
+Connections are opened on first use and reopened when the other end has closed them.
+'''
+
+import logging
+import socket
+import threading
+from urllib.parse import unquote, urlsplit
+
+
+log = logging.getLogger('pophttp')
+
+SCHEMES = ('udp://', 'tcp://', 'unix://')
+
+# The body sent when a socket target doesn't specify one
+DEFAULT_BODY = '{onoff} {hue} {saturation} {brightness} {kelvin}'
+
+
+def is_socket_url(url):
+    return url.startswith(SCHEMES)
+
+
+def parse_address(url):
+    '''Returns (scheme, address) for a socket target URL, raising ValueError if it isn't valid'''
+    parts = urlsplit(url)
+    if parts.scheme == 'unix':
+        path = unquote(parts.netloc + parts.path)
+        if not path:
+            raise ValueError(f'{url} is missing the path of the socket')
+        return parts.scheme, path
+    if parts.scheme not in ('udp', 'tcp'):
+        raise ValueError(f'Unsupported URL scheme {parts.scheme!r} in {url}')
+    if not parts.hostname or parts.port is None:
+        raise ValueError(f'{url} must include a host and port')
+    return parts.scheme, (parts.hostname, parts.port)
+
+
+class _DatagramTarget:
+    def __init__(self, address):
+        self.address = address
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        # Connecting a UDP socket means the address is only resolved once and errors from the other end are reported
+        host, port = self.address
+        family, _, _, _, sockaddr = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0]
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        sock.connect(sockaddr)
+        return sock
+
+    def send(self, data, timeout):
+        '''Returns True if the socket was already open'''
+        sock = self.sock
+        reused = sock is not None
+        if sock is None:
+            with self.lock:
+                if self.sock is None:
+                    self.sock = self._connect()
+                sock = self.sock
+        sock.send(data)
+        return reused
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class _StreamTarget:
+    def __init__(self, scheme, address):
+        self.scheme = scheme
+        self.address = address
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def _connect(self, timeout):
+        if self.scheme == 'unix':
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            try:
+                sock.connect(self.address)
+            except OSError:
+                sock.close()
+                raise
+        else:
+            sock = socket.create_connection(self.address, timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+
+    def _is_open(self):
+        '''Discard anything the other end has sent, and check it hasn't closed the connection'''
+        self.sock.setblocking(False)
+        while True:
+            try:
+                if not self.sock.recv(4096):
+                    return False
+            except BlockingIOError:
+                return True
+            except OSError:
+                return False
+
+    def send(self, data, timeout):
+        '''Returns True if the connection was reused'''
+        with self.lock:
+            reused = self.sock is not None and self._is_open()
+            if not reused:
+                if self.sock is not None:
+                    log.debug('reconnecting to %s://%s after it closed the connection', self.scheme, self.address, extra=dict(sender_ip='-'))
+                self.close()
+                self._connect(timeout)
+            self.sock.settimeout(timeout)
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.close()
+                raise
+            return reused
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class SocketBackends:
+    '''The open sockets for each udp, tcp & unix target, shared by all of the dispatcher's workers'''
+    def __init__(self):
+        self._targets = {}
+        self._lock = threading.Lock()
+
+    def _target(self, url):
+        target = self._targets.get(url)
+        if target is None:
+            scheme, address = parse_address(url)
+            with self._lock:
+                target = self._targets.get(url)
+                if target is None:
+                    target = _DatagramTarget(address) if scheme == 'udp' else _StreamTarget(scheme, address)
+                    self._targets[url] = target
+        return target
+
+    def send(self, url, body, timeout=None):
+        '''
+        Send `body` to the target, with a newline added for the tcp & unix targets. Returns True if an existing
+        connection was used. Raises OSError if it couldn't be sent, or ValueError if the URL isn't valid
+        '''
+        target = self._target(url)
+        data = body.encode('utf-8')
+        if isinstance(target, _StreamTarget):
+            data += b'\n'
+        return target.send(data, timeout)
+
+    def close(self):
+        with self._lock:
+            for target in self._targets.values():
+                target.close()
+            self._targets = {}
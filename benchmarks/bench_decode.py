@@ -0,0 +1,78 @@
+'''
+Micro-benchmark for lifx.Message.decode. Compares the precompiled decoder against the original implementation that
+searched the Message class for every packet.
+
+    python benchmarks/bench_decode.py [-n PACKETS]
+'''
+
+import os
+import struct
+import sys
+from argparse import ArgumentParser
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lifx
+
+
+def legacy_decode(data):
+    '''The decoder as it was before the code lookup table and precompiled structs'''
+    def decode_payload(payload_def, payload):
+        members = struct.unpack(payload_def.fmt, payload)
+        if sys.version_info > (3, 0):
+            def try_decode(val):
+                if isinstance(val, bytes):
+                    try:
+                        return val.decode('utf-8')
+                    except UnicodeDecodeError:
+                        pass
+                return val
+            members = [try_decode(m) for m in members]
+        return payload_def.type(*members)
+
+    header_fmt = lifx.PacketDef.header_fmt
+    header = decode_payload(header_fmt, data[:header_fmt.length])
+    for member_name in dir(lifx.Message):
+        member = getattr(lifx.Message, member_name)
+        if isinstance(member, lifx.PacketDef) and member.code == header.code:
+            pkt = lifx.Packet(member, header=header)
+            pkt.header = decode_payload(header_fmt, data[:header_fmt.length])
+            pkt.payload = decode_payload(member.payload_fmt, data[header_fmt.length:])
+            return pkt
+    return None
+
+
+def sample_packets():
+    #The mix of packets a pop bridge sends: polling for the light state and retransmitted switch actions
+    target, site = bytes(8), bytes(6)
+    return [
+        lifx.Message.Light_Get().encode(target, site),
+        lifx.Message.Device_GetVersion().encode(target, site),
+        lifx.Message.Light_SetPower(level=lifx.DevicePower.ON, duration=1000).encode(target, site),
+        lifx.Message.Light_SetColor(stream=0, hue=24102, saturation=31097, brightness=32768, kelvin=3612, duration=1000).encode(target, site),
+    ]
+
+
+def bench(decode, packets, count):
+    rounds = max(1, count // len(packets))
+    start = perf_counter()
+    for _ in range(rounds):
+        for data in packets:
+            decode(data)
+    return rounds * len(packets) / (perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark decoding of LIFX packets')
+    parser.add_argument('-n', dest='count', type=int, default=200000, help='number of packets to decode for each decoder')
+    args = parser.parse_args()
+
+    packets = sample_packets()
+    for data in packets:
+        assert legacy_decode(data) == lifx.Message.decode(data)
+
+    before = bench(legacy_decode, packets, args.count)
+    after = bench(lifx.Message.decode, packets, args.count)
+    print(f'before: {before:12,.0f} packets/sec')
+    print(f'after:  {after:12,.0f} packets/sec')
+    print(f'speedup: {after / before:.1f}x')
@@ -0,0 +1,81 @@
+'''
+End to end benchmark of the pophttp server. Starts a stub HTTP server and pophttp configured to send every press to
+it, then drives pophttp with simulated pop bridges and reports the sustained packet rate, ACK round trip time,
+press to webhook latency and drop rates.
+
+    python benchmarks/bench_server.py [--engine thread|asyncio] [--bridges N] [--rate PRESSES_PER_SEC] [--duration SECONDS]
+'''
+
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+from argparse import ArgumentParser
+from time import sleep
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from simulator import LoadGenerator, StubHttpServer, format_report
+
+
+def start_pophttp(config_filename, engine, extra_args=(), timeout=30):
+    '''Start pophttp and wait for it to be listening, then keep reading its output so it never blocks on the pipe'''
+    proc = subprocess.Popen(
+        [sys.executable, '-u', os.path.join(ROOT, 'pophttp.py'), '--config', config_filename, '--engine', engine] + list(extra_args),
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=dict(os.environ, PYTHONUNBUFFERED='1')
+    )
+    first_line = queue.Queue()
+    output = [] # Only kept until pophttp has started, to show why it didn't
+
+    def read_output():
+        first_line.put(proc.stdout.readline())
+        for line in proc.stdout:
+            collected = output
+            if collected is not None:
+                collected.append(line)
+    reader = threading.Thread(target=read_output, daemon=True)
+    reader.start()
+
+    try:
+        line = first_line.get(timeout=timeout)
+    except queue.Empty:
+        proc.kill()
+        raise RuntimeError(f'pophttp did not start within {timeout}s')
+    if not line.startswith('Server started'):
+        proc.kill()
+        reader.join(5)
+        raise RuntimeError(f'pophttp failed to start: {line}{"".join(output)}')
+    output = None
+    return proc
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark pophttp with simulated pop bridges')
+    parser.add_argument('--engine', choices=('thread', 'asyncio'), default='thread')
+    parser.add_argument('--bridges', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=20.0, help='switch presses per second across all bridges')
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('pophttp_args', nargs='*', help='extra arguments for pophttp.py, after a --')
+    args = parser.parse_args()
+
+    stub = StubHttpServer()
+    with tempfile.NamedTemporaryFile('w', suffix='.yml', delete=False) as cfg_file:
+        yaml.safe_dump(dict(interface='127.0.0.1', default_url=stub.url_template()), cfg_file)
+    proc = start_pophttp(cfg_file.name, args.engine, args.pophttp_args)
+    try:
+        load = LoadGenerator(('127.0.0.1', 56700), args.bridges, args.rate, args.poll_interval, seed=args.seed)
+        load.run(args.duration)
+        sleep(0.5)
+        print(f'engine:           {args.engine}')
+        print(format_report(load.report(stub)))
+    finally:
+        proc.terminate()
+        proc.wait()
+        stub.close()
+        os.unlink(cfg_file.name)
@@ -0,0 +1,86 @@
+'''
+Benchmark for Config.get_target_for_switch with a large number of switch filters. Compares the filter index against
+the original scan of every filter.
+
+    python benchmarks/bench_switches.py [-n FILTERS] [-l LOOKUPS]
+'''
+
+import os
+import random
+import sys
+import tempfile
+from argparse import ArgumentParser
+from time import perf_counter
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import Config
+
+
+def legacy_match(switches, hue, saturation, brightness, kelvin, power):
+    '''The filter matching as it was before the index'''
+    targets = []
+    match = dict(h=hue, s=saturation, b=brightness, k=kelvin, p=power)
+    for _, filter, target in switches:
+        this_match = dict((k, None if filter[k] is None else v) for k, v in match.items())
+        if this_match == filter:
+            targets.append(target)
+    return targets
+
+
+def generate_switches(count, rng):
+    #A mix of fully specified filters and partial ones, like a large generated config would have
+    switches = {}
+    while len(switches) < count:
+        params = [f'{rng.randrange(65536)}h', f'{rng.randrange(65536)}s', f'{rng.randrange(65536)}b', f'{rng.randrange(2500, 9001)}k', rng.choice(['on', 'off'])]
+        kept = [p for p in params if rng.random() < 0.8] or params[:1]
+        switches[','.join(kept)] = f'http://example.com/{len(switches)}?power={{onoff}}'
+    return switches
+
+
+def sample_presses(switches, count, rng):
+    presses = []
+    for filter in rng.sample(list(switches), min(count, len(switches))):
+        values = dict(h=rng.randrange(65536), s=rng.randrange(65536), b=rng.randrange(65536), k=3500, p=rng.random() < 0.5)
+        for param in filter.split(','):
+            if param in ('on', 'off'):
+                values['p'] = param == 'on'
+            else:
+                values[param[-1]] = int(param[:-1])
+        presses.append((values['h'], values['s'], values['b'], values['k'], values['p']))
+    return presses
+
+
+def bench(match, presses):
+    start = perf_counter()
+    for press in presses:
+        match(*press)
+    return len(presses) / (perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark switch filter matching')
+    parser.add_argument('-n', dest='filters', type=int, default=10000, help='number of switch filters in the config')
+    parser.add_argument('-l', dest='lookups', type=int, default=1000, help='number of switch presses to look up')
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    switches = generate_switches(args.filters, rng)
+    with tempfile.NamedTemporaryFile('w', suffix='.yml', delete=False) as cfg_file:
+        yaml.safe_dump(dict(switches=switches), cfg_file)
+    try:
+        config = Config(cfg_file.name)
+    finally:
+        os.unlink(cfg_file.name)
+
+    presses = sample_presses(switches, args.lookups, rng)
+    for press in presses:
+        assert [t.url for t in legacy_match(config.switches, *press)] == [t.url.template for t in config.switch_index.match(*press)]
+
+    before = bench(lambda *press: legacy_match(config.switches, *press), presses)
+    after = bench(config.switch_index.match, presses)
+    print(f'{args.filters} filters, {len(presses)} presses')
+    print(f'before: {before:12,.0f} lookups/sec')
+    print(f'after:  {after:12,.0f} lookups/sec')
+    print(f'speedup: {after / before:.0f}x')
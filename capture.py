@@ -0,0 +1,174 @@
+'''
+Recording the datagrams pophttp accepts to a capture file, and replaying captures through the message handler to
+reproduce what happened or to benchmark the handler with real traffic.
+
+    python capture.py FILE [FILE ...] [--config config.yml] [--realtime] [--execute]
+
+Replaying uses the times in the capture as the handler's clock, so retransmits and presses are handled the same way
+whether the capture is replayed in real time or as fast as possible. Unless --execute is given, actions are counted
+rather than sent.
+'''
+
+import os
+import socket
+import struct
+from argparse import ArgumentParser
+from time import monotonic, perf_counter, sleep
+
+MAGIC = b'PHCAP\x00\x01\x00'
+RECORD = struct.Struct('<dHBH') # monotonic time, sender port, sender address length, data length
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_BACKUPS = 4
+
+
+class CaptureWriter:
+    '''
+    Appends each datagram to `filename`. When the file would grow past `max_bytes` it is renamed to `filename.1`
+    (and any older captures to `.2` and so on, keeping `backups` of them) and a new file is started.
+    Writes are buffered and flushed at most every `flush_interval` seconds.
+    '''
+    def __init__(self, filename, max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS, flush_interval=1.0):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self._last_flush = monotonic()
+        self._open()
+
+    def _open(self):
+        self._file = open(self.filename, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._size = self._file.tell()
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.filename}.{i}'):
+                os.replace(f'{self.filename}.{i}', f'{self.filename}.{i + 1}')
+        if self.backups > 0:
+            os.replace(self.filename, f'{self.filename}.1')
+        else:
+            os.remove(self.filename)
+        self._open()
+
+    def write(self, address, data, now=None):
+        now = monotonic() if now is None else now
+        ip = address[0].partition('%')[0] # Without the scope of a link local IPv6 address
+        packed_ip = socket.inet_pton(socket.AF_INET6 if ':' in ip else socket.AF_INET, ip)
+        record = RECORD.pack(now, address[1], len(packed_ip), len(data)) + packed_ip + bytes(data)
+        if self._size + len(record) > self.max_bytes and self._size > len(MAGIC):
+            self._rotate()
+        self._file.write(record)
+        self._size += len(record)
+        if now - self._last_flush >= self.flush_interval:
+            self._file.flush()
+            self._last_flush = now
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture(filename):
+    '''Yields (time, (ip, port), data) for each datagram in a capture file'''
+    with open(filename, 'rb') as capture_file:
+        if capture_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{filename} is not a pophttp capture file')
+        while True:
+            header = capture_file.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, port, ip_length, data_length = RECORD.unpack(header)
+            body = capture_file.read(ip_length + data_length)
+            if len(body) < ip_length + data_length:
+                return # The last record was only partly written when pophttp stopped
+            ip = socket.inet_ntop(socket.AF_INET if ip_length == 4 else socket.AF_INET6, body[:ip_length])
+            yield timestamp, (ip, port), body[ip_length:]
+
+
+class ReplayClock:
+    '''A clock for the MessageHandler that is set to the capture time of each datagram as it is replayed'''
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class CountingDispatcher:
+    '''Stands in for the dispatcher to count the actions instead of sending them'''
+    def __init__(self):
+        self.actions = 0
+
+    def submit(self, action):
+        self.actions += 1
+
+
+def replay(records, handler, process_datagram, clock, realtime=False):
+    '''
+    Feed captured datagrams to `process_datagram` for `handler`, setting `clock` (the handler's ReplayClock) to the
+    time each one was captured. Returns a dict of stats
+    '''
+    packets = 0
+    replies = 0
+    first = last = None
+
+    def send(data, address):
+        nonlocal replies
+        replies += 1
+
+    start = perf_counter()
+    for timestamp, address, data in records:
+        if first is None:
+            first = timestamp
+        if realtime:
+            wait = (timestamp - first) - (perf_counter() - start)
+            if wait > 0:
+                sleep(wait)
+        clock.now = last = timestamp
+        process_datagram(handler, data, address, send)
+        packets += 1
+    elapsed = perf_counter() - start
+    return dict(
+        packets=packets,
+        replies=replies,
+        captured_seconds=last - first if packets else 0,
+        elapsed=elapsed,
+        packets_per_sec=packets / elapsed if elapsed else 0,
+    )
+
+
+if __name__ == '__main__':
+    import itertools
+    import logging
+    import logs
+    import pophttp
+    import metrics
+    from config import Config
+
+    parser = ArgumentParser(description='Replay pophttp capture files through the message handler')
+    parser.add_argument('files', nargs='+', metavar='FILE', help='capture files, oldest first')
+    parser.add_argument('--config', default='config.yml', help='path to the configuration YAML file to use')
+    parser.add_argument('--realtime', action='store_true', help='replay with the same timing as the capture, instead of as fast as possible')
+    parser.add_argument('--execute', action='store_true', help='send the HTTP requests for the actions, instead of only counting them')
+    parser.add_argument('-v', dest='verbosity', action='count', default=0, help='increase verbosity level')
+    args = parser.parse_args()
+
+    log_output = logs.QueueLogging(pophttp.log, [logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbosity, 3)])
+
+    config = Config(args.config)
+    pophttp.http_pool.config = config
+    dispatcher = None if args.execute else CountingDispatcher()
+    clock = ReplayClock()
+    handler = pophttp.MessageHandler(config, dispatcher, clock=clock)
+    records = itertools.chain.from_iterable(read_capture(f) for f in args.files)
+    stats = replay(records, handler, pophttp.process_datagram, clock, args.realtime)
+    log_output.stop()
+
+    print(f'packets:   {stats["packets"]} over {stats["captured_seconds"]:.1f}s of capture')
+    print(f'replies:   {stats["replies"]}')
+    print(f'triggers:  {metrics.triggers.value()}')
+    if dispatcher is not None:
+        print(f'actions:   {dispatcher.actions}')
+    print(f'handled:   {stats["packets_per_sec"]:,.0f} packets/sec ({stats["elapsed"]:.3f}s)')
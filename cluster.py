@@ -0,0 +1,186 @@
+'''
+Active/standby clustering of pophttp nodes, for running pophttp on more than one host where each node receives the
+same presses from the bridges.
+
+The nodes send each other heartbeats over UDP, and the live node with the lowest (priority, node name) is active.
+The active node fires each press straight away and tells the other nodes it has claimed it. The other nodes hold on
+to each press for a short lease, which is longer the further down the order a node is, and only fire it if no other
+node claimed it in that time. So a press the active node missed still fires exactly once, and when the active node
+stops sending heartbeats the next node takes over as active after `failover` seconds.
+'''
+
+import json
+import logging
+import socket
+import threading
+from hashlib import blake2b
+from time import monotonic
+
+
+log = logging.getLogger('pophttp')
+
+# How long a claim from another node stops the same press being fired, which covers the bridges' retransmits of it
+CLAIM_WINDOW = 5
+
+
+def _fingerprint(trigger):
+    return blake2b(repr(trigger).encode('utf-8'), digest_size=16).hexdigest()
+
+
+class Cluster:
+    '''
+    A node in the cluster. `claim` is called for each press once the MessageHandler has decided to trigger it, and
+    presses that are fired later because no other node claimed them are passed to the `fire` function given to `start`
+    '''
+    def __init__(self, config, clock=monotonic):
+        self.config = config
+        self.node = config.node or f'{socket.gethostname()}/{config.address}:{config.port}'
+        self.clock = clock
+        self.active = False
+        self.deferred_fired = 0
+        self._started = clock()
+        self._peers = {} # node -> (priority, time of last heartbeat)
+        self._claims = {} # fingerprint -> time it was claimed by another node
+        self._pending = {} # fingerprint -> (deadline, sender, trigger)
+        self._lock = threading.Lock()
+        self._next_heartbeat = 0
+        self._sock = None
+        self._peer_addresses = []
+        self._fire = None
+
+    def _rank(self, now):
+        '''0 if this node is active, otherwise the number of live nodes ahead of it'''
+        me = (self.config.priority, self.node)
+        ahead = sum(1 for node, (priority, seen) in self._peers.items() if now - seen < self.config.failover and (priority, node) < me)
+        if ahead == 0 and now - self._started < self.config.failover:
+            # Until there's been time to hear from the other nodes, assume one of them might be active
+            return 1
+        return ahead
+
+    def _set_active(self, active):
+        if active != self.active:
+            self.active = active
+            log.warning('cluster node %s is now %s', self.node, 'active' if active else 'standby', extra=dict(sender_ip='-'))
+
+    def claim(self, sender, trigger):
+        '''Returns True if this node should fire the press now'''
+        key = _fingerprint(trigger)
+        now = self.clock()
+        with self._lock:
+            claimed = self._claims.get(key)
+            if claimed is not None and now - claimed < CLAIM_WINDOW:
+                return False
+            rank = self._rank(now)
+            self._set_active(rank == 0)
+            if rank > 0:
+                if key not in self._pending:
+                    self._pending[key] = (now + self.config.lease * rank, sender, trigger)
+                return False
+        self._send(dict(type='claim', node=self.node, trigger=key))
+        return True
+
+    def start(self, fire):
+        '''Start exchanging heartbeats & claims with the other nodes on a background thread'''
+        self._fire = fire
+        # An IPv6 address gets a dual stack socket, with the IPv4 peers' addresses mapped to IPv6
+        family = socket.AF_INET6 if ':' in self.config.address else socket.AF_INET
+        for host, port in self.config.peers:
+            try:
+                sockaddr = socket.getaddrinfo(host, port, family, socket.SOCK_DGRAM, 0, socket.AI_V4MAPPED if family == socket.AF_INET6 else 0)[0][4]
+                self._peer_addresses.append((sockaddr[0], port))
+            except OSError as err:
+                log.error('cluster unable to resolve peer %s: %s', host, err, extra=dict(sender_ip='-'))
+        self._sock = socket.socket(family, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        if family == socket.AF_INET6:
+            self._sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        self._sock.bind((self.config.address, self.config.port))
+        self._sock.settimeout(min(self.config.heartbeat, self.config.lease) / 4)
+        threading.Thread(target=self._run, name='cluster', daemon=True).start()
+        log.info('cluster node %s started with peers %s', self.node, ', '.join(f'{h}:{p}' for h, p in self._peer_addresses), extra=dict(sender_ip='-'))
+
+    def stop(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _send(self, message):
+        sock = self._sock
+        if sock is None:
+            return
+        data = json.dumps(message).encode('utf-8')
+        for address in self._peer_addresses:
+            try:
+                sock.sendto(data, address)
+            except OSError as err:
+                log.debug('cluster unable to send to %s:%d: %s', address[0], address[1], err, extra=dict(sender_ip='-'))
+
+    def _run(self):
+        peer_ips = {ip for ip, _ in self._peer_addresses}
+        while True:
+            sock = self._sock
+            if sock is None:
+                return
+            try:
+                data, address = sock.recvfrom(1024)
+            except socket.timeout:
+                data = None
+            except OSError:
+                return # The socket was closed by stop()
+            now = self.clock()
+            if data is not None:
+                if address[0] in peer_ips:
+                    self._received(data, address, now)
+                else:
+                    log.debug('cluster ignoring message from unknown peer', extra=dict(sender_ip=address[0]))
+            self._tick(now)
+
+    def _received(self, data, address, now):
+        try:
+            message = json.loads(data)
+            node = str(message['node'])
+            if message['type'] == 'heartbeat':
+                priority = int(message['priority'])
+            else:
+                key = str(message['trigger'])
+        except (ValueError, KeyError, TypeError) as err:
+            log.debug('cluster unable to decode message %r: %r', data, err, extra=dict(sender_ip=address[0]))
+            return
+        if node == self.node:
+            return
+
+        with self._lock:
+            if message['type'] == 'heartbeat':
+                last = self._peers.get(node)
+                if last is None or now - last[1] >= self.config.failover:
+                    log.warning('cluster peer %s is up', node, extra=dict(sender_ip=address[0]))
+                self._peers[node] = (priority, now)
+            elif message['type'] == 'claim':
+                self._claims[key] = now
+                self._pending.pop(key, None)
+
+    def _tick(self, now):
+        if now >= self._next_heartbeat:
+            self._next_heartbeat = now + self.config.heartbeat
+            self._send(dict(type='heartbeat', node=self.node, priority=self.config.priority))
+
+        with self._lock:
+            for node, (priority, seen) in list(self._peers.items()):
+                if now - seen >= self.config.failover:
+                    log.warning('cluster peer %s is down', node, extra=dict(sender_ip='-'))
+                    del self._peers[node]
+            self._set_active(self._rank(now) == 0)
+            for key, claimed in list(self._claims.items()):
+                if now - claimed >= CLAIM_WINDOW:
+                    del self._claims[key]
+            unclaimed = [(key, sender, trigger) for key, (deadline, sender, trigger) in self._pending.items() if deadline <= now]
+            for key, _, _ in unclaimed:
+                del self._pending[key]
+
+        for key, sender, trigger in unclaimed:
+            log.warning('cluster press was not claimed by another node, firing it', extra=dict(sender_ip=sender))
+            self._send(dict(type='claim', node=self.node, trigger=key))
+            self.deferred_fired += 1
+            try:
+                self._fire(sender, trigger)
+            except Exception:
+                log.exception('cluster failed to fire press', extra=dict(sender_ip=sender))
@@ -1,58 +1,214 @@
-import struct
+import hashlib
+import logging
+import os
+import pickle
+import sys
 import yaml
 from base64 import b64encode
 from collections import namedtuple
-from socket import inet_aton
+from functools import lru_cache
+from ipaddress import ip_address, ip_network
+from operator import itemgetter
+from string import Formatter
+from urllib.parse import urlsplit
+try:
+    from yaml import CSafeLoader as SafeLoader # libyaml is much faster for large configs, when PyYAML was built with it
+except ImportError:
+    from yaml import SafeLoader
+try:
+    import backends
+    from dispatch import OVERFLOW_POLICIES
+except ImportError:
+    from . import backends
+    from .dispatch import OVERFLOW_POLICIES
+
+
+log = logging.getLogger('pophttp')
 
 
 class ConfigError(Exception):
     pass
 
-SwitchConfig = namedtuple("SwitchConfig", "url method body headers")
-EndpointConfig = namedtuple("EndpointConfig", "method headers")
+# `source` is the URL template in the config the target was rendered from, so a target can be told apart from the others
+SwitchConfig = namedtuple("SwitchConfig", "url method body headers timeout retry endpoint rate_limit coalesce source", defaults=(None, None, False, None))
+EndpointConfig = namedtuple("EndpointConfig", "method headers timeout max_connections idle_timeout retry rate_limit coalesce")
+DispatchConfig = namedtuple("DispatchConfig", "workers queue_size overflow timeout max_connections idle_timeout retry_spool dns_ttl prewarm")
+RetryPolicy = namedtuple("RetryPolicy", "max_attempts backoff max_backoff jitter statuses")
+RateLimit = namedtuple("RateLimit", "rate burst")
+MetricsConfig = namedtuple("MetricsConfig", "address port")
+SocketConfig = namedtuple("SocketConfig", "receive_buffer send_buffer batch_size")
+ClusterConfig = namedtuple("ClusterConfig", "node address port peers priority heartbeat failover lease")
+LightConfig = namedtuple("LightConfig", "target label switches default_url")
+
+
+TEMPLATE_PARAMETERS = ('onoff', 'hue', 'saturation', 'brightness', 'kelvin')
 
 
 def format_template(template, hue, saturation, brightness, kelvin, power):
     return template.format(onoff='on' if power else 'off', hue=hue, saturation=saturation, brightness=brightness, kelvin=kelvin)
 
 
+class Template:
+    '''
+    A URL or body template that has been checked when the config is loaded, so a mistake in a placeholder is
+    reported at startup rather than when the switch is pressed
+    '''
+    def __init__(self, template, section):
+        self.template = template
+        try:
+            parts = list(Formatter().parse(template))
+        except ValueError as err:
+            raise ConfigError(f'Could not parse template {template!r} for {section}: {err}')
+        fields = [field for _, field, _, _ in parts if field is not None]
+        for field in fields:
+            if field not in TEMPLATE_PARAMETERS:
+                raise ConfigError(f'Unknown parameter {{{field}}} in template {template!r} for {section}. Expecting any of {", ".join(TEMPLATE_PARAMETERS)}')
+        # Templates without any parameters render the same every time
+        self.constant = ''.join(literal for literal, _, _, _ in parts) if not fields else None
+        try:
+            self.render(hue=0, saturation=0, brightness=0, kelvin=0, power=True)
+        except ValueError as err:
+            raise ConfigError(f'Bad format in template {template!r} for {section}: {err}')
+
+    def render(self, hue, saturation, brightness, kelvin, power):
+        if self.constant is not None:
+            return self.constant
+        return format_template(self.template, hue, saturation, brightness, kelvin, power)
+
+    def __repr__(self):
+        return f'Template({self.template!r})'
+
+
 def _basic_auth_header(username, password):
-    base64string = b64encode(f'{username}:{password}')
+    base64string = b64encode(f'{username}:{password}'.encode('utf-8')).decode('ascii')
     return "Basic %s" % base64string
 
 
-def _parse_cidr(cidr_address):
-    ip, *rest = cidr_address.split('/')
+def _parse_network(cidr_address):
     try:
-        ip = struct.unpack('>L', inet_aton(ip))[0]
-    except (struct.error, OSError):
-        raise ConfigError(f'Could not parse {ip} as a valid IPv4 address')
-    if not rest:
-        net_mask = 32
-    elif len(rest) == 1:
-        try:
-            net_mask = int(rest[0])
-        except ValueError:
-            raise ConfigError(f'Subnet mask {rest[0]} is not an integer')
-        if net_mask > 32 or net_mask < 0:
-            raise ConfigError(f'Subnet mask {net_mask} must be in the range of 0-32')
+        return ip_network(str(cidr_address), strict=False)
+    except ValueError as err:
+        raise ConfigError(f'Could not parse {cidr_address} in ip_filter: {err}')
+
+
+def _parse_ip_filter(ip_filter):
+    '''
+    `ip_filter` is a network or list of networks to allow, or a dict with `allow` and/or `deny` lists.
+    Everything is allowed if it isn't set
+    '''
+    if ip_filter is None:
+        return IPFilter(allow=[ip_network('0.0.0.0/0'), ip_network('::/0')])
+    if isinstance(ip_filter, dict):
+        unknown = set(ip_filter) - {'allow', 'deny'}
+        if unknown:
+            raise ConfigError(f'Unknown ip_filter options {", ".join(sorted(unknown))}. Expected allow or deny')
+        allow = ip_filter.get('allow') or []
+        deny = ip_filter.get('deny') or []
     else:
-        raise ConfigError('Bad IP address format specified for IP filter')
-    return ip, net_mask
+        allow = ip_filter
+        deny = []
+    allow = [allow] if not isinstance(allow, list) else allow
+    deny = [deny] if not isinstance(deny, list) else deny
+    return IPFilter([_parse_network(n) for n in allow], [_parse_network(n) for n in deny])
 
 
 def _parse_switch_filter(filter):
+    if isinstance(filter, bool):
+        # YAML reads unquoted `on` and `off` keys as booleans
+        filter = 'on' if filter else 'off'
+    if not isinstance(filter, (str, int)):
+        raise ConfigError(f'Switch filter {filter!r} must be a string like 500h,500s,32768b,3612k,on')
     parsed_filter = dict(h=None, s=None, b=None, k=None, p=None)
-    for param in filter.lower().split(','):
+    for param in str(filter).lower().split(','):
+        param = param.strip()
         if param in ('on', 'off'):
             parsed_filter['p'] = param == 'on'
-        elif param[-1] in parsed_filter:
-            parsed_filter[param[-1]] = int(param[:-1])
+        elif param and param[-1] in parsed_filter:
+            try:
+                parsed_filter[param[-1]] = int(param[:-1])
+            except ValueError:
+                raise ConfigError(f'Could not parse the value of {param!r} in switch filter {filter!r}')
         else:
-            raise ConfigError(f'Unknown parameter {param[-1]} while parsing switch filter {filter!r}')
+            raise ConfigError(f'Unknown parameter {param!r} while parsing switch filter {filter!r}')
     return parsed_filter
 
 
+def _parse_switches(switches, section):
+    '''A mapping of switch filters to targets, as a list of (key, filter, target) where key is the filter as written'''
+    if switches is None:
+        return []
+    if not isinstance(switches, dict):
+        raise ConfigError(f'{section} must be a mapping of switch filters to URLs, but got {type(switches).__name__}')
+    return [(f, _parse_switch_filter(f), _parse_target_url(url, f)) for f, url in switches.items()]
+
+
+def _parse_headers(headers, section):
+    if headers is None:
+        return {}
+    if not isinstance(headers, dict):
+        raise ConfigError(f'Headers for {section} must be a mapping of header names to values, but got {type(headers).__name__}')
+    return dict((str(name), str(value)) for name, value in headers.items())
+
+
+def _parse_timeout(timeout, section):
+    if timeout is None:
+        return None
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0:
+        raise ConfigError(f'Timeout for {section} must be a positive number of seconds, but got {timeout!r}')
+    return float(timeout)
+
+
+def _parse_positive_int(value, name):
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ConfigError(f'{name} must be a positive integer, but got {value!r}')
+    return value
+
+
+def _parse_retry_policy(config, section):
+    if config is None:
+        return None
+    if isinstance(config, int) and not isinstance(config, bool):
+        config = dict(max_attempts=config)
+    if not isinstance(config, dict):
+        raise ConfigError(f'Expected a number of attempts or mapping with parameters for the retry config of {section}, but got {type(config).__name__}')
+    config = dict(config)
+
+    max_attempts = _parse_positive_int(config.pop("max_attempts", 3), f'Retry max_attempts for {section}')
+    backoff = _parse_timeout(config.pop("backoff", 1), f'retry backoff of {section}')
+    max_backoff = _parse_timeout(config.pop("max_backoff", 300), f'retry max_backoff of {section}')
+    jitter = config.pop("jitter", 0.2)
+    if isinstance(jitter, bool) or not isinstance(jitter, (int, float)) or not 0 <= jitter <= 1:
+        raise ConfigError(f'Retry jitter for {section} must be in the range of 0-1, but got {jitter!r}')
+    statuses = config.pop("statuses", [500, 502, 503, 504])
+    if not isinstance(statuses, list) or not all(isinstance(s, int) and not isinstance(s, bool) for s in statuses):
+        raise ConfigError(f'Retry statuses for {section} must be a list of HTTP status codes, but got {statuses!r}')
+
+    if config:
+        raise ConfigError(f'Retry config for {section} contains unknown parameters {",".join(config)}')
+    return RetryPolicy(max_attempts, backoff, max_backoff, float(jitter), tuple(statuses))
+
+
+def _parse_rate_limit(config, section):
+    if config is None:
+        return None
+    if isinstance(config, (int, float)) and not isinstance(config, bool):
+        config = dict(rate=config)
+    if not isinstance(config, dict):
+        raise ConfigError(f'Expected a number of requests per second or mapping with parameters for the rate_limit of {section}, but got {type(config).__name__}')
+    config = dict(config)
+
+    rate = config.pop("rate", None)
+    if isinstance(rate, bool) or not isinstance(rate, (int, float)) or rate <= 0:
+        raise ConfigError(f'Rate limit rate for {section} must be a positive number of requests per second, but got {rate!r}')
+    burst = _parse_positive_int(config.pop("burst", max(1, int(rate))), f'Rate limit burst for {section}')
+
+    if config:
+        raise ConfigError(f'Rate limit config for {section} contains unknown parameters {",".join(config)}')
+    return RateLimit(float(rate), burst)
+
+
 def _parse_target_url(target, filter):
     if isinstance(target, str):
         target = dict(url=target)
@@ -63,19 +219,39 @@ def _parse_target_url(target, filter):
         raise ConfigError(f'Section for switch filter {filter!r} is missing the `url` parameter')
     body = target.pop("body", None)
     method = target.pop("method", None)
-    headers = target.pop("headers", {})
+    headers = _parse_headers(target.pop("headers", None), f'switch filter {filter!r}')
+    timeout = _parse_timeout(target.pop("timeout", None), f'switch filter {filter!r}')
+    retry = _parse_retry_policy(target.pop("retry", None), f'switch filter {filter!r}')
     if target:
         raise ConfigError(f'Section for switch filter {filter!r} contains unknown parameters {",".join(target)}')
-    return SwitchConfig(url, method, body, headers)
+    if backends.is_socket_url(url):
+        if method is not None or headers:
+            raise ConfigError(f'Switch filter {filter!r} sends to {url}, which can\'t have a method or headers')
+        if '{' not in url:
+            try:
+                backends.parse_address(url)
+            except ValueError as err:
+                raise ConfigError(f'Bad URL for switch filter {filter!r}: {err}')
+        if body is None:
+            body = backends.DEFAULT_BODY
+    return SwitchConfig(url, method, body, headers, timeout, retry)
 
 
 def _parse_endpoint_config(config, endpoint):
     if not isinstance(config, dict):
         raise ConfigError(f'Expected a mapping with parameters for endpoint {endpoint!r} config, but got {type(config).__name__}')
     
-    headers = config.pop("headers", {})
+    headers = _parse_headers(config.pop("headers", None), f'endpoint {endpoint!r}')
     method = config.pop("method", None)
-    
+    timeout = _parse_timeout(config.pop("timeout", None), f'endpoint {endpoint!r}')
+    max_connections = _parse_positive_int(config.pop("max_connections", None), f'max_connections for endpoint {endpoint!r}')
+    idle_timeout = _parse_timeout(config.pop("idle_timeout", None), f'idle connections of endpoint {endpoint!r}')
+    retry = _parse_retry_policy(config.pop("retry", None), f'endpoint {endpoint!r}')
+    rate_limit = _parse_rate_limit(config.pop("rate_limit", None), f'endpoint {endpoint!r}')
+    coalesce = config.pop("coalesce", False)
+    if not isinstance(coalesce, bool):
+        raise ConfigError(f'coalesce for endpoint {endpoint!r} must be true or false, but got {coalesce!r}')
+
     auth = config.pop("auth", None)
     if auth == "basic":
         try:
@@ -90,50 +266,453 @@ def _parse_endpoint_config(config, endpoint):
         except KeyError as err:
             raise ConfigError(f'HTTP bearer auth config for endpoint {endpoint!r} is missing the {err.args[0]} parameter')
         headers['Authorization'] = f'Bearer {token}'
-    else:
+    elif auth is not None:
         raise ConfigError(f'Unknown auth type {auth} for endpoint {endpoint!r}. Expecting 1 of basic or bearer')
 
     if config:
         raise ConfigError(f'Section endpoint {endpoint} contains unknown parameters {",".join(config)}')
-    return EndpointConfig(method, headers)
+    return EndpointConfig(method, headers, timeout, max_connections, idle_timeout, retry, rate_limit, coalesce)
+
+
+def _parse_dispatch_config(config):
+    if not isinstance(config, dict):
+        raise ConfigError(f'Expected a mapping with parameters for the dispatch config, but got {type(config).__name__}')
+
+    workers = _parse_positive_int(config.pop("workers", 4), 'Dispatch workers')
+    queue_size = _parse_positive_int(config.pop("queue_size", 100), 'Dispatch queue_size')
+    overflow = config.pop("overflow", 'drop-oldest')
+    if overflow not in OVERFLOW_POLICIES:
+        raise ConfigError(f'Unknown dispatch overflow policy {overflow!r}. Expecting 1 of {" or ".join(OVERFLOW_POLICIES)}')
+    timeout = _parse_timeout(config.pop("timeout", 10), 'dispatch')
+    max_connections = _parse_positive_int(config.pop("max_connections", 4), 'Dispatch max_connections')
+    idle_timeout = _parse_timeout(config.pop("idle_timeout", 30), 'dispatch idle connections')
+    retry_spool = config.pop("retry_spool", None)
+    if retry_spool is not None and not isinstance(retry_spool, str):
+        raise ConfigError(f'Dispatch retry_spool must be a file path, but got {retry_spool!r}')
+    dns_ttl = _parse_timeout(config.pop("dns_ttl", 300), 'dispatch dns_ttl')
+    prewarm = config.pop("prewarm", False)
+    if not isinstance(prewarm, bool):
+        raise ConfigError(f'Dispatch prewarm must be true or false, but got {prewarm!r}')
+
+    if config:
+        raise ConfigError(f'Section dispatch contains unknown parameters {",".join(config)}')
+    return DispatchConfig(workers, queue_size, overflow, timeout, max_connections, idle_timeout, retry_spool, dns_ttl, prewarm)
+
+
+def _parse_metrics_config(config):
+    if config is None:
+        return None
+    if isinstance(config, int) and not isinstance(config, bool):
+        config = dict(port=config)
+    if not isinstance(config, dict):
+        raise ConfigError(f'Expected a port number or mapping with parameters for the metrics config, but got {type(config).__name__}')
+
+    port = config.pop("port", None)
+    if isinstance(port, bool) or not isinstance(port, int) or not 0 < port < 65536:
+        raise ConfigError(f'Metrics port must be in the range of 1-65535, but got {port!r}')
+    address = config.pop("address", '127.0.0.1')
+
+    if config:
+        raise ConfigError(f'Section metrics contains unknown parameters {",".join(config)}')
+    return MetricsConfig(address, port)
+
+
+def _parse_socket_config(config):
+    if not isinstance(config, dict):
+        raise ConfigError(f'Expected a mapping with parameters for the socket config, but got {type(config).__name__}')
+
+    receive_buffer = _parse_positive_int(config.pop("receive_buffer", None), 'Socket receive_buffer')
+    send_buffer = _parse_positive_int(config.pop("send_buffer", None), 'Socket send_buffer')
+    batch_size = _parse_positive_int(config.pop("batch_size", 64), 'Socket batch_size')
+
+    if config:
+        raise ConfigError(f'Section socket contains unknown parameters {",".join(config)}')
+    return SocketConfig(receive_buffer, send_buffer, batch_size)
+
+
+def _parse_port(port, name):
+    if isinstance(port, bool) or not isinstance(port, int) or not 0 < port < 65536:
+        raise ConfigError(f'{name} must be in the range of 1-65535, but got {port!r}')
+    return port
+
+
+def _parse_peer(peer, default_port):
+    '''A peer is an IPv4 address, IPv6 address or host name, with an optional :port. IPv6 addresses with a port are in []'''
+    if not isinstance(peer, str) or not peer:
+        raise ConfigError(f'Cluster peers must be given as host or host:port, but got {peer!r}')
+    if peer.startswith('['):
+        host, bracket, port = peer[1:].partition(']')
+        if not bracket or (port and not port.startswith(':')):
+            raise ConfigError(f'Cluster peers must be given as host or host:port, but got {peer!r}')
+        port = port[1:]
+    elif peer.count(':') > 1:
+        host, port = peer, ''
+    else:
+        host, _, port = peer.partition(':')
+    try:
+        port = int(port) if port else default_port
+    except ValueError:
+        raise ConfigError(f'Could not parse the port of cluster peer {peer!r}')
+    return host, _parse_port(port, f'Port of cluster peer {peer!r}')
+
+
+def _parse_cluster_config(config):
+    if config is None:
+        return None
+    if not isinstance(config, dict):
+        raise ConfigError(f'Expected a mapping with parameters for the cluster config, but got {type(config).__name__}')
+
+    node = config.pop("node", None)
+    if node is not None:
+        node = str(node)
+    address = config.pop("address", '0.0.0.0')
+    port = _parse_port(config.pop("port", 56701), 'Cluster port')
+    peers = config.pop("peers", None)
+    if isinstance(peers, str):
+        peers = [peers]
+    if not isinstance(peers, list) or not peers:
+        raise ConfigError(f'Cluster peers must be a list of host:port for the other nodes, but got {peers!r}')
+    peers = [_parse_peer(peer, port) for peer in peers]
+    priority = config.pop("priority", 0)
+    if isinstance(priority, bool) or not isinstance(priority, int):
+        raise ConfigError(f'Cluster priority must be an integer, but got {priority!r}')
+    heartbeat = _parse_timeout(config.pop("heartbeat", 0.5), 'cluster heartbeat')
+    failover = _parse_timeout(config.pop("failover", 2), 'cluster failover')
+    lease = _parse_timeout(config.pop("lease", 0.25), 'cluster lease')
+    if failover <= heartbeat:
+        raise ConfigError(f'Cluster failover must be longer than the heartbeat interval, but got {failover} <= {heartbeat}')
+
+    if config:
+        raise ConfigError(f'Section cluster contains unknown parameters {",".join(config)}')
+    return ClusterConfig(node, address, port, peers, priority, heartbeat, failover, lease)
+
+
+def _parse_mac(mac):
+    '''A light's MAC address, as the 8 byte target the bridge addresses it by'''
+    if not isinstance(mac, str):
+        # YAML reads an unquoted MAC address made of only digits as a base 60 number
+        raise ConfigError(f'Light mac must be a quoted string like "d0:73:d5:00:00:01", but got {mac!r}')
+    digits = mac.replace(':', '').replace('-', '')
+    try:
+        if len(digits) != 12:
+            raise ValueError()
+        address = bytes.fromhex(digits)
+    except ValueError:
+        raise ConfigError(f'Light mac must be 6 hex bytes like d0:73:d5:00:00:01, but got {mac!r}')
+    if not any(address):
+        raise ConfigError(f'Light mac {mac!r} is the broadcast address')
+    return address + bytes(2)
+
+
+def _parse_light(config, number):
+    if not isinstance(config, dict):
+        raise ConfigError(f'Expected a mapping with parameters for light {number}, but got {type(config).__name__}')
+
+    if 'mac' not in config:
+        raise ConfigError(f'Light {number} is missing its mac address')
+    target = _parse_mac(config.pop('mac'))
+    label = str(config.pop('label', f'Pop HTTP {number}'))
+    if len(label.encode('utf-8')) > 32:
+        raise ConfigError(f'Label of light {number} must be at most 32 bytes, but got {label!r}')
+    switches = _parse_switches(config.pop('switches', None), f'Switches of light {label!r}')
+    default_url = config.pop('default_url', None)
+    if default_url is not None:
+        default_url = _parse_target_url(default_url, f'default_url of light {label!r}')
+    if not switches and default_url is None:
+        raise ConfigError(f'Light {label!r} needs switches or a default_url')
+
+    if config:
+        raise ConfigError(f'Light {label!r} contains unknown parameters {",".join(config)}')
+    return LightConfig(target, label, switches, default_url)
+
+
+def _parse_lights(config):
+    '''The virtual lights, keyed by their target'''
+    if config is None:
+        return {}
+    if not isinstance(config, list):
+        raise ConfigError(f'Expected a list of lights, but got {type(config).__name__}')
+    lights = {}
+    for number, light_config in enumerate(config, 1):
+        light = _parse_light(light_config, number)
+        if light.target in lights:
+            raise ConfigError(f'Lights {lights[light.target].label!r} and {light.label!r} have the same mac address')
+        lights[light.target] = light
+    return lights
+
+
+class SwitchIndex:
+    '''
+    Finds the targets for a switch without scanning every filter.
+    Filters are grouped by which of the h/s/b/k/p parameters they specify, and each group is a dict keyed by the
+    values of those parameters, so a lookup is one dict lookup per group regardless of the number of filters.
+    '''
+    FIELDS = ('h', 's', 'b', 'k', 'p')
+
+    def __init__(self, switches):
+        groups = {}
+        for order, (filter, target) in enumerate(switches):
+            fields = tuple(i for i, name in enumerate(self.FIELDS) if filter[name] is not None)
+            key = tuple(filter[self.FIELDS[i]] for i in fields)
+            groups.setdefault(fields, {}).setdefault(key, []).append((order, target))
+        self.groups = list(groups.items())
+
+    def match(self, hue, saturation, brightness, kelvin, power):
+        '''Returns the matching targets in the order they are listed in the config'''
+        values = (hue, saturation, brightness, kelvin, power)
+        matches = []
+        for fields, index in self.groups:
+            found = index.get(tuple(values[i] for i in fields))
+            if found:
+                matches.extend(found)
+        if len(matches) > 1:
+            matches.sort(key=itemgetter(0))
+        return [target for _, target in matches]
+
+
+class IPFilter:
+    '''
+    Decides whether to respond to a sender from lists of allowed and denied IPv4 & IPv6 networks. The most specific
+    network containing the address wins, with deny winning for the same network. Addresses that aren't in any of the
+    networks are only allowed if no allowed networks are listed.
+    The networks are compiled into a binary prefix trie for each IP version, and the decision for each sender is
+    cached so most packets only need a dict lookup.
+    '''
+    CACHE_SIZE = 4096
+
+    def __init__(self, allow=(), deny=()):
+        self.allow = list(allow)
+        self.deny = list(deny)
+        self.default = not self.allow
+        self._tries = {4: [None, None, None], 6: [None, None, None]} # [zero bit child, one bit child, decision]
+        self._cache = {}
+        for allowed, networks in ((True, self.allow), (False, self.deny)):
+            for network in networks:
+                self._insert(network, allowed)
+
+    def _insert(self, network, allowed):
+        node = self._tries[network.version]
+        value = int(network.network_address)
+        for shift in range(network.max_prefixlen - 1, network.max_prefixlen - 1 - network.prefixlen, -1):
+            bit = (value >> shift) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None or not allowed:
+            node[2] = allowed
+
+    def _lookup(self, ip):
+        address = ip_address(ip.partition('%')[0])
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        value = int(address)
+        shift = address.max_prefixlen
+        node = self._tries[address.version]
+        allowed = self.default
+        while node is not None:
+            if node[2] is not None:
+                allowed = node[2]
+            shift -= 1
+            if shift < 0:
+                break
+            node = node[(value >> shift) & 1]
+        return allowed
+
+    def is_allowed(self, ip):
+        allowed = self._cache.get(ip)
+        if allowed is None:
+            allowed = self._lookup(ip)
+            if len(self._cache) >= self.CACHE_SIZE:
+                del self._cache[next(iter(self._cache))]
+            self._cache[ip] = allowed
+        return allowed
+
+
+def _snapshot_key(source):
+    '''
+    Identifies the config file contents and the code that compiled them, so a snapshot is only used for the same
+    config with the same version of pophttp
+    '''
+    digest = hashlib.sha256(source)
+    with open(__file__, 'rb') as code_file:
+        digest.update(code_file.read())
+    digest.update(f'{__name__} {sys.version}'.encode('utf-8'))
+    return digest.hexdigest()
 
 
 class Config:
-    def __init__(self, filename):
-        with open(filename, 'r') as cfg_file:
-            config = yaml.load(cfg_file, yaml.SafeLoader)
+    RENDER_CACHE_SIZE = 256
+
+    def __init__(self, filename, source=None):
+        '''`source` is the contents of the file if it has already been read'''
+        if source is None:
+            with open(filename, 'rb') as cfg_file:
+                source = cfg_file.read()
+        config = yaml.load(source, SafeLoader)
+        if config is None:
+            config = {}
+        if not isinstance(config, dict):
+            raise ConfigError(f'Expected the config file to be a mapping of sections, but got {type(config).__name__}')
 
         default_url = config.get('default_url')
         self.default_url = _parse_target_url(default_url, 'default_url') if default_url is not None else None
         self.interface = config.get('interface', '0.0.0.0')
-        self.ip_filter = _parse_cidr(config.get('ip_filter', '0.0.0.0/0'))
-        self.switches = [(_parse_switch_filter(f), _parse_target_url(url, f)) for f, url in config.get('switches', {}).items()]
-        self.endpoints = [(e, _parse_endpoint_config(cfg, e)) for e, cfg in config.get('endpoints', {}).items()]
+        self.socket = _parse_socket_config(config.get('socket', {}))
+        self.ip_filter = _parse_ip_filter(config.get('ip_filter'))
+        self.switches = _parse_switches(config.get('switches'), 'Section switches')
+        endpoints = config.get('endpoints') or {}
+        if not isinstance(endpoints, dict):
+            raise ConfigError(f'Section endpoints must be a mapping of base URLs to their parameters, but got {type(endpoints).__name__}')
+        self.endpoints = [(e, _parse_endpoint_config(cfg, e)) for e, cfg in endpoints.items()]
+        self.dispatch = _parse_dispatch_config(config.get('dispatch', {}))
+        self.metrics = _parse_metrics_config(config.get('metrics'))
+        self.cluster = _parse_cluster_config(config.get('cluster'))
+        self.lights = _parse_lights(config.get('lights'))
+        # The single light that answers for any target is kept for the top level switches, or when there are no lights
+        self.default_light = not self.lights or bool(self.switches) or self.default_url is not None
 
-    def is_ip_allowed(self, ip):
-        ip = struct.unpack('>L', inet_aton(ip))[0]
-        net_mask = ((1 << self.ip_filter[1]) - 1) << (32-self.ip_filter[1])
-        return ip & net_mask == self.ip_filter[0] & net_mask
+        self.switch_index = SwitchIndex([(f, self._compile_target(t, f'switch filter {key!r}')) for key, f, t in self.switches])
+        self.default_target = self._compile_target(self.default_url, 'default_url') if self.default_url is not None else None
+        self.light_index = dict(
+            (target, (
+                SwitchIndex([(f, self._compile_target(t, f'light {light.label!r} switch filter {key!r}')) for key, f, t in light.switches]),
+                self._compile_target(light.default_url, f'default_url of light {light.label!r}') if light.default_url is not None else None,
+            ))
+            for target, light in self.lights.items()
+        )
+        self._render_targets = lru_cache(maxsize=self.RENDER_CACHE_SIZE)(self._render_targets)
+
+    @classmethod
+    def load(cls, filename, snapshot=None):
+        '''
+        Load the config from `filename`. If `snapshot` is given, the config is saved there once it has been parsed and
+        validated, and is loaded from there instead for as long as the config file and pophttp stay the same.
+        The snapshot is a pickle, so it must be somewhere only pophttp can write to.
+        '''
+        with open(filename, 'rb') as cfg_file:
+            source = cfg_file.read()
+        if snapshot is None:
+            return cls(filename, source)
+
+        key = _snapshot_key(source)
+        try:
+            with open(snapshot, 'rb') as snapshot_file:
+                snapshot_key, config = pickle.load(snapshot_file)
+            if snapshot_key == key:
+                return config
+        except FileNotFoundError:
+            pass
+        except Exception as err: # Anything could go wrong unpickling an old or damaged snapshot
+            log.warning('config snapshot %s could not be loaded, rebuilding it: %r', snapshot, err, extra=dict(sender_ip='-'))
 
-    def get_target_for_switch(self, hue, saturation, brightness, kelvin, power):
-        targets = []
+        config = cls(filename, source)
+        try:
+            with open(f'{snapshot}.tmp', 'wb') as snapshot_file:
+                pickle.dump((key, config), snapshot_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(f'{snapshot}.tmp', snapshot)
+        except OSError as err:
+            log.warning('unable to save config snapshot %s: %s', snapshot, err, extra=dict(sender_ip='-'))
+        return config
+
+    def __getstate__(self):
+        # The render cache wraps a bound method and can't be pickled, so it is started again when a snapshot is loaded
+        state = dict(self.__dict__)
+        del state['_render_targets']
+        return state
 
-        match = dict(h=hue, s=saturation, b=brightness, k=kelvin, p=power)
-        for filter, target in self.switches:
-            this_match = dict((k, None if filter[k] is None else v) for k, v in match.items())
-            if this_match == filter:
-                targets.append(target)
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._render_targets = lru_cache(maxsize=self.RENDER_CACHE_SIZE)(self._render_targets)
 
-        if not targets and self.default_url is not None:
-            targets.append(self.default_url)
+    def _compile_target(self, target, section):
+        '''
+        Resolve everything about a target that doesn't depend on the switch press: the templates are compiled and
+        the endpoint's method, headers, timeout, retry policy, rate limit & coalescing are merged in
+        '''
+        method = target.method
+        headers = target.headers
+        timeout = target.timeout
+        retry = target.retry
+        name, endpoint = self._find_endpoint(target.url)
+        if endpoint is not None:
+            method = endpoint.method or method
+            headers = dict(endpoint.headers)
+            headers.update(target.headers)
+            timeout = timeout or endpoint.timeout
+            retry = retry or endpoint.retry
+        body = Template(target.body, section) if target.body is not None else None
+        return SwitchConfig(
+            Template(target.url, section), method, body, headers, timeout or self.dispatch.timeout, retry,
+            name, endpoint.rate_limit if endpoint is not None else None, endpoint is not None and endpoint.coalesce, target.url
+        )
+
+    def is_ip_allowed(self, ip):
+        return self.ip_filter.is_allowed(ip)
 
-        return [
-            SwitchConfig(format_template(t.url, hue, saturation, brightness, kelvin, power), t.method, t.body, t.headers)
+    def _render_targets(self, hue, saturation, brightness, kelvin, power, light):
+        if light is None:
+            switch_index, default_target = self.switch_index, self.default_target
+        elif light in self.light_index:
+            switch_index, default_target = self.light_index[light]
+        else:
+            return () # The light was removed when the config was reloaded
+        targets = switch_index.match(hue, saturation, brightness, kelvin, power)
+        if not targets and default_target is not None:
+            targets.append(default_target)
+
+        return tuple(
+            SwitchConfig(
+                t.url.render(hue, saturation, brightness, kelvin, power),
+                t.method,
+                t.body.render(hue, saturation, brightness, kelvin, power) if t.body is not None else None,
+                t.headers,
+                t.timeout,
+                t.retry,
+                t.endpoint,
+                t.rate_limit,
+                t.coalesce,
+                t.source
+            )
             for t in targets
-        ]
-    
-    def get_endpoint_for_url(self, url):
+        )
+
+    def get_target_for_switch(self, hue, saturation, brightness, kelvin, power, light=None):
+        '''
+        Returns the requests to make for a switch press, with the URL and body rendered and the endpoint settings
+        applied. `light` is the target of the light the press was sent to, or None for the top level switches.
+        The pop bridge only uses a handful of distinct colors, so the results are cached.
+        '''
+        return list(self._render_targets(hue, saturation, brightness, kelvin, power, light))
+
+    def webhook_hosts(self):
+        '''
+        The (scheme, host, port) of every server in the switches, default_url, lights & endpoints, leaving out any
+        where the host is filled in from a template parameter
+        '''
+        urls = [target.url for _, _, target in self.switches] + [endpoint for endpoint, _ in self.endpoints]
+        if self.default_url is not None:
+            urls.append(self.default_url.url)
+        for light in self.lights.values():
+            urls.extend(target.url for _, _, target in light.switches)
+            if light.default_url is not None:
+                urls.append(light.default_url.url)
+        hosts = set()
+        for url in urls:
+            try:
+                parts = urlsplit(url)
+                port = parts.port or (443 if parts.scheme == 'https' else 80)
+            except ValueError:
+                continue
+            if parts.scheme in ('http', 'https') and parts.hostname and '{' not in parts.netloc:
+                hosts.add((parts.scheme, parts.hostname, port))
+        return sorted(hosts)
+
+    def _find_endpoint(self, url):
+        '''Returns the (name, config) of the most specific endpoint for the URL, or (None, None)'''
         matches = [(e, c) for (e, c) in self.endpoints if url.startswith(e)]
         if not matches:
-            return None
-        return sorted(matches, key=lambda e: len(e[0]), reverse=True)[0][1]
+            return None, None
+        return sorted(matches, key=lambda e: len(e[0]), reverse=True)[0]
+
+    def get_endpoint_for_url(self, url):
+        return self._find_endpoint(url)[1]
@@ -0,0 +1,72 @@
+import logging
+import os
+import signal
+import threading
+import yaml
+from time import sleep
+try:
+    from config import Config, ConfigError
+except ImportError:
+    from .config import Config, ConfigError
+
+
+log = logging.getLogger('pophttp')
+
+
+class ConfigReloader:
+    '''
+    Reloads the config file on SIGHUP, or when the file changes if it is being watched.
+    The new file is parsed on a background thread and only handed to `apply` if it loads without errors, otherwise
+    the current config stays in use.
+    '''
+    def __init__(self, filename, apply, config=None, snapshot=None):
+        self.filename = filename
+        self.apply = apply
+        self.config = config
+        self.snapshot = snapshot
+        self._lock = threading.Lock()
+        self._file_state = self._stat()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def reload(self):
+        '''Load the config file and apply it. Returns False if the file couldn't be loaded'''
+        with self._lock:
+            self._file_state = self._stat()
+            try:
+                config = Config.load(self.filename, self.snapshot)
+            except (ConfigError, yaml.YAMLError, OSError) as err:
+                log.error('config reload failed, keeping the current config: %s', err, extra=dict(sender_ip='-'))
+                return False
+            except Exception as err: # A mistake in the file that the parsing doesn't check for, which mustn't stop reloading
+                log.error('config reload failed, keeping the current config: %r', err, extra=dict(sender_ip='-'))
+                return False
+            if self.config is not None and config.interface != self.config.interface:
+                log.warning('config interface changed to %s, this requires a restart to take effect', config.interface, extra=dict(sender_ip='-'))
+            self.config = config
+            self.apply(config)
+            log.info('config reloaded from %s', self.filename, extra=dict(sender_ip='-'))
+            return True
+
+    def reload_in_background(self):
+        threading.Thread(target=self.reload, name='config-reload', daemon=True).start()
+
+    def install_signal_handler(self):
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.reload_in_background())
+
+    def watch(self, interval):
+        '''Check the config file for changes every `interval` seconds on a background thread'''
+        def poll():
+            while True:
+                sleep(interval)
+                if self._stat() != self._file_state:
+                    try:
+                        self.reload()
+                    except Exception:
+                        log.exception('config reload failed', extra=dict(sender_ip='-'))
+        threading.Thread(target=poll, name='config-watch', daemon=True).start()
@@ -0,0 +1,82 @@
+'''
+Tracking of the last switch action that was triggered. When there are multiple pop bridges they all send the same
+action, and only the first bridge to send it should trigger it.
+
+Also recognising a bridge's retransmits of the same message, so they can be acknowledged without being handled again.
+'''
+
+import ctypes
+import multiprocessing
+from collections import OrderedDict
+from hashlib import blake2b
+
+
+class LastTrigger:
+    '''The last trigger, kept in this process'''
+    def __init__(self):
+        self.last = None
+
+    def claim(self, sender, trigger):
+        '''Returns False if another sender has already triggered the same action, otherwise records this trigger'''
+        if self.last is not None and self.last[1] == trigger and self.last[0] != sender:
+            return False
+        self.last = (sender, trigger)
+        return True
+
+
+def _digest(value):
+    return blake2b(repr(value).encode('utf-8'), digest_size=16).digest()
+
+
+class SharedLastTrigger:
+    '''
+    The last trigger, kept in shared memory so it is shared by all of the worker processes forked from the process
+    that created it. The sender and trigger are stored as digests of their repr so they fit in a fixed size buffer.
+    '''
+    def __init__(self):
+        self._last = multiprocessing.RawArray(ctypes.c_char, 32)
+        self._lock = multiprocessing.Lock()
+
+    def claim(self, sender, trigger):
+        sender_key = _digest(sender)
+        trigger_key = _digest(trigger)
+        with self._lock:
+            last = self._last.raw
+            if last[16:] == trigger_key and last[:16] != sender_key:
+                return False
+            self._last.raw = sender_key + trigger_key
+            return True
+
+
+class RetransmitFilter:
+    '''
+    Recognises a bridge resending the same message from the message code and raw payload bytes, before the packet is
+    decoded. A message is a retransmit if the sender sent the same payload for the code within the last `window`
+    seconds and hasn't sent a different payload for any code since, which is the same rule the MessageHandler uses
+    to ignore them. The least recently seen senders are forgotten beyond `max_senders`.
+    '''
+    def __init__(self, window=5, max_senders=1024):
+        self.window = window
+        self.max_senders = max_senders
+        self._senders = OrderedDict() # sender -> {code: (payload, first seen)}
+
+    def is_retransmit(self, sender, code, payload, now):
+        seen = self._senders.get(sender)
+        if seen is None:
+            seen = self._senders[sender] = {}
+            if len(self._senders) > self.max_senders:
+                self._senders.popitem(last=False)
+        else:
+            self._senders.move_to_end(sender)
+
+        last = seen.get(code)
+        if last is not None:
+            if last[0] == payload and now - last[1] < self.window:
+                return True
+            # The bridge has started sending something new, so none of what it sent before can be a retransmit
+            seen.clear()
+        seen[code] = (payload, now)
+        return False
+
+    def forget(self, sender):
+        self._senders.pop(sender, None)
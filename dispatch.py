@@ -0,0 +1,300 @@
+import logging
+import threading
+from collections import deque, namedtuple
+from time import monotonic
+
+
+log = logging.getLogger('pophttp')
+
+Action = namedtuple("Action", "sender_ip url method body headers timeout retry attempt retry_id trace endpoint rate_limit coalesce_key", defaults=(None, 0, None, None, None, None, None))
+
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_REJECT = 'reject'
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_REJECT)
+
+
+class TokenBucket:
+    '''Allows up to `limit.burst` actions at once, refilling at `limit.rate` actions per second'''
+    def __init__(self, limit, now):
+        self.limit = limit
+        self.tokens = float(limit.burst)
+        self.updated = now
+
+    def take(self, now):
+        '''Takes a token and returns 0, or if there are none returns the number of seconds until there will be'''
+        self.tokens = min(self.limit.burst, self.tokens + (now - self.updated) * self.limit.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.limit.rate
+
+
+class Throttle:
+    '''
+    The rate limits for each endpoint and the coalescing of actions for the same switch, applied to the actions that
+    a dispatcher has waiting to start. Actions for an endpoint that is being rate limited wait in the order they were
+    submitted, without holding up actions for other endpoints.
+    '''
+    def __init__(self):
+        self._buckets = {}
+        self.coalesced = 0
+
+    def coalesce(self, pending, action):
+        '''
+        If an action with the same coalesce_key is waiting, replace it with `action` so only the latest state is sent,
+        and return True. A retry doesn't replace the waiting action but is dropped, since it has an older state
+        '''
+        if action.coalesce_key is None:
+            return False
+        for i, waiting in enumerate(pending):
+            if waiting.coalesce_key == action.coalesce_key:
+                if action.attempt == 0:
+                    pending[i] = action
+                self.coalesced += 1
+                log.debug('dispatch coalesced %s into %s', waiting.url, pending[i].url, extra=dict(sender_ip=action.sender_ip))
+                return True
+        return False
+
+    def _bucket(self, action, now):
+        bucket = self._buckets.get(action.endpoint)
+        if bucket is None or bucket.limit != action.rate_limit:
+            bucket = self._buckets[action.endpoint] = TokenBucket(action.rate_limit, now)
+        return bucket
+
+    def take_ready(self, pending, now):
+        '''
+        Remove and return the first waiting action that is within its endpoint's rate limit, as (action, None).
+        If none are, returns (None, the number of seconds until one might be), or (None, None) if nothing is waiting
+        '''
+        limited = set()
+        wait = None
+        for i, action in enumerate(pending):
+            if action.rate_limit is not None:
+                if action.endpoint in limited:
+                    continue
+                delay = self._bucket(action, now).take(now)
+                if delay > 0:
+                    limited.add(action.endpoint)
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+            del pending[i]
+            return action, None
+        return None, wait
+
+
+class Dispatcher:
+    '''
+    Runs actions on a pool of worker threads so that slow endpoints never hold up the UDP receive loop.
+    Actions are queued in a bounded queue. When the queue is full the `overflow` policy decides whether the oldest
+    queued action is dropped to make room, or the new action is rejected.
+    Queued actions are coalesced and wait for their endpoint's rate limit as described in Throttle.
+    '''
+    def __init__(self, execute, workers=4, queue_size=100, overflow=OVERFLOW_DROP_OLDEST):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy {overflow!r}')
+        self.execute = execute
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._throttle = Throttle()
+
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.busy = 0
+        self.max_depth = 0
+
+        self._threads = [threading.Thread(target=self._worker, name=f'dispatch-{i}', daemon=True) for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    def stats(self):
+        with self._cond:
+            return dict(
+                depth=len(self._queue),
+                max_depth=self.max_depth,
+                busy=self.busy,
+                submitted=self.submitted,
+                completed=self.completed,
+                dropped=self.dropped,
+                rejected=self.rejected,
+                coalesced=self._throttle.coalesced,
+            )
+
+    def submit(self, action):
+        '''Queue an action to be run by the next free worker. Returns False if the action was rejected'''
+        with self._cond:
+            if self._throttle.coalesce(self._queue, action):
+                self.submitted += 1
+                return True
+            if len(self._queue) >= self.queue_size:
+                if self.overflow == OVERFLOW_REJECT:
+                    self.rejected += 1
+                    log.warning('dispatch queue full (%d), rejecting %s', len(self._queue), action.url, extra=dict(sender_ip=action.sender_ip))
+                    return False
+                dropped = self._queue.popleft()
+                self.dropped += 1
+                log.warning('dispatch queue full (%d), dropping oldest %s', len(self._queue) + 1, dropped.url, extra=dict(sender_ip=dropped.sender_ip))
+            self._queue.append(action)
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, len(self._queue))
+            log.debug('dispatch queued %s (depth %d, busy %d)', action.url, len(self._queue), self.busy, extra=dict(sender_ip=action.sender_ip))
+            self._cond.notify()
+        return True
+
+    def stop(self, timeout=None):
+        '''Stop the workers once the queue has been drained'''
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while True:
+                    action, wait = self._throttle.take_ready(self._queue, monotonic())
+                    if action is not None or (self._stopping and not self._queue):
+                        break
+                    self._cond.wait(wait)
+                if action is None:
+                    return
+                self.busy += 1
+            try:
+                self.execute(action)
+            except Exception:
+                log.exception('dispatch failed for %s', action.url, extra=dict(sender_ip=action.sender_ip))
+            finally:
+                with self._cond:
+                    self.busy -= 1
+                    self.completed += 1
+
+
+class AsyncDispatcher:
+    '''
+    The asyncio engine equivalent of Dispatcher. Each action is run as a task on the event loop, with at most
+    `queue_size` actions in progress at once. The `overflow` policy applies the same way as for Dispatcher, with
+    drop-oldest cancelling the oldest action that is still in progress.
+    Actions for rate limited endpoints wait until they are within the limit before they are started, and are
+    coalesced while they wait.
+    asyncio is imported by the methods that use it, so the thread engine doesn't have to load it.
+    '''
+    def __init__(self, execute, queue_size=100, overflow=OVERFLOW_DROP_OLDEST):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy {overflow!r}')
+        self.execute = execute
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self._tasks = deque()
+        self._pending = deque()
+        self._throttle = Throttle()
+        self._timer = None
+
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self):
+        return len(self._tasks) + len(self._pending)
+
+    def stats(self):
+        return dict(
+            depth=len(self._tasks) + len(self._pending),
+            max_depth=self.max_depth,
+            busy=len(self._tasks),
+            submitted=self.submitted,
+            completed=self.completed,
+            dropped=self.dropped,
+            rejected=self.rejected,
+            coalesced=self._throttle.coalesced,
+        )
+
+    def submit(self, action):
+        '''
+        Start running an action as a task, or leave it waiting for its endpoint's rate limit. Must be called from the
+        event loop thread. Returns False if the action was rejected
+        '''
+        if action.rate_limit is None and not self._pending:
+            return self._start(action)
+        if self._throttle.coalesce(self._pending, action):
+            self.submitted += 1
+            return True
+        self._pending.append(action)
+        return self._start_ready(action)
+
+    def _start_ready(self, submitted=None):
+        '''Start every waiting action that is within its rate limit, returning False if `submitted` was rejected'''
+        accepted = True
+        while True:
+            action, wait = self._throttle.take_ready(self._pending, monotonic())
+            if action is None:
+                break
+            if not self._start(action) and action is submitted:
+                accepted = False
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if wait is not None:
+            import asyncio
+            self._timer = asyncio.get_event_loop().call_later(wait, self._on_timer)
+        return accepted
+
+    def _on_timer(self):
+        self._timer = None
+        self._start_ready()
+
+    def _start(self, action):
+        if len(self._tasks) >= self.queue_size:
+            if self.overflow == OVERFLOW_REJECT:
+                self.rejected += 1
+                log.warning('dispatch limit reached (%d), rejecting %s', len(self._tasks), action.url, extra=dict(sender_ip=action.sender_ip))
+                return False
+            oldest_task, oldest_action = self._tasks.popleft()
+            oldest_task.cancel()
+            self.dropped += 1
+            log.warning('dispatch limit reached (%d), cancelling oldest %s', len(self._tasks) + 1, oldest_action.url, extra=dict(sender_ip=oldest_action.sender_ip))
+
+        import asyncio
+        entry = (asyncio.get_event_loop().create_task(self._run(action)), action)
+        self._tasks.append(entry)
+        entry[0].add_done_callback(lambda task: self._done(entry))
+        self.submitted += 1
+        self.max_depth = max(self.max_depth, len(self._tasks))
+        log.debug('dispatch started %s (in progress %d)', action.url, len(self._tasks), extra=dict(sender_ip=action.sender_ip))
+        return True
+
+    async def stop(self):
+        '''Wait for all of the actions in progress to finish'''
+        if self._tasks:
+            import asyncio
+            await asyncio.wait([task for task, _ in self._tasks])
+
+    async def _run(self, action):
+        import asyncio
+        try:
+            await self.execute(action)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception('dispatch failed for %s', action.url, extra=dict(sender_ip=action.sender_ip))
+
+    def _done(self, entry):
+        try:
+            self._tasks.remove(entry)
+        except ValueError:
+            pass  # already removed when it was cancelled
+        # Actions cancelled by drop-oldest are counted as dropped instead
+        if not entry[0].cancelled():
+            self.completed += 1
@@ -0,0 +1,213 @@
+import logging
+import threading
+from collections import namedtuple
+from time import monotonic
+from urllib.parse import urlsplit
+
+
+log = logging.getLogger('pophttp')
+
+PoolResponse = namedtuple("PoolResponse", "code reason headers body reused")
+
+DEFAULT_MAX_CONNECTIONS = 4
+DEFAULT_IDLE_TIMEOUT = 30
+
+# Errors that mean a kept-alive connection was closed by the server while it was idle in the pool, along with
+# http.client's BadStatusLine (which also includes RemoteDisconnected)
+STALE_CONNECTION_ERRORS = (ConnectionResetError, ConnectionAbortedError, BrokenPipeError)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def _http_client():
+    # http.client & ssl take a while to import, so they are left until they are needed and pophttp can start
+    # answering the bridges first
+    import http.client
+    return http.client
+
+
+def preload():
+    '''Import the HTTP stack ahead of the first request, such as from a background thread once the server is up'''
+    _http_client()
+
+
+def __getattr__(name):
+    # Lets callers catch httppool.HTTPException without importing http.client themselves
+    if name == 'HTTPException':
+        return _http_client().HTTPException
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+class _HostPool:
+    def __init__(self, scheme, host, port, max_connections, idle_timeout, resolver=None):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.resolver = resolver
+        self.idle = []  # (connection, time it was returned to the pool), most recently used last
+        self.open = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, timeout):
+        '''Returns a tuple of (connection, reused)'''
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.cond:
+            while True:
+                now = monotonic()
+                while self.idle:
+                    conn, last_used = self.idle.pop()
+                    if now - last_used < self.idle_timeout:
+                        return conn, True
+                    conn.close()
+                    self.open -= 1
+                if self.open < self.max_connections:
+                    self.open += 1
+                    break
+                remaining = None if deadline is None else deadline - now
+                if remaining is not None and remaining <= 0:
+                    raise PoolTimeout(f'timed out waiting for a free connection to {self.host}:{self.port}')
+                self.cond.wait(remaining)
+
+        http_client = _http_client()
+        conn_type = http_client.HTTPSConnection if self.scheme == 'https' else http_client.HTTPConnection
+        log.debug('pool opening new connection to %s://%s:%d (%d open)', self.scheme, self.host, self.port, self.open, extra=dict(sender_ip='-'))
+        conn = conn_type(self.host, self.port, timeout=timeout)
+        if self.resolver is not None:
+            # Connect to the cached addresses, while the Host header & TLS server name still use the host name
+            resolver = self.resolver
+            conn._create_connection = lambda address, timeout, source_address: resolver.create_connection(address[0], address[1], timeout, source_address)
+        return conn, False
+
+    def release(self, conn):
+        with self.cond:
+            self.idle.append((conn, monotonic()))
+            self.cond.notify()
+
+    def discard(self, conn):
+        conn.close()
+        with self.cond:
+            self.open -= 1
+            self.cond.notify()
+
+    def close_expired(self, before):
+        '''Close the idle connections that will have been idle for longer than the idle timeout by the time `before`'''
+        with self.cond:
+            expired = [conn for conn, last_used in self.idle if before - last_used >= self.idle_timeout]
+            if expired:
+                self.idle = [(conn, last_used) for conn, last_used in self.idle if before - last_used < self.idle_timeout]
+                for conn in expired:
+                    conn.close()
+                self.open -= len(expired)
+                self.cond.notify_all()
+
+    def close_idle(self):
+        with self.cond:
+            for conn, _ in self.idle:
+                conn.close()
+            self.open -= len(self.idle)
+            self.idle = []
+            self.cond.notify_all()
+
+
+class ConnectionPool:
+    '''
+    Keeps HTTP(S) connections open between requests so each switch press doesn't pay for a new TCP & TLS handshake.
+    Connections are pooled for each scheme/host/port. The limits for each pool come from the config for the endpoint
+    matching the URL, falling back to the `dispatch` section.
+    '''
+    def __init__(self, config=None, resolver=None):
+        self.config = config
+        self.resolver = resolver
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _limits(self, url):
+        max_connections = DEFAULT_MAX_CONNECTIONS
+        idle_timeout = DEFAULT_IDLE_TIMEOUT
+        if self.config is not None:
+            max_connections = self.config.dispatch.max_connections
+            idle_timeout = self.config.dispatch.idle_timeout
+            endpoint = self.config.get_endpoint_for_url(url)
+            if endpoint is not None:
+                max_connections = endpoint.max_connections or max_connections
+                idle_timeout = endpoint.idle_timeout or idle_timeout
+        return max_connections, idle_timeout
+
+    def _host_pool(self, url):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f'Unsupported URL scheme {parts.scheme!r} in {url}')
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        with self._lock:
+            host_pool = self._hosts.get(key)
+            if host_pool is None:
+                host_pool = self._hosts[key] = _HostPool(parts.scheme, parts.hostname, port, *self._limits(url), self.resolver)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        return host_pool, path
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        '''
+        Send a request over a pooled connection and return a PoolResponse once the whole response has been read.
+        If a reused connection turns out to have been closed by the server, the request is retried once on a new
+        connection.
+        '''
+        host_pool, path = self._host_pool(url)
+        method = method or ('GET' if body is None else 'POST')
+        headers = dict(headers or {})
+        if body is not None:
+            headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+
+        while True:
+            conn, reused = host_pool.acquire(timeout)
+            try:
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                conn.request(method, path, body, headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (_http_client().BadStatusLine,) + STALE_CONNECTION_ERRORS as err:
+                host_pool.discard(conn)
+                if not reused:
+                    raise
+                log.debug('pool reconnecting to %s after %r', url, err, extra=dict(sender_ip='-'))
+                continue
+            except BaseException:
+                host_pool.discard(conn)
+                raise
+
+            if resp.will_close:
+                host_pool.discard(conn)
+            else:
+                host_pool.release(conn)
+            return PoolResponse(resp.status, resp.reason, resp.headers, data, reused)
+
+    def prewarm(self, url, timeout=None, margin=0):
+        '''
+        Open a connection to the server for the URL and leave it in the pool, unless there's already one idle.
+        Idle connections that will pass their idle timeout within `margin` seconds are closed and replaced first
+        '''
+        host_pool, _ = self._host_pool(url)
+        host_pool.close_expired(monotonic() + margin)
+        with host_pool.cond:
+            if host_pool.idle or host_pool.open >= host_pool.max_connections:
+                return
+        conn, _ = host_pool.acquire(timeout)
+        try:
+            conn.connect()
+        except BaseException:
+            host_pool.discard(conn)
+            raise
+        host_pool.release(conn)
+
+    def close(self):
+        with self._lock:
+            for host_pool in self._hosts.values():
+                host_pool.close_idle()
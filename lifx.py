@@ -1,3 +1,5 @@
+import itertools
+import re
 import struct
 from collections import namedtuple
 from random import randint
@@ -15,29 +17,34 @@ class PayloadDef(object):
         self.members = members.split(' ')
         self.type = namedtuple(name, members)
         self.fmt = '<' + fmt
-        self.length = struct.calcsize(self.fmt)
+        self.struct = struct.Struct(self.fmt)
+        self.length = self.struct.size
+        # Only the `s` fields can hold text, so they are the only ones that need decoding
+        self.string_fields = tuple(i for i, code in enumerate(re.findall(r'\d*[a-zA-Z?]', fmt)) if code.endswith('s'))
 
     def encode(self, members):
-        if sys.version_info > (3, 0):
-            members = [m.encode('utf-8') if isinstance(m, str) else m for m in members]
-        return struct.pack(self.fmt, *members)
-
-    def decode(self, payload):
-        members = struct.unpack(self.fmt, payload)
-        if sys.version_info > (3, 0):
-            def try_decode(val):
-                if isinstance(val, bytes):
-                    try:
-                        return val.decode('utf-8')
-                    except UnicodeDecodeError:
-                        pass
-                return val
-            members = [try_decode(m) for m in members]
-        return self.type(*members)
+        members = [m.encode('utf-8') if isinstance(m, str) else m for m in members]
+        return self.struct.pack(*members)
+
+    def decode(self, payload, offset=0):
+        members = self.struct.unpack_from(payload, offset)
+        if self.string_fields:
+            members = list(members)
+            for i in self.string_fields:
+                try:
+                    members[i] = members[i].decode('utf-8')
+                except UnicodeDecodeError:
+                    pass
+        return self.type._make(members)
+
+_sequence_numbers = itertools.count(1)
+
+def next_sequence():
+    '''The sequence number for the next packet sent this session, shared by all packets'''
+    return next(_sequence_numbers) & 0xFF
 
 class Packet(object):
     source = randint(1, 0xFFFFFFFF) #a random one per session
-    sequence_number = 0
 
     def __init__(self, pkt_def, *args, **kwargs):
         self.pkt_def = pkt_def
@@ -55,7 +62,6 @@ class Packet(object):
             target_vs = str(target_vs)
             site_vs = str(site_vs)
 
-        self.sequence_number += 1
         self.header = self.pkt_def.header_fmt.type(
             size = self.pkt_def.header_fmt.length + self.pkt_def.payload_fmt.length,
             protocol_and_flags = 0x800 | (0x2000 if target == BROADCAST_TARGET else 0),
@@ -63,7 +69,7 @@ class Packet(object):
             target = target_vs,
             site = site_vs,
             acknowledge = 0,
-            sequence = self.sequence_number & 0xFF,
+            sequence = next_sequence(),
             timestamp = 0,
             code = self.pkt_def.code,
             reserved = 0
@@ -91,17 +97,25 @@ class PacketDef(object):
 
     def __init__(self, code, name, members='', fmt=''):
         self.code = code
+        self.name = name
         self.payload_fmt = PayloadDef(name, members, fmt)
+        self.length = self.header_fmt.length + self.payload_fmt.length
 
     def __call__(self, *args, **kwargs):
         return Packet(self, *args, **kwargs)
 
     def decode(self, data, header):
+        if len(data) != self.length:
+            raise struct.error(f'{self.name} packet must be {self.length} bytes, but got {len(data)}')
         pkt = Packet(self, header=header)
-        pkt.header = self.header_fmt.decode(data[:self.header_fmt.length])
-        pkt.payload = self.payload_fmt.decode(data[self.header_fmt.length:])
+        pkt.payload = self.payload_fmt.decode(data, self.header_fmt.length)
         return pkt
 
+HEADER_LENGTH = PacketDef.header_fmt.length
+TARGET_SLICE = slice(8, 16)
+SITE_SLICE = slice(16, 22)
+CODE_SLICE = slice(32, 34)
+
 class Message(object):
     Device_GetVersion = PacketDef(32, 'Device_GetVersion')
     Device_StateVersion = PacketDef(33, 'Device_StateVersion', 'vendor product version', 'III')
@@ -111,11 +125,54 @@ class Message(object):
     Light_State = PacketDef(107, 'Light_State', 'hue saturation brightness kelvin dim power label tags', 'HHHHhH32sQ')
     Light_SetPower = PacketDef(117, 'Light_SetPower', 'level duration', 'HI')
 
+    by_code = {}
+
     @classmethod
     def decode(cls, data):
-        header = PacketDef.header_fmt.decode(data[:PacketDef.header_fmt.length])
-        for member_name in dir(Message):
-            member = getattr(Message, member_name)
-            if isinstance(member, PacketDef) and member.code == header.code:
-                return member.decode(data, header)
-        return None
+        data = memoryview(data)
+        header = PacketDef.header_fmt.decode(data)
+        pkt_def = cls.by_code.get(header.code)
+        if pkt_def is None:
+            return None
+        return pkt_def.decode(data, header)
+
+Message.by_code.update((m.code, m) for m in vars(Message).values() if isinstance(m, PacketDef))
+
+
+class ReplyTemplate(object):
+    '''
+    A reply whose payload never changes, encoded once. Encoding it for a request only copies the bytes and patches in
+    the source, target, site and sequence number, instead of building and packing the whole packet again.
+    Replies are addressed to the bridge that sent the request so they are never tagged, whatever the target is.
+    '''
+    # source target site, after the size & protocol_and_flags
+    addressing = struct.Struct('<I8s6s')
+    addressing_offset = 4
+    sequence_offset = 23
+
+    def __init__(self, packet):
+        self.packet = packet
+        header = PacketDef.header_fmt.type(
+            size = packet.pkt_def.length,
+            protocol_and_flags = 0x800,
+            source = 0,
+            target = bytes(8),
+            site = bytes(6),
+            acknowledge = 0,
+            sequence = 0,
+            timestamp = 0,
+            code = packet.code,
+            reserved = 0
+        )
+        self.data = PacketDef.header_fmt.encode(header) + packet.pkt_def.payload_fmt.encode(packet.payload)
+
+    def encode(self, target, site):
+        '''`target` & `site` can be the raw bytes from a request, or the header fields decoded from it'''
+        if isinstance(target, str):
+            target = target.encode('utf-8')
+        if isinstance(site, str):
+            site = site.encode('utf-8')
+        data = bytearray(self.data)
+        self.addressing.pack_into(data, self.addressing_offset, Packet.source, target, site)
+        data[self.sequence_offset] = next_sequence()
+        return data
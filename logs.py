@@ -0,0 +1,116 @@
+'''
+Logging for pophttp. Records are handed to a background thread to be formatted and written, so the packet path only
+pays for creating the record. Output is either the plain text format or JSON lines, and repetitive debug lines are
+rate limited.
+'''
+
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from collections import OrderedDict
+from time import monotonic
+
+
+TEXT_FORMAT = '%(asctime)-15s %(sender_ip)s %(message)s'
+
+# Fields passed in `extra` that are included in the JSON output when they are set
+JSON_FIELDS = ('sender_ip', 'sender_port', 'switch', 'url', 'endpoint', 'code', 'latency_ms')
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = dict(time=self.formatTime(record), level=record.levelname, message=record.getMessage())
+        for field in JSON_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None and value != '-':
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    '''
+    Lets through at most 1 record every `interval` seconds for each `rate_key` (given in `extra`) & sender, such as the
+    debug lines for the Get/GetVersion polling that every bridge does. The next record let through says how many were
+    suppressed. Records without a rate_key are never limited.
+    Senders that haven't had a record let through for `ttl` seconds are forgotten, and the least recent are evicted
+    once there are more than `max_entries`, so packets from lots of different senders can't use an unbounded amount
+    of memory.
+    '''
+    def __init__(self, interval=10.0, max_entries=1024, ttl=60.0):
+        super().__init__()
+        self.interval = interval
+        self.max_entries = max_entries
+        self.ttl = max(ttl, interval)
+        self._seen = OrderedDict() # (rate_key, sender_ip) -> [time let through, suppressed since], least recent first
+
+    def filter(self, record):
+        rate_key = getattr(record, 'rate_key', None)
+        if rate_key is None:
+            return True
+        key = (rate_key, getattr(record, 'sender_ip', None))
+        now = monotonic()
+        seen = self._seen.get(key)
+        if seen is not None and now - seen[0] < self.interval:
+            seen[1] += 1
+            return False
+        if seen is not None and seen[1]:
+            record.msg = f'{record.msg} (%d similar suppressed)'
+            record.args = tuple(record.args or ()) + (seen[1],)
+        self._seen[key] = [now, 0]
+        self._seen.move_to_end(key)
+        self._expire(now)
+        return True
+
+    def _expire(self, now):
+        while self._seen:
+            oldest = next(iter(self._seen.values()))
+            if len(self._seen) <= self.max_entries and now - oldest[0] < self.ttl:
+                break
+            self._seen.popitem(last=False)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    '''Queues the record as it is, leaving all of the formatting for the listener thread'''
+    def prepare(self, record):
+        return record
+
+
+class QueueLogging:
+    '''
+    A handler for the logger that queues records, and a listener thread that filters, formats and writes them.
+    Worker processes forked with --workers get their own queue and listener thread.
+    '''
+    def __init__(self, logger, level, json_lines=False, stream=None):
+        self.logger = logger
+        stream_handler = logging.StreamHandler(stream or sys.stderr)
+        stream_handler.setFormatter(JsonFormatter() if json_lines else logging.Formatter(TEXT_FORMAT))
+        stream_handler.addFilter(RateLimitFilter())
+        self.stream_handler = stream_handler
+        self.handler = DeferredQueueHandler(queue.SimpleQueue())
+        self.listener = None
+        logger.addHandler(self.handler)
+        logger.setLevel(level)
+        self.start()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def start(self):
+        self.listener = logging.handlers.QueueListener(self.handler.queue, self.stream_handler)
+        self.listener.start()
+
+    def stop(self):
+        '''Write out everything that has been queued and stop the listener thread'''
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def _after_fork(self):
+        # The listener thread isn't copied into the new process, and the queue's lock may have been held by it
+        if self.listener is not None:
+            self.handler.queue = queue.SimpleQueue()
+            self.start()
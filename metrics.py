@@ -0,0 +1,191 @@
+'''
+Counters and histograms for monitoring pophttp, served in the Prometheus text format.
+'''
+
+import logging
+import threading
+from bisect import bisect_left
+from urllib.parse import urlsplit
+
+
+log = logging.getLogger('pophttp')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _label_key(item):
+    return tuple(str(label) for label in item[0])
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def unregister(self, metric):
+        with self._lock:
+            self.metrics.remove(metric)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=(), function=None, registry=REGISTRY):
+        '''
+        `function` is optional and is called to read the value when the metrics are collected, for values that are
+        already tracked somewhere else
+        '''
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.function = function
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        if self.function is not None:
+            return [f'{self.name} {_format_value(self.function())}']
+        with self._lock:
+            values = sorted(self._values.items(), key=_label_key)
+        return [f'{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}' for labels, value in values]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels, registry=registry)
+
+    def observe(self, value, *labels):
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bucket] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def value(self, *labels):
+        '''Returns the number of observations'''
+        entry = self._values.get(labels)
+        return entry[2] if entry is not None else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted(((labels, (list(counts), total, count)) for labels, (counts, total, count) in self._values.items()), key=_label_key)
+        lines = []
+        for labels, (counts, total, count) in values:
+            cumulative = 0
+            for upper, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, labels, [("le", _format_value(upper))])} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, labels)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, labels)} {count}')
+        return lines
+
+
+def endpoint_label(url):
+    '''The scheme, host & port of a URL, to keep the number of label values for HTTP metrics small'''
+    parts = urlsplit(url)
+    return f'{parts.scheme}://{parts.netloc}'
+
+
+packets_received = Counter('pophttp_packets_received_total', 'Packets received from the pop bridges by LIFX message type', ('type',))
+decode_failures = Counter('pophttp_decode_failures_total', 'Packets that could not be decoded')
+ip_filtered = Counter('pophttp_ip_filtered_total', 'Packets dropped by the ip_filter')
+messages_suppressed = Counter('pophttp_messages_suppressed_total', 'Repeated switch actions ignored by the message handler', ('reason',))
+retransmits_filtered = Counter('pophttp_retransmits_filtered_total', 'Retransmitted messages acknowledged without being decoded', ('type',))
+reply_send_errors = Counter('pophttp_reply_send_errors_total', 'Replies to the pop bridges that could not be sent')
+receive_batch_size = Histogram('pophttp_receive_batch_size', 'Datagrams read from the socket each time it became readable', buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+triggers = Counter('pophttp_triggers_total', 'Switch presses that triggered an action')
+http_responses = Counter('pophttp_http_responses_total', 'HTTP responses by endpoint and status code, or error', ('endpoint', 'code'))
+http_latency = Histogram('pophttp_http_request_duration_seconds', 'Time taken for HTTP requests by endpoint', ('endpoint',))
+
+
+def observe_http(url, code, duration):
+    endpoint = endpoint_label(url)
+    http_responses.inc(endpoint, str(code))
+    http_latency.observe(duration, endpoint)
+
+
+def start_server(address, port, registry=REGISTRY):
+    '''Serve the metrics on a background thread'''
+    # http.server is only imported when the metrics are enabled, as it takes a while to import
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = self.server.registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug('metrics ' + format, *args, extra=dict(sender_ip=self.client_address[0]))
+
+    server = ThreadingHTTPServer((address, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
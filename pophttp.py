@@ -1,174 +1,720 @@
 #!/usr/bin/env python
 
+import atexit
+import os
+import signal
 import socket
-from time import time
-from collections import defaultdict
+import threading
+from time import perf_counter, sleep, time
+from collections import OrderedDict
 import sys
 import logging
 try:
     import lifx
-    from config import Config, ConfigError, format_template
+    from config import Config, ConfigError
+    from dispatch import Action, AsyncDispatcher, Dispatcher
+    from httppool import ConnectionPool, PoolTimeout
+    import httppool
+    from configwatch import ConfigReloader
+    from retry import RetryQueue
+    from dedup import LastTrigger, RetransmitFilter
+    from capture import CaptureWriter
+    from cluster import Cluster
+    from resolver import Resolver
+    from tracing import Profiler, Trace
+    import tracing
+    import backends
+    import logs
+    import metrics
+    import workers
 except ImportError:
     from . import lifx
-    from .config import Config, ConfigError, format_template
+    from .config import Config, ConfigError
+    from .dispatch import Action, AsyncDispatcher, Dispatcher
+    from .httppool import ConnectionPool, PoolTimeout
+    from . import httppool
+    from .configwatch import ConfigReloader
+    from .retry import RetryQueue
+    from .dedup import LastTrigger, RetransmitFilter
+    from .capture import CaptureWriter
+    from .cluster import Cluster
+    from .resolver import Resolver
+    from .tracing import Profiler, Trace
+    from . import tracing
+    from . import backends
+    from . import logs
+    from . import metrics
+    from . import workers
 import yaml
-from urllib.request import urlopen, HTTPError, Request
-from urllib.error import URLError
-from http.client import BadStatusLine
 from argparse import ArgumentParser
 
 
-log = logging.Logger('')
+log = logging.getLogger('pophttp')
+# asyncio & asynchttp are only imported when the asyncio engine is used, see import_asyncio_engine()
+asyncio = None
+asynchttp = None
+resolver = Resolver()
+http_pool = ConnectionPool(resolver=resolver)
+socket_backends = backends.SocketBackends()
+retry_queue = None
+capture = None
+trace_packets = False
 
 
-class MessageHandler:
-    class PopBridgeMessageState:
-        def __init__(self):
-            self.power_msg = None
-            self.color_msg = None
-            self.last_triggered = None # The Pop sends multiple of the same message over several seconds, this removes the duplicates
+class PopBridgeMessageState:
+    __slots__ = ('power', 'color', 'last_triggered', 'last_seen')
 
-        def reset(self):
-            self.power_msg = None
-            self.color_msg = None
-            self.last_triggered = None
+    def __init__(self):
+        self.power = None # Only the decoded payloads are kept, not the whole packets
+        self.color = None
+        self.last_triggered = None # The Pop sends multiple of the same message over several seconds, this removes the duplicates
+        self.last_seen = None
 
-    def __init__(self, config):
+    def reset(self):
+        self.power = None
+        self.color = None
+        self.last_triggered = None
+
+
+class BridgeStateTable:
+    '''
+    The message state for each bridge, keyed by sender, or by (sender, target) for presses sent to one of the lights
+    in the config. Bridges that haven't sent anything for `ttl` seconds are
+    removed, and the least recently seen bridges are evicted once there are more than `max_entries`, so packets from
+    lots of different senders can't use an unbounded amount of memory.
+    '''
+    def __init__(self, max_entries=1024, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        self._states = OrderedDict() # Least recently seen first
+
+    def __len__(self):
+        return len(self._states)
+
+    def __contains__(self, sender):
+        return sender in self._states
+
+    def get(self, sender, now):
+        state = self._states.get(sender)
+        if state is None:
+            state = self._states[sender] = PopBridgeMessageState()
+        else:
+            self._states.move_to_end(sender)
+        state.last_seen = now
+        self._expire(now)
+        return state
+
+    def _expire(self, now):
+        while self._states:
+            oldest = next(iter(self._states.values()))
+            if len(self._states) <= self.max_entries and now - oldest.last_seen < self.ttl:
+                break
+            self._states.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return dict(entries=len(self._states), evictions=self.evictions)
+
+
+class MessageHandler:
+    def __init__(self, config, dispatcher=None, trigger_dedup=None, bridge_states=None, clock=time, cluster=None):
+        '''
+        `trigger_dedup` tracks the last trigger across bridges, and is shared between processes with --workers.
+        `clock` is replaced when replaying a capture. `cluster` decides which node fires each press when pophttp is
+        running on several hosts
+        '''
         self.config = config
-        self.bridge_states = defaultdict(self.PopBridgeMessageState)
-        self.last_trigger = None
+        self.dispatcher = dispatcher
+        self.bridge_states = bridge_states if bridge_states is not None else BridgeStateTable()
+        self.trigger_dedup = trigger_dedup if trigger_dedup is not None else LastTrigger()
+        self.cluster = cluster
+        self.retransmits = RetransmitFilter()
+        self.clock = clock
+        self.trace = None # The Trace for the packet being handled, with --trace
+        self._lights = None
+
+    @property
+    def lights(self):
+        '''The VirtualLights for the current config, which are built again when the config is reloaded'''
+        lights = self._lights
+        if lights is None or lights.config is not self.config:
+            lights = self._lights = VirtualLights(self.config)
+        return lights
 
-    def handle_msg(self, sender_ip, packet):
-        bridge_state = self.bridge_states[sender_ip]
-        if bridge_state.last_triggered is not None and time() - bridge_state.last_triggered >= 5:
+    def handle_msg(self, sender_ip, packet, light=None):
+        '''`light` is the target of the light in the config the packet was sent to, or None for the default light'''
+        now = self.clock()
+        # Each light has its own state, so messages for one light don't reset a press on another
+        key = sender_ip if light is None else (sender_ip, light)
+        bridge_state = self.bridge_states.get(key, now)
+        if bridge_state.last_triggered is not None and now - bridge_state.last_triggered >= 5:
             bridge_state.reset()
 
         if packet.code == lifx.Message.Light_Get.code:
             bridge_state.reset()
+            self.retransmits.forget(key)
         elif packet.code == lifx.Message.Light_SetPower.code:
-            if bridge_state.power_msg is not None and packet != bridge_state.power_msg:
+            if bridge_state.power is not None and packet.payload != bridge_state.power:
                 bridge_state.reset()
-            bridge_state.power_msg = packet
+            bridge_state.power = packet.payload
         elif packet.code == lifx.Message.Light_SetColor.code:
-            if bridge_state.color_msg is not None and packet != bridge_state.color_msg:
+            if bridge_state.color is not None and packet.payload != bridge_state.color:
                 bridge_state.reset()
-            bridge_state.color_msg = packet
+            bridge_state.color = packet.payload
 
-        if bridge_state.power_msg is None or bridge_state.color_msg is None:
+        if bridge_state.power is None or bridge_state.color is None:
             #The Pop bridge sends a pair of messages: power & color. We need both to know the full state of what it is sending
             return
 
         if bridge_state.last_triggered is None:
-            bridge_state.last_triggered = time()
-        elif time() - bridge_state.last_triggered < 15:
+            bridge_state.last_triggered = now
+        elif now - bridge_state.last_triggered < 15:
+            metrics.messages_suppressed.inc('retransmit')
             return
 
-        this_trigger = (bridge_state.power_msg, bridge_state.color_msg)
-        if self.last_trigger is not None and self.last_trigger[1] == this_trigger and self.last_trigger[0] != sender_ip:
+        power_msg = lifx.Message.Light_SetPower(*bridge_state.power)
+        color_msg = lifx.Message.Light_SetColor(*bridge_state.color)
+        trigger = (power_msg, color_msg) if light is None else (power_msg, color_msg, light)
+        if not self.trigger_dedup.claim(sender_ip, trigger):
             #There are multiple Pop bridges and another bridge has already triggered this message
+            metrics.messages_suppressed.inc('other_bridge')
             return
+        if self.cluster is not None and not self.cluster.claim(sender_ip, trigger):
+            #Another node in the cluster has fired this press, or is the active node and will fire it
+            metrics.messages_suppressed.inc('cluster')
+            return
+
+        metrics.triggers.inc()
+        self.trigger_action(sender_ip, *trigger)
 
-        self.last_trigger = (sender_ip, this_trigger)
-        self.trigger_action(sender_ip, bridge_state.power_msg, bridge_state.color_msg)
+    def fire_unclaimed(self, sender_ip, trigger):
+        '''Trigger a press the cluster held back, once no other node has claimed it'''
+        metrics.triggers.inc()
+        self.trigger_action(sender_ip, *trigger)
 
-    def trigger_action(self, sender_ip, power_msg, color_msg):
+    def trigger_action(self, sender_ip, power_msg, color_msg, light=None):
         targets = self.config.get_target_for_switch(
             power = power_msg.level == lifx.DevicePower.ON,
             hue = color_msg.hue,
             saturation = color_msg.saturation,
             brightness = color_msg.brightness,
-            kelvin = color_msg.kelvin
+            kelvin = color_msg.kelvin,
+            light = light
         )
 
         if not targets:
-            log.warning('request %dh,%ds,%db,%dk,%s not mapped to a URL',
+            switch = '%dh,%ds,%db,%dk,%s' % (
                 color_msg.hue,
                 color_msg.saturation,
                 color_msg.brightness,
                 color_msg.kelvin,
                 'on' if power_msg.level == lifx.DevicePower.ON else 'off',
-                extra=dict(sender_ip=sender_ip)
             )
+            if light is None:
+                log.warning('request %s not mapped to a URL', switch, extra=dict(sender_ip=sender_ip, switch=switch))
+            else:
+                log.warning('request %s for light %s not mapped to a URL', switch, format_mac(light), extra=dict(sender_ip=sender_ip, switch=switch))
 
+        if self.trace is not None:
+            self.trace.mark('match')
         for target in targets:
-            endpoint = self.config.get_endpoint_for_url(target.url)
-            method = target.method
-            headers = target.headers
-            body = None
-            if endpoint is not None:
-                method = endpoint.method or method
-                headers = dict(endpoint.headers)
-                headers.update(target.headers)
-                body = format_template(
-                    target.body,
-                    power = power_msg.level == lifx.DevicePower.ON,
-                    hue = color_msg.hue,
-                    saturation = color_msg.saturation,
-                    brightness = color_msg.brightness,
-                    kelvin = color_msg.kelvin
-                )
-            try:
-                start = time()
-                req = Request(target.url, data=body.encode('utf-8'), headers=headers, method=method)
-                with urlopen(req) as resp:
-                    log.info('resp %d in %dms %s' % (resp.code, (time()-start)*1000, target.url), extra=dict(sender_ip=sender_ip))
-            except HTTPError as err:
-                log.error('resp %d in %dms %s' % (err.code, (time()-start)*1000, target.url), extra=dict(sender_ip=sender_ip))
-            except (BadStatusLine, URLError) as err: #BadStatusLine also includes RemoteDisconnected
-                log.error('%s in %dms %s' % (err, (time()-start)*1000, target.url), extra=dict(sender_ip=sender_ip))
-
-
-def server_loop(address, handler):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            # Actions for the same switch, light & target in the config can replace each other while they wait, so only the latest state is sent
+            coalesce_key = (target.endpoint, light and format_mac(light), color_msg.hue, color_msg.saturation, color_msg.brightness, color_msg.kelvin, target.source) if target.coalesce else None
+            action_trace = None
+            if self.trace is not None:
+                action_trace = self.trace.branch()
+                action_trace.mark('dispatch')
+            action = Action(sender_ip, target.url, target.method, target.body, target.headers, target.timeout, target.retry, trace=action_trace,
+                endpoint=target.endpoint, rate_limit=target.rate_limit, coalesce_key=coalesce_key)
+            if self.dispatcher is None:
+                execute_action(action)
+            else:
+                self.dispatcher.submit(action)
+
+
+def action_completed(action, code):
+    '''Pass the result of an attempt to the retry queue, where `code` is the HTTP status or None if the request failed'''
+    if action.trace is not None:
+        action.trace.mark('response')
+        tracing.log_press(action.trace, action.sender_ip, action.url)
+    if action.retry is not None and retry_queue is not None:
+        retry_queue.completed(action, code is None or code in action.retry.statuses)
+
+
+def _action_log_fields(action, code, elapsed):
+    return dict(sender_ip=action.sender_ip, url=action.url, endpoint=action.endpoint, code=code, latency_ms=round(elapsed*1000, 1))
+
+
+def send_to_socket(action):
+    '''Send the action to a udp, tcp or unix target. Returns 'sent', or None if it failed'''
+    start = perf_counter()
+    try:
+        reused = socket_backends.send(action.url, action.body, action.timeout)
+    except (OSError, ValueError) as err:
+        elapsed = perf_counter()-start
+        metrics.observe_http(action.url, 'error', elapsed)
+        log.error('%s in %.2fms %s', err, elapsed*1000, action.url, extra=_action_log_fields(action, 'error', elapsed))
+        return None
+    elapsed = perf_counter()-start
+    metrics.observe_http(action.url, 'sent', elapsed)
+    log.info('sent in %.2fms (%s connection) %s', elapsed*1000, 'reused' if reused else 'new', action.url, extra=_action_log_fields(action, 'sent', elapsed))
+    return 'sent'
+
+
+def execute_action(action):
+    if backends.is_socket_url(action.url):
+        action_completed(action, send_to_socket(action))
+        return
+    start = time()
+    code = None
+    try:
+        data = action.body.encode('utf-8') if action.body is not None else None
+        resp = http_pool.request(action.method, action.url, body=data, headers=action.headers, timeout=action.timeout)
+    except (httppool.HTTPException, OSError, PoolTimeout, ValueError) as err: #OSError includes timeouts and connection errors
+        elapsed = time()-start
+        metrics.observe_http(action.url, 'error', elapsed)
+        log.error('%s in %dms %s', err, elapsed*1000, action.url, extra=_action_log_fields(action, 'error', elapsed))
+    else:
+        code = resp.code
+        elapsed = time()-start
+        metrics.observe_http(action.url, resp.code, elapsed)
+        log.log(logging.ERROR if resp.code >= 400 else logging.INFO, 'resp %d in %dms (%s connection) %s',
+            resp.code, elapsed*1000, 'reused' if resp.reused else 'new', action.url, extra=_action_log_fields(action, resp.code, elapsed))
+    action_completed(action, code)
+
+
+async def execute_action_async(action):
+    if backends.is_socket_url(action.url):
+        # Connecting can block, so the send is done on the default executor rather than the event loop
+        code = await asyncio.get_running_loop().run_in_executor(None, send_to_socket, action)
+        action_completed(action, code)
+        return
+    start = time()
+    code = None
+    try:
+        data = action.body.encode('utf-8') if action.body is not None else None
+        resp = await asynchttp.request(action.method, action.url, body=data, headers=action.headers, timeout=action.timeout, resolver=resolver)
+    except asyncio.TimeoutError:
+        elapsed = time()-start
+        metrics.observe_http(action.url, 'error', elapsed)
+        log.error('timed out in %dms %s', elapsed*1000, action.url, extra=_action_log_fields(action, 'error', elapsed))
+    except (asynchttp.HTTPClientError, OSError, asyncio.IncompleteReadError) as err:
+        elapsed = time()-start
+        metrics.observe_http(action.url, 'error', elapsed)
+        log.error('%s in %dms %s', err, elapsed*1000, action.url, extra=_action_log_fields(action, 'error', elapsed))
+    else:
+        code = resp.code
+        elapsed = time()-start
+        metrics.observe_http(action.url, resp.code, elapsed)
+        log.log(logging.ERROR if resp.code >= 400 else logging.INFO, 'resp %d in %dms %s',
+            resp.code, elapsed*1000, action.url, extra=_action_log_fields(action, resp.code, elapsed))
+    action_completed(action, code)
+
+
+def format_mac(target):
+    '''The MAC address of a light from its target, as it's written in the config'''
+    return ':'.join('%02x' % byte for byte in target[:6])
+
+
+def light_state(label):
+    return lifx.Message.Light_State(hue=0, saturation=655, brightness=65535, kelvin=2500, dim=0, power=65535, label=label, tags=0)
+
+
+# The replies the bridge expects for each type of message it sends
+REPLIES = {
+    lifx.Message.Device_GetVersion.code: lifx.ReplyTemplate(lifx.Message.Device_StateVersion(vendor=1, product=36, version=0)),
+    lifx.Message.Light_Get.code: lifx.ReplyTemplate(light_state('Pop HTTP')),
+    lifx.Message.Light_SetPower.code: lifx.ReplyTemplate(lifx.Message.Device_Acknowledgment()),
+    lifx.Message.Light_SetColor.code: lifx.ReplyTemplate(lifx.Message.Device_Acknowledgment()),
+}
+
+
+# Messages every bridge sends every few seconds, which are only logged occasionally
+POLLING = (lifx.Message.Light_Get.code, lifx.Message.Device_GetVersion.code)
+
+# Messages the bridge resends many times, which can be recognised without decoding them
+RETRANSMITTED = dict((m.code, m) for m in (lifx.Message.Light_SetPower, lifx.Message.Light_SetColor))
+
+# Messages the bridge broadcasts to find the lights, which every light answers
+DISCOVERY = (lifx.Message.Light_Get.code, lifx.Message.Device_GetVersion.code)
+
+
+class VirtualLight:
+    '''A light from the config, with its replies built ahead of time'''
+    __slots__ = ('target', 'label', 'replies')
+
+    def __init__(self, light):
+        self.target = light.target
+        self.label = light.label
+        self.replies = dict(REPLIES)
+        self.replies[lifx.Message.Light_Get.code] = lifx.ReplyTemplate(light_state(light.label))
+
+
+class VirtualLights:
+    '''
+    The lights in a config, keyed by target so each packet is routed to its light with a dict lookup. `default` is
+    whether the original single light answers packets that aren't for any of them, for the top level switches
+    '''
+    def __init__(self, config):
+        self.config = config
+        self.by_target = dict((target, VirtualLight(light)) for target, light in config.lights.items())
+        self.default = config.default_light
+
+
+def process_datagram(handler, data, address, send):
+    '''Decode a single datagram, send any reply the bridge expects with `send(data, address)` and pass it to the handler'''
+    trace = Trace() if trace_packets else None
+    sender_ip = address[0]
+    if sender_ip.startswith('::ffff:'):
+        # An IPv4 bridge sending to a dual stack socket
+        sender_ip = sender_ip[7:]
+    if not handler.config.is_ip_allowed(sender_ip):
+        metrics.ip_filtered.inc()
+        log.debug('recv filtering packet %r', bytes(data), extra=dict(sender_ip=sender_ip, sender_port=address[1], rate_key='ip_filter'))
+        return
+    if trace is not None:
+        trace.mark('ip_filter')
+    if capture is not None:
+        capture.write(address, data)
+
+    code = int.from_bytes(data[lifx.CODE_SLICE], 'little')
+    lights = handler.lights
+    light = lights.by_target.get(bytes(data[lifx.TARGET_SLICE])) if lights.by_target else None
+    broadcast = data[lifx.TARGET_SLICE] == lifx.BROADCAST_TARGET
+    if light is None and not lights.default and not broadcast:
+        log.debug('recv packet for unknown light %s', bytes(data[lifx.TARGET_SLICE]).hex(), extra=dict(sender_ip=sender_ip, sender_port=address[1], rate_key='unknown light'))
+        return
+    replies = REPLIES if light is None else light.replies
+
+    pkt_def = RETRANSMITTED.get(code)
+    if pkt_def is not None and (light is not None or lights.default) and len(data) == pkt_def.length and handler.retransmits.is_retransmit(
+            sender_ip if light is None else (sender_ip, light.target), code, bytes(data[lifx.HEADER_LENGTH:]), handler.clock()):
+        metrics.packets_received.inc(pkt_def.name)
+        metrics.retransmits_filtered.inc(pkt_def.name)
+        log.debug('recv retransmitted %s', pkt_def.name, extra=dict(sender_ip=sender_ip, sender_port=address[1], rate_key='retransmitted ' + pkt_def.name))
+        send(replies[code].encode(bytes(data[lifx.TARGET_SLICE]), bytes(data[lifx.SITE_SLICE])), address)
+        if trace is not None:
+            trace.mark('ack')
+            tracing.log_packet(trace, sender_ip, pkt_def.name)
+        return
+    try:
+        packet = lifx.Message.decode(data)
+    except Exception as exc:
+        metrics.decode_failures.inc()
+        log.debug('recv unable to decode packet %r: %r', bytes(data), exc, extra=dict(sender_ip=sender_ip, sender_port=address[1]))
+        return
+
+    if packet is None:
+        metrics.packets_received.inc('unknown')
+        log.debug('recv Unknown packet type %r', bytes(data), extra=dict(sender_ip=sender_ip, sender_port=address[1]))
+        return
+    metrics.packets_received.inc(packet.pkt_def.name)
+    if trace is not None:
+        trace.mark('decode')
+
+    rate_key = packet.pkt_def.name if packet.code in POLLING else None
+    log.debug('recv %r (%r)', packet, packet.header, extra=dict(sender_ip=sender_ip, sender_port=address[1], rate_key=rate_key))
+
+    reply = replies.get(packet.code) if light is not None or lights.default else None
+    if reply is not None:
+        log.debug('send %s', reply.packet, extra=dict(sender_ip=sender_ip, sender_port=address[1], rate_key=rate_key and 'reply ' + rate_key))
+        send(reply.encode(packet.header.target, packet.header.site), address)
+        if trace is not None:
+            trace.mark('ack')
+    if broadcast and packet.code in DISCOVERY:
+        for each in lights.by_target.values():
+            send(each.replies[packet.code].encode(each.target, packet.header.site), address)
+
+    if light is None and not lights.default:
+        return # A broadcast, which only the lights have answered
+    handler.trace = trace
+    handler.handle_msg(sender_ip, packet, light.target if light is not None else None)
+    if trace is not None:
+        trace.mark('handle')
+        tracing.log_packet(trace, sender_ip, packet.pkt_def.name)
+
+
+def bind_socket(address):
+    sock = workers.udp_socket(address)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock.bind((address, 56700))
-    print('Server started on on %s' % address)
-    while True:
-        data, address = sock.recvfrom(4096)
-        if not config.is_ip_allowed(address[0]):
-            log.debug('recv filtering packet %r', data, extra=dict(sender_ip=address[0], sender_port=address[1]))
+    return sock
+
+
+# The options for setting the socket buffers beyond the net.core limits, which aren't in Python's socket module
+SO_SNDBUFFORCE = 32
+SO_RCVBUFFORCE = 33
+
+
+def configure_socket(sock, socket_config):
+    '''Set the socket's buffer sizes from the config, warning if the kernel limits them to less'''
+    linux = sys.platform.startswith('linux')
+    for name, option, force_option, size in (
+        ('receive', socket.SO_RCVBUF, SO_RCVBUFFORCE if linux else None, socket_config.receive_buffer),
+        ('send', socket.SO_SNDBUF, SO_SNDBUFFORCE if linux else None, socket_config.send_buffer),
+    ):
+        if size is None:
             continue
         try:
-            packet = lifx.Message.decode(data)
-        except Exception as exc:
-            log.debug('recv unable to decode packet %r: %r', data, exc, extra=dict(sender_ip=address[0], sender_port=address[1]))
-            continue
+            # The FORCE options can go past the net.core limits on Linux, when running with CAP_NET_ADMIN
+            if force_option is None:
+                raise OSError()
+            sock.setsockopt(socket.SOL_SOCKET, force_option, size)
+        except OSError: # PermissionError without CAP_NET_ADMIN
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+        actual = sock.getsockopt(socket.SOL_SOCKET, option)
+        # Linux reports double the size that was set, to allow for its own bookkeeping
+        if linux:
+            actual //= 2
+        if actual < size:
+            log.warning('socket %s buffer is %d bytes rather than %d, as it is limited by the OS (net.core.%smem_max on Linux)',
+                name, actual, size, 'r' if name == 'receive' else 'w', extra=dict(sender_ip='-'))
 
-        if packet is None:
-            log.debug('recv Unknown packet type %r', data, extra=dict(sender_ip=address[0], sender_port=address[1]))
-            continue
 
-        log.debug('recv %r (%r)', packet, packet.header, extra=dict(sender_ip=address[0], sender_port=address[1]))
+def socket_drops(sock):
+    '''
+    The number of datagrams the kernel dropped for the socket because its receive buffer was full, or None where the
+    OS doesn't make it available
+    '''
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+        for table in ('/proc/net/udp', '/proc/net/udp6'):
+            with open(table) as udp_sockets:
+                next(udp_sockets)
+                for line in udp_sockets:
+                    fields = line.split()
+                    if fields[9] == inode:
+                        return int(fields[12])
+    except (OSError, IndexError, ValueError, StopIteration):
+        pass
+    return None
 
-        resp = None
-        if packet.code == lifx.Message.Device_GetVersion.code:
-            resp = lifx.Message.Device_StateVersion(vendor=1, product=36, version=0)
-        elif packet.code == lifx.Message.Light_Get.code:
-            resp = lifx.Message.Light_State(hue=0, saturation=655, brightness=65535, kelvin=2500, dim=0, power=65535, label='Pop HTTP', tags=0)
-        elif packet.code in (lifx.Message.Light_SetPower.code, lifx.Message.Light_SetColor.code):
-            resp = lifx.Message.Device_Acknowledgment()
 
-        if resp is not None:
-            log.debug('send %s', str(resp), extra=dict(sender_ip=address[0], sender_port=address[1]))
-            sock.sendto(resp.encode(packet.header.target, packet.header.site), address)
+def server_loop(address, handler, sock=None, batch_size=1):
+    '''
+    Receive on `sock` if it is given, otherwise bind a new socket.
+    When a datagram arrives, up to `batch_size` datagrams that are already waiting are read without blocking into
+    buffers that are reused for every batch. The replies are sent once the whole batch has been handled.
+    '''
+    if sock is None:
+        sock = bind_socket(address)
+        print('Server started on on %s' % address)
+    if not hasattr(socket, 'MSG_DONTWAIT'):
+        batch_size = 1
+    buffers = [memoryview(bytearray(4096)) for _ in range(batch_size)]
+    replies = []
+    def queue_reply(data, address):
+        replies.append((data, address))
 
-        handler.handle_msg(address[0], packet)
+    while True:
+        nbytes, address = sock.recvfrom_into(buffers[0])
+        received = [(buffers[0][:nbytes], address)]
+        for buffer in buffers[1:]:
+            try:
+                nbytes, address = sock.recvfrom_into(buffer, 0, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            received.append((buffer[:nbytes], address))
+        metrics.receive_batch_size.observe(len(received))
+
+        for data, address in received:
+            process_datagram(handler, data, address, queue_reply)
+        for data, address in replies:
+            try:
+                sock.sendto(data, address)
+            except OSError as err:
+                metrics.reply_send_errors.inc()
+                log.debug('send failed: %s', err, extra=dict(sender_ip=address[0], sender_port=address[1]))
+        replies.clear()
+
+
+def import_asyncio_engine():
+    '''
+    Import the modules for the asyncio engine. They pull in ssl, which is slow to import, so the thread engine doesn't
+    load them at all
+    '''
+    global asyncio, asynchttp
+    import asyncio
+    try:
+        import asynchttp
+    except ImportError:
+        from . import asynchttp
+
+
+async def async_server_loop(address, handler, sock=None):
+    class ServerProtocol(asyncio.DatagramProtocol):
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, data, address):
+            process_datagram(handler, data, address, self.transport.sendto)
+
+        def error_received(self, exc):
+            log.warning('socket error %s', exc, extra=dict(sender_ip='-'))
+
+    loop = asyncio.get_running_loop()
+    if retry_queue is not None:
+        retry_queue.start(lambda action: loop.call_soon_threadsafe(handler.dispatcher.submit, action))
+    if handler.cluster is not None:
+        handler.cluster.start(lambda sender_ip, trigger: loop.call_soon_threadsafe(handler.fire_unclaimed, sender_ip, trigger))
+    announce = sock is None
+    if sock is None:
+        sock = bind_socket(address)
+    transport, _ = await loop.create_datagram_endpoint(ServerProtocol, sock=sock)
+    if announce:
+        print('Server started on on %s' % address)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        transport.close()
+
+
+def prepare_webhook_hosts(config, prewarm=True):
+    '''
+    Resolve the hosts in the config ahead of any presses, and open a connection to each of them if the config asks
+    for it. This waits on the network, so is run on a background thread
+    '''
+    hosts = config.webhook_hosts()
+    resolver.ttl = config.dispatch.dns_ttl
+    resolver.prefetch([(host, port) for _, host, port in hosts])
+    if prewarm and config.dispatch.prewarm:
+        prewarm_connections(config)
+
+
+def prewarm_connections(config, margin=0):
+    '''Open a connection to each host in the config, replacing any that will be closed as idle within `margin` seconds'''
+    for scheme, host, port in config.webhook_hosts():
+        try:
+            http_pool.prewarm(f'{scheme}://{host}:{port}/', config.dispatch.timeout, margin)
+        except (httppool.HTTPException, OSError, PoolTimeout) as err:
+            log.warning('unable to open a connection to %s://%s:%d: %s', scheme, host, port, err, extra=dict(sender_ip='-'))
+
+
+def keep_connections_warm():
+    '''
+    With prewarm, replace the open connections on a background thread before their idle_timeout closes them, so a
+    press long after the config was loaded doesn't wait for a handshake either
+    '''
+    while True:
+        config = http_pool.config
+        idle_timeouts = [config.dispatch.idle_timeout] + [e.idle_timeout for _, e in config.endpoints if e.idle_timeout]
+        interval = max(min(idle_timeouts) / 2, 1)
+        sleep(interval)
+        if http_pool.config.dispatch.prewarm:
+            prewarm_connections(http_pool.config, interval)
+
+
+def close_files():
+    '''Finish writing the retry spool & capture file when the server stops'''
+    if retry_queue is not None:
+        retry_queue.close()
+    if capture is not None:
+        capture.close()
+
+
+def run_server(args, config, sock=None, trigger_dedup=None, worker=None):
+    '''
+    Run the server until it is stopped. With --workers this runs in each worker process, where `worker` is the
+    worker's number and `sock` is its socket
+    '''
+    global retry_queue, capture, trace_packets
+
+    if args.profile is not None:
+        profiler = Profiler(args.profile if worker is None else f'{args.profile}.{worker}')
+        profiler.start()
+        if hasattr(signal, 'SIGUSR1'):
+            profiler.install_signal_handler(signal.SIGUSR1)
+    trace_packets = args.trace
+
+    if args.engine == 'asyncio':
+        import_asyncio_engine()
+        dispatcher = AsyncDispatcher(execute_action_async, config.dispatch.queue_size, config.dispatch.overflow)
+    else:
+        http_pool.config = config
+        dispatcher = Dispatcher(execute_action, config.dispatch.workers, config.dispatch.queue_size, config.dispatch.overflow)
+    cluster = Cluster(config.cluster) if config.cluster is not None else None
+    handler = MessageHandler(config, dispatcher, trigger_dedup, cluster=cluster)
+    if cluster is not None:
+        metrics.Gauge('pophttp_cluster_active', 'Whether this node is the active node in the cluster', function=lambda: int(cluster.active))
+        metrics.Counter('pophttp_cluster_deferred_fired_total', 'Presses fired by this node after no other node claimed them', function=lambda: cluster.deferred_fired)
+    metrics.Gauge('pophttp_bridge_states', 'Bridges with message state being tracked', function=lambda: len(handler.bridge_states))
+    metrics.Counter('pophttp_bridge_state_evictions_total', 'Bridge states removed after their TTL or to stay under the limit', function=lambda: handler.bridge_states.evictions)
+
+    for stat in ('depth', 'max_depth', 'busy'):
+        metrics.Gauge(f'pophttp_dispatch_{stat}', f'Dispatch queue {stat.replace("_", " ")}', function=lambda stat=stat: dispatcher.stats()[stat])
+    for stat in ('submitted', 'completed', 'dropped', 'rejected', 'coalesced'):
+        metrics.Counter(f'pophttp_dispatch_{stat}_total', f'Actions {stat} by the dispatch queue', function=lambda stat=stat: dispatcher.stats()[stat])
+
+    # Each worker keeps its own retry spool & capture file and serves its own metrics on the next port up
+    retry_spool = config.dispatch.retry_spool
+    if retry_spool is not None and worker is not None:
+        retry_spool = f'{retry_spool}.{worker}'
+    if args.capture is not None:
+        capture = CaptureWriter(args.capture if worker is None else f'{args.capture}.{worker}')
+    retry_queue = RetryQueue(retry_spool)
+    metrics.Gauge('pophttp_retries_pending', 'Failed actions waiting to be retried', function=lambda: retry_queue.pending)
+
+    if sock is not None and socket_drops(sock) is not None:
+        metrics.Counter('pophttp_socket_drops_total', 'Datagrams dropped by the kernel because the socket receive buffer was full', function=lambda: socket_drops(sock) or 0)
+
+    if config.metrics is not None:
+        metrics.start_server(config.metrics.address, config.metrics.port + (worker or 0))
+
+    # The asyncio engine doesn't keep connections open, so only resolving is done ahead of time for it
+    prewarm = args.engine != 'asyncio'
+    threading.Thread(target=prepare_webhook_hosts, args=(config, prewarm), name='prepare-hosts', daemon=True).start()
+    resolver.start()
+
+    def apply_config(new_config):
+        handler.config = new_config
+        http_pool.config = new_config
+        prepare_webhook_hosts(new_config, prewarm)
+
+    reloader = ConfigReloader(args.config, apply_config, config, args.config_snapshot)
+    if hasattr(signal, 'SIGHUP'):
+        reloader.install_signal_handler()
+    if args.watch_config:
+        reloader.watch(args.watch_config)
+
+    # Stopping with SIGTERM unwinds the server loop like Ctrl+C, so the files are closed below. That is done here
+    # rather than with atexit, which isn't run in the --workers processes
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if args.engine == 'asyncio':
+            asyncio.run(async_server_loop(config.interface, handler, sock))
+        else:
+            retry_queue.start(dispatcher.submit)
+            if cluster is not None:
+                cluster.start(handler.fire_unclaimed)
+            # Answer the bridges straight away, while the HTTP stack is imported in the background for the first press
+            threading.Thread(target=httppool.preload, name='preload', daemon=True).start()
+            threading.Thread(target=keep_connections_warm, name='keep-warm', daemon=True).start()
+            server_loop(config.interface, handler, sock, config.socket.batch_size)
+    finally:
+        close_files()
 
 
 if __name__ == '__main__':
     parser = ArgumentParser(description='Make a fake LIFX light to allow the Logitech pop to send web requests')
     parser.add_argument('-v', dest='verbosity', action='count', default=0, help='increase verbosity level')
     parser.add_argument('--config', dest='config', metavar='FILE', default='config.yml', help='path to the configuration YAML file to use')
+    parser.add_argument('--config-snapshot', dest='config_snapshot', metavar='FILE', help='save the parsed config to FILE and load it from there on the next start, unless the config file has changed')
+    parser.add_argument('--watch-config', dest='watch_config', metavar='SECONDS', type=float, nargs='?', const=2.0, default=None, help='reload the config file when it changes, checking every SECONDS (default 2). The config is also reloaded on SIGHUP')
+    parser.add_argument('--engine', dest='engine', choices=('thread', 'asyncio'), default='thread', help='run the server with a blocking socket and worker threads, or on a single asyncio event loop')
+    parser.add_argument('--capture', dest='capture', metavar='FILE', help='record every accepted datagram to FILE, for replaying with capture.py')
+    parser.add_argument('--log-format', dest='log_format', choices=('text', 'json'), default='text', help='write the log as text, or as JSON lines with the sender, switch, URL, endpoint, status code and latency as separate fields')
+    parser.add_argument('--trace', dest='trace', action='store_true', help='time each stage of handling packets and presses. Logs a summary of each press and adds pophttp_trace_stage_seconds to the metrics, with more detail at -vvv')
+    parser.add_argument('--profile', dest='profile', metavar='FILE', help='run under cProfile and write the stats to FILE on SIGUSR1')
+    parser.add_argument('--workers', dest='workers', metavar='N', type=int, default=1, help='run N server processes sharing the UDP port (Linux only). Default 1')
     args = parser.parse_args()
 
-    ch = logging.StreamHandler()
-    ch.setLevel([logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbosity, 3)])
-    formatter = logging.Formatter('%(asctime)-15s %(sender_ip)s %(message)s')
-    ch.setFormatter(formatter)
-    log.addHandler(ch)
+    log_level = [logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbosity, 3)]
+    log_output = logs.QueueLogging(log, log_level, json_lines=args.log_format == 'json')
+    atexit.register(log_output.stop)
 
     try:
-        config = Config(args.config)
+        config = Config.load(args.config, args.config_snapshot)
     except ConfigError as err:
         print(str(err))
         sys.exit(-2)
@@ -176,4 +722,18 @@ if __name__ == '__main__':
         print(str(err))
         sys.exit(-1)
 
-    server_loop(config.interface, MessageHandler(config))
+    if args.workers > 1 and config.cluster is not None:
+        print('A cluster node can only be run with 1 worker')
+        sys.exit(-2)
+    if args.workers > 1:
+        socks = workers.bind_reuseport_sockets(config.interface, 56700, args.workers)
+        for sock in socks:
+            configure_socket(sock, config.socket)
+        print('Server started on on %s with %d workers' % (config.interface, args.workers))
+        workers.run_workers(socks, lambda worker, sock, trigger_dedup: run_server(args, config, sock, trigger_dedup, worker))
+    else:
+        # Bind before setting up everything else, so packets from the bridges are queued rather than refused
+        sock = bind_socket(config.interface)
+        configure_socket(sock, config.socket)
+        print('Server started on on %s' % config.interface)
+        run_server(args, config, sock)
@@ -0,0 +1,111 @@
+'''
+A cache of the addresses for the webhook hosts, so a switch press doesn't have to wait for the system resolver, which
+can be slow for mDNS `.local` names. The hosts in the config are resolved when it is loaded, and entries are refreshed
+in the background before they expire. If a refresh fails the previous addresses keep being used.
+'''
+
+import logging
+import socket
+import threading
+from time import monotonic, sleep
+
+
+log = logging.getLogger('pophttp')
+
+DEFAULT_TTL = 300
+
+
+class Resolver:
+    def __init__(self, ttl=DEFAULT_TTL, clock=monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self._cache = {} # (host, port) -> (addresses, time they expire)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _getaddrinfo(self, host, port):
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        addresses = []
+        for _, _, _, _, sockaddr in infos:
+            if sockaddr[0] not in addresses:
+                addresses.append(sockaddr[0])
+        return addresses
+
+    def _refresh(self, host, port):
+        '''Resolve the host now and cache the result. Returns the addresses, or raises OSError if it can't be resolved'''
+        try:
+            addresses = self._getaddrinfo(host, port)
+        finally:
+            with self._lock:
+                self._refreshing.discard((host, port))
+        with self._lock:
+            self._cache[(host, port)] = (addresses, self.clock() + self.ttl)
+        return addresses
+
+    def _refresh_in_background(self, host, port):
+        with self._lock:
+            if (host, port) in self._refreshing:
+                return
+            self._refreshing.add((host, port))
+
+        def refresh():
+            try:
+                self._refresh(host, port)
+            except OSError as err:
+                log.warning('unable to resolve %s, still using the previous addresses: %s', host, err, extra=dict(sender_ip='-'))
+        threading.Thread(target=refresh, name='resolver', daemon=True).start()
+
+    def lookup(self, host, port):
+        '''
+        The cached addresses for the host without waiting, or None if it hasn't been resolved yet. Expired and
+        missing entries are resolved in the background
+        '''
+        entry = self._cache.get((host, port))
+        if entry is None or self.clock() >= entry[1]:
+            self._refresh_in_background(host, port)
+        return entry[0] if entry is not None else None
+
+    def resolve(self, host, port):
+        '''The addresses for the host, only waiting for the resolver if it has never been resolved'''
+        entry = self._cache.get((host, port))
+        if entry is None:
+            return self._refresh(host, port)
+        if self.clock() >= entry[1]:
+            self._refresh_in_background(host, port)
+        return entry[0]
+
+    def create_connection(self, host, port, timeout=None, source_address=None):
+        '''socket.create_connection, trying each of the cached addresses for the host in turn'''
+        error = None
+        for address in self.resolve(host, port):
+            try:
+                return socket.create_connection((address, port), timeout, source_address)
+            except OSError as err:
+                error = err
+        raise error if error is not None else OSError(f'no addresses found for {host}')
+
+    def prefetch(self, hosts):
+        '''Resolve each of the (host, port) pairs and keep them refreshed until the next call to prefetch'''
+        with self._lock:
+            for key in list(self._cache):
+                if key not in hosts:
+                    del self._cache[key]
+        for host, port in hosts:
+            try:
+                self._refresh(host, port)
+            except OSError as err:
+                log.warning('unable to resolve %s: %s', host, err, extra=dict(sender_ip='-'))
+
+    def start(self):
+        '''Refresh the cached entries on a background thread shortly before they expire'''
+        def refresh_loop():
+            while True:
+                sleep(max(self.ttl / 10, 1))
+                soon = self.clock() + self.ttl / 10
+                for (host, port), (_, expires) in list(self._cache.items()):
+                    if expires <= soon:
+                        try:
+                            self._refresh(host, port)
+                        except OSError as err:
+                            log.warning('unable to resolve %s, still using the previous addresses: %s', host, err, extra=dict(sender_ip='-'))
+        threading.Thread(target=refresh_loop, name='resolver-refresh', daemon=True).start()
@@ -0,0 +1,224 @@
+'''
+Retries for actions that failed with a connection error or a retryable HTTP status, with exponential backoff.
+Pending retries can be kept in an append-only spool file so they survive pophttp being restarted.
+'''
+
+import heapq
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import uuid
+from time import time
+try:
+    from config import RateLimit, RetryPolicy
+    from dispatch import Action
+    import metrics
+except ImportError:
+    from .config import RateLimit, RetryPolicy
+    from .dispatch import Action
+    from . import metrics
+
+
+log = logging.getLogger('pophttp')
+
+retries_scheduled = metrics.Counter('pophttp_retries_scheduled_total', 'Failed actions scheduled to be retried')
+retries_abandoned = metrics.Counter('pophttp_retries_abandoned_total', 'Failed actions that ran out of retry attempts')
+
+
+def backoff_delay(policy, attempt, rand=random.random):
+    '''The delay before retry number `attempt` (starting from 1), doubling each time up to max_backoff'''
+    delay = min(policy.max_backoff, policy.backoff * (2 ** (attempt - 1)))
+    return delay * (1 + policy.jitter * (2 * rand() - 1))
+
+
+def _action_to_json(action):
+    record = action._asdict()
+    del record['trace']
+    if action.retry is not None:
+        record['retry'] = action.retry._asdict()
+    if action.rate_limit is not None:
+        record['rate_limit'] = action.rate_limit._asdict()
+    return record
+
+
+def _action_from_json(record):
+    if record.get('retry') is not None:
+        record['retry'] = RetryPolicy(**dict(record['retry'], statuses=tuple(record['retry']['statuses'])))
+    if record.get('rate_limit') is not None:
+        record['rate_limit'] = RateLimit(**record['rate_limit'])
+    if record.get('coalesce_key') is not None:
+        record['coalesce_key'] = tuple(record['coalesce_key'])
+    return Action(**record)
+
+
+class Spool:
+    '''
+    An append-only file with one JSON record per line. An `add` record holds an action waiting to be retried, and a
+    later `add` with the same id replaces it. A `done` record removes it. The file is compacted when it is loaded.
+    Records are written & synced on a background thread, since `add` and `done` are called after each attempt, which
+    is on the event loop with the asyncio engine.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._file = None
+        self._lines = queue.Queue()
+        self._writer = None
+
+    def load(self):
+        '''Returns a list of (due time, action) for every pending action, and compacts the file'''
+        pending = {}
+        try:
+            with open(self.filename, 'r') as spool_file:
+                for line_no, line in enumerate(spool_file, 1):
+                    try:
+                        record = json.loads(line)
+                        if record['op'] == 'add':
+                            pending[record['id']] = (record['due'], _action_from_json(record['action']))
+                        elif record['op'] == 'done':
+                            pending.pop(record['id'], None)
+                    except (ValueError, KeyError, TypeError) as err:
+                        # Most likely the last line was only partly written when pophttp was stopped
+                        log.warning('retry spool %s line %d is corrupt, skipping: %s', self.filename, line_no, err, extra=dict(sender_ip='-'))
+        except FileNotFoundError:
+            pass
+
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as tmp_file:
+            for retry_id, (due, action) in pending.items():
+                tmp_file.write(self._format('add', retry_id, due, action))
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_filename, self.filename)
+        self._file = open(self.filename, 'a')
+        self._writer = threading.Thread(target=self._write_lines, name='retry-spool', daemon=True)
+        self._writer.start()
+        return list(pending.values())
+
+    def _format(self, op, retry_id, due=None, action=None):
+        record = dict(op=op, id=retry_id)
+        if op == 'add':
+            record.update(due=due, action=_action_to_json(action))
+        return json.dumps(record) + '\n'
+
+    def _write(self, line):
+        self._lines.put(line)
+
+    def _write_lines(self):
+        '''Write the queued records, syncing once for all of the records that are waiting. A None stops the thread'''
+        stopping = False
+        while not stopping:
+            lines = [self._lines.get()]
+            while True:
+                try:
+                    lines.append(self._lines.get_nowait())
+                except queue.Empty:
+                    break
+            if None in lines:
+                stopping = True
+                lines = lines[:lines.index(None)]
+            if not lines:
+                continue
+            with self._lock:
+                try:
+                    self._file.writelines(lines)
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                except OSError as err:
+                    log.error('unable to write retry spool %s: %s', self.filename, err, extra=dict(sender_ip='-'))
+
+    def add(self, due, action):
+        self._write(self._format('add', action.retry_id, due, action))
+
+    def done(self, retry_id):
+        self._write(self._format('done', retry_id))
+
+    def close(self):
+        '''Finish writing the queued records and close the file'''
+        if self._writer is not None:
+            self._lines.put(None)
+            self._writer.join()
+            self._writer = None
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class RetryQueue:
+    '''
+    Holds failed actions until their backoff delay has passed, then hands them back to the dispatcher with
+    `submit`. Runs on its own thread so retries never hold up the UDP receive loop.
+    '''
+    def __init__(self, spool_filename=None):
+        self.spool = Spool(spool_filename) if spool_filename is not None else None
+        self.submit = None
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    @property
+    def pending(self):
+        return len(self._heap)
+
+    def start(self, submit):
+        '''Start submitting due retries with `submit(action)`, including any left in the spool from a previous run'''
+        self.submit = submit
+        if self.spool is not None:
+            restored = self.spool.load()
+            for due, action in restored:
+                self._push(due, action)
+            if restored:
+                log.info('restored %d pending retries from %s', len(restored), self.spool.filename, extra=dict(sender_ip='-'))
+        self._thread = threading.Thread(target=self._run, name='retry', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        '''Finish writing the spool, so the pending retries are there when pophttp is started again'''
+        if self.spool is not None:
+            self.spool.close()
+
+    def completed(self, action, failed):
+        '''
+        Called after each attempt of an action that has a retry policy. Failed actions are scheduled for another
+        attempt until the policy's max_attempts is reached
+        '''
+        if not failed:
+            if action.retry_id is not None and self.spool is not None:
+                self.spool.done(action.retry_id)
+            return
+
+        attempt = action.attempt + 1
+        if attempt >= action.retry.max_attempts:
+            retries_abandoned.inc()
+            log.error('giving up on %s after %d attempts', action.url, attempt, extra=dict(sender_ip=action.sender_ip))
+            if action.retry_id is not None and self.spool is not None:
+                self.spool.done(action.retry_id)
+            return
+
+        delay = backoff_delay(action.retry, attempt)
+        action = action._replace(attempt=attempt, retry_id=action.retry_id or uuid.uuid4().hex, trace=None)
+        due = time() + delay
+        if self.spool is not None:
+            self.spool.add(due, action)
+        retries_scheduled.inc()
+        log.warning('retrying %s in %.1fs (attempt %d of %d)', action.url, delay, attempt + 1, action.retry.max_attempts, extra=dict(sender_ip=action.sender_ip))
+        self._push(due, action)
+
+    def _push(self, due, action):
+        with self._cond:
+            heapq.heappush(self._heap, (due, next(self._counter), action))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time():
+                    self._cond.wait(self._heap[0][0] - time() if self._heap else None)
+                _, _, action = heapq.heappop(self._heap)
+            self.submit(action)
@@ -1,17 +1,265 @@
 '''
-This script sends a fake power on message for `25486h,5397s,32768b,3612k,on` acting as a fake pop switch for testing
+This script acts as fake pop bridges for testing.
+
+With no arguments it sends a single power on message for `25486h,5397s,32768b,3612k,on`.
+
+With --duration it becomes a load generator: a number of simulated bridges press switches at a given rate, resending
+each SetPower/SetColor pair with the same timing as a real bridge and polling with Get/GetVersion in between. A stub
+HTTP server can be started to record the requests that pophttp makes, to measure the latency from a press to its
+webhook arriving.
 '''
 
+import heapq
+import itertools
+import random
+import selectors
 import socket
+import threading
+from argparse import ArgumentParser
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ipaddress import IPv4Address
+from time import perf_counter, sleep
+from urllib.parse import parse_qs, urlsplit
 try:
     import lifx
 except ImportError:
     from . import lifx
 
-def send(msg):
-    sock.sendto(msg.encode(b'\x00'*8, b'\x00'*6), ('127.0.0.1', 56700))
+TARGET = b'\x00'*8
+SITE = b'\x00'*6
+
+# The times a pop bridge sends the SetPower message for a single press, with the SetColor following shortly after
+RETRANSMIT_TIMES = (0.000, 0.055, 0.134, 0.275, 0.509, 0.873, 1.469, 2.443, 4.042)
+COLOR_DELAY = 0.002
+
+
+def percentiles(values, points=(50, 90, 99)):
+    if not values:
+        return dict((p, None) for p in points)
+    values = sorted(values)
+    return dict((p, values[min(len(values) - 1, int(len(values) * p / 100))]) for p in points)
+
+
+def press_messages(press_id, on):
+    '''The pair of messages for a press, with the press id encoded in the color so the webhook can be matched to it'''
+    power_msg = lifx.Message.Light_SetPower(level=lifx.DevicePower.ON if on else lifx.DevicePower.OFF, duration=1000)
+    color_msg = lifx.Message.Light_SetColor(stream=0, hue=press_id & 0xFFFF, saturation=press_id >> 16, brightness=32768, kelvin=3612, duration=1000)
+    return power_msg.encode(TARGET, SITE), color_msg.encode(TARGET, SITE)
+
+
+class SimulatedBridge:
+    def __init__(self, index, server, source=('127.0.0.1', 0)):
+        self.index = index
+        self.server = server
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(source)
+        self.sock.setblocking(False)
+        self.awaiting_reply = deque()
+        self.current_press = None
+        self.sent = 0
+        self.received = 0
+        self.reply_times = []
+
+    def send(self, data):
+        self.awaiting_reply.append(perf_counter())
+        self.sock.sendto(data, self.server)
+        self.sent += 1
+
+    def receive(self):
+        while True:
+            try:
+                self.sock.recvfrom(4096)
+            except BlockingIOError:
+                return
+            now = perf_counter()
+            self.received += 1
+            # Every message a bridge sends gets exactly 1 reply, and they arrive in order over loopback
+            if self.awaiting_reply:
+                self.reply_times.append(now - self.awaiting_reply.popleft())
+
+
+class StubHttpServer:
+    '''Records the time each request arrives, keyed by the press id encoded in the hue & saturation parameters'''
+    def __init__(self, address='127.0.0.1', port=0):
+        arrivals = self.arrivals = {}
+        self.requests = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def handle_request(handler):
+                now = perf_counter()
+                length = int(handler.headers.get('Content-Length') or 0)
+                if length:
+                    handler.rfile.read(length)
+                params = parse_qs(urlsplit(handler.path).query)
+                self.requests += 1
+                try:
+                    press_id = int(params['hue'][0]) + (int(params['saturation'][0]) << 16)
+                    arrivals.setdefault(press_id, now)
+                except (KeyError, ValueError):
+                    pass
+                handler.send_response(200)
+                handler.send_header('Content-Length', '0')
+                handler.end_headers()
+
+            do_GET = do_POST = do_PUT = handle_request
+
+            def log_message(handler, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def url_template(self):
+        return f'http://127.0.0.1:{self.port}/press?power={{onoff}}&hue={{hue}}&saturation={{saturation}}'
+
+    def close(self):
+        self.server.shutdown()
+
+
+class LoadGenerator:
+    def __init__(self, server, bridges=1, rate=1.0, poll_interval=5.0, source_ip='127.0.0.1', source_port=0, seed=None):
+        '''
+        `rate` is the total presses per second across all bridges. Each bridge is bound to consecutive source IPs
+        starting at `source_ip`, and to `source_port` (if it isn't 0) plus the bridge number
+        '''
+        first_ip = IPv4Address(source_ip)
+        self.bridges = [SimulatedBridge(i, server, (str(first_ip + i), source_port + i if source_port else 0)) for i in range(bridges)]
+        self.rate = rate
+        self.poll_interval = poll_interval
+        self.random = random.Random(seed)
+        self.press_times = {}
+        self._schedule = []
+        self._counter = itertools.count()
+
+    def _at(self, when, bridge, data, press_id=None):
+        heapq.heappush(self._schedule, (when, next(self._counter), bridge, data, press_id))
+
+    def _schedule_press(self, when, press_id):
+        bridge = self.random.choice(self.bridges)
+        power, color = press_messages(press_id, on=self.random.random() < 0.5)
+        self.press_times[press_id] = when
+        for offset in RETRANSMIT_TIMES:
+            self._at(when + offset, bridge, power, press_id)
+            self._at(when + offset + COLOR_DELAY, bridge, color, press_id)
+
+    def run(self, duration):
+        get = lifx.Message.Light_Get().encode(TARGET, SITE)
+        get_version = lifx.Message.Device_GetVersion().encode(TARGET, SITE)
+        selector = selectors.DefaultSelector()
+        for bridge in self.bridges:
+            selector.register(bridge.sock, selectors.EVENT_READ, bridge)
+
+        start = perf_counter()
+        for bridge in self.bridges:
+            first_poll = start + self.random.random() * self.poll_interval
+            for poll_time in itertools.takewhile(lambda t: t < start + duration, itertools.count(first_poll, self.poll_interval)):
+                self._at(poll_time, bridge, get)
+                self._at(poll_time + 0.003, bridge, get_version)
+        press_time = start
+        for press_id in itertools.count(1):
+            press_time += self.random.expovariate(self.rate) if self.rate > 0 else duration
+            if press_time >= start + duration:
+                break
+            self._schedule_press(press_time, press_id)
+
+        while self._schedule:
+            when, _, bridge, data, press_id = heapq.heappop(self._schedule)
+            if press_id is not None:
+                if when == self.press_times[press_id]:
+                    bridge.current_press = press_id
+                elif bridge.current_press != press_id:
+                    continue  # Like a real bridge, stop resending a press once another one has started
+            while True:
+                wait = when - perf_counter()
+                for key, _ in selector.select(max(wait, 0)):
+                    key.data.receive()
+                if wait <= 0:
+                    break
+            bridge.send(data)
+        self.elapsed = perf_counter() - start
+
+        # Give the last replies time to arrive
+        end = perf_counter() + 1
+        while perf_counter() < end:
+            for key, _ in selector.select(0.1):
+                key.data.receive()
+
+    def report(self, stub=None):
+        sent = sum(b.sent for b in self.bridges)
+        received = sum(b.received for b in self.bridges)
+        reply_times = [t for b in self.bridges for t in b.reply_times]
+        stats = dict(
+            bridges=len(self.bridges),
+            presses=len(self.press_times),
+            packets_sent=sent,
+            packets_per_sec=sent / self.elapsed if self.elapsed else 0,
+            replies=received,
+            reply_drop_rate=1 - received / sent if sent else 0,
+            ack_rtt=percentiles(reply_times),
+        )
+        if stub is not None:
+            latencies = [stub.arrivals[p] - t for p, t in self.press_times.items() if p in stub.arrivals]
+            stats.update(
+                webhooks=len(latencies),
+                webhook_drop_rate=1 - len(latencies) / len(self.press_times) if self.press_times else 0,
+                press_to_webhook=percentiles(latencies),
+            )
+        return stats
+
+
+def format_report(stats):
+    def ms(values):
+        return ', '.join(f'p{p} {v*1000:.2f}ms' if v is not None else f'p{p} -' for p, v in values.items())
+    lines = [
+        f'bridges:          {stats["bridges"]}',
+        f'presses:          {stats["presses"]}',
+        f'packets sent:     {stats["packets_sent"]} ({stats["packets_per_sec"]:.0f}/sec)',
+        f'replies:          {stats["replies"]} ({stats["reply_drop_rate"]:.2%} dropped)',
+        f'ack round trip:   {ms(stats["ack_rtt"])}',
+    ]
+    if 'webhooks' in stats:
+        lines += [
+            f'webhooks:         {stats["webhooks"]} ({stats["webhook_drop_rate"]:.2%} missing)',
+            f'press to webhook: {ms(stats["press_to_webhook"])}',
+        ]
+    return '\n'.join(lines)
+
+
+def send_single_press(server):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.sendto(lifx.Message.Light_SetColor(stream=0, hue=25486, saturation=5397, brightness=32768, kelvin=3612, duration=1000).encode(TARGET, SITE), server)
+    sock.sendto(lifx.Message.Light_SetPower(level=lifx.DevicePower.ON, duration=1000).encode(TARGET, SITE), server)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Act as one or more fake pop bridges')
+    parser.add_argument('--server', default='127.0.0.1', help='address of the pophttp server. Default 127.0.0.1')
+    parser.add_argument('--duration', type=float, help='generate load for this many seconds instead of sending a single press')
+    parser.add_argument('--bridges', type=int, default=1, help='number of simulated bridges. Default 1')
+    parser.add_argument('--rate', type=float, default=1.0, help='switch presses per second across all bridges. Default 1')
+    parser.add_argument('--poll-interval', type=float, default=5.0, help='seconds between each bridge polling with Get/GetVersion. Default 5')
+    parser.add_argument('--source-ip', default='127.0.0.1', help='source IP of the first bridge, incremented for each other bridge. Default 127.0.0.1')
+    parser.add_argument('--source-port', type=int, default=0, help='source port of the first bridge, incremented for each other bridge. Default is any free port')
+    parser.add_argument('--stub-port', type=int, help='run a stub HTTP server on this port to record the webhooks (use 0 for any free port)')
+    parser.add_argument('--seed', type=int, help='random seed for a repeatable sequence of presses')
+    args = parser.parse_args()
 
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-send(lifx.Message.Light_SetColor(stream=0, hue=25486, saturation=5397, brightness=32768, kelvin=3612, duration=1000))
-send(lifx.Message.Light_SetPower(level=lifx.DevicePower.ON, duration=1000))
+    server = (args.server, 56700)
+    if args.duration is None:
+        send_single_press(server)
+    else:
+        stub = None
+        if args.stub_port is not None:
+            stub = StubHttpServer(port=args.stub_port)
+            print(f'Stub HTTP server recording requests, configure pophttp with\n    default_url: {stub.url_template()}')
+        load = LoadGenerator(server, args.bridges, args.rate, args.poll_interval, args.source_ip, args.source_port, args.seed)
+        load.run(args.duration)
+        sleep(0.5)
+        print(format_report(load.report(stub)))
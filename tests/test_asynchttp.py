@@ -0,0 +1,92 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pophttp import asynchttp
+from pophttp.dispatch import Action, AsyncDispatcher
+
+
+class RecordingHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path, None))
+        if self.path == '/chunked':
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.wfile.write(b'5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n')
+        else:
+            self.send_response(404 if self.path == '/missing' else 200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.command, self.path, body))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+def start_server():
+    server = HTTPServer(('127.0.0.1', 0), RecordingHandler)
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+class TestAsyncHttp(object):
+    def test_get(self):
+        server, base_url = start_server()
+        resp = asyncio.run(asynchttp.request('GET', base_url + '/switch?power=on', timeout=5))
+        server.shutdown()
+        assert (resp.code, resp.body) == (200, b'ok')
+        assert server.requests == [('GET', '/switch?power=on', None)]
+
+    def test_post_and_errors(self):
+        server, base_url = start_server()
+        async def run():
+            return [
+                await asynchttp.request('POST', base_url + '/post', body=b'{"on": true}', timeout=5),
+                await asynchttp.request('GET', base_url + '/missing', timeout=5),
+                await asynchttp.request('GET', base_url + '/chunked', timeout=5),
+            ]
+        post, missing, chunked = asyncio.run(run())
+        server.shutdown()
+        assert post.code == 204
+        assert missing.code == 404
+        assert chunked.body == b'hello world'
+        assert server.requests[0] == ('POST', '/post', b'{"on": true}')
+
+    def test_async_dispatcher(self):
+        executed = []
+        async def execute(action):
+            await asyncio.sleep(0)
+            executed.append(action.url)
+        async def run():
+            dispatcher = AsyncDispatcher(execute, queue_size=10)
+            for i in range(3):
+                dispatcher.submit(Action('10.0.0.1', f'http://example.com/{i}', None, None, {}, 1))
+            await dispatcher.stop()
+            return dispatcher.stats()
+        stats = asyncio.run(run())
+        assert sorted(executed) == ['http://example.com/0', 'http://example.com/1', 'http://example.com/2']
+        assert stats['completed'] == 3 and stats['depth'] == 0
+
+    def test_async_dispatcher_drop_oldest(self):
+        async def execute(action):
+            await asyncio.sleep(0.05)
+        async def run():
+            dispatcher = AsyncDispatcher(execute, queue_size=2)
+            for i in range(3):
+                dispatcher.submit(Action('10.0.0.1', f'http://example.com/{i}', None, None, {}, 1))
+            await dispatcher.stop()
+            await asyncio.sleep(0)
+            return dispatcher.stats()
+        stats = asyncio.run(run())
+        assert (stats['submitted'], stats['completed'], stats['dropped']) == (3, 2, 1)
+
+    def test_ssl_context_reused(self):
+        assert asynchttp._ssl_context() is asynchttp._ssl_context()
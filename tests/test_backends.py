@@ -0,0 +1,84 @@
+import socket
+import pytest
+from pophttp.backends import SocketBackends
+from pophttp.config import Config, ConfigError
+from pophttp.tests.test_config import write_config
+
+
+def read_lines(conn, count=1):
+    conn.settimeout(5)
+    data = b''
+    while data.count(b'\n') < count:
+        data += conn.recv(1024)
+    return data
+
+
+class TestSocketBackends(object):
+    def test_udp(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        backends = SocketBackends()
+        url = f'udp://127.0.0.1:{server.getsockname()[1]}'
+        assert backends.send(url, 'on 100 0 0 0', 5) is False
+        assert backends.send(url, 'off 100 0 0 0', 5) is True
+        assert [server.recv(1024) for _ in range(2)] == [b'on 100 0 0 0', b'off 100 0 0 0']
+        backends.close()
+        server.close()
+
+    def test_tcp_reconnects(self):
+        server = socket.create_server(('127.0.0.1', 0))
+        server.settimeout(5)
+        backends = SocketBackends()
+        url = f'tcp://127.0.0.1:{server.getsockname()[1]}'
+
+        assert backends.send(url, 'on', 5) is False
+        conn, _ = server.accept()
+        assert backends.send(url, 'off', 5) is True
+        assert read_lines(conn, 2) == b'on\noff\n'
+
+        conn.close()
+        assert backends.send(url, 'on', 5) is False
+        conn, _ = server.accept()
+        assert read_lines(conn) == b'on\n'
+        conn.close()
+        backends.close()
+        server.close()
+
+    def test_unix(self, tmp_path):
+        path = str(tmp_path / 'pop.sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen()
+        server.settimeout(5)
+        backends = SocketBackends()
+        backends.send(f'unix://{path}', 'on 1 2 3 4', 5)
+        conn, _ = server.accept()
+        assert read_lines(conn) == b'on 1 2 3 4\n'
+        conn.close()
+        backends.close()
+        server.close()
+
+    def test_connection_refused(self):
+        server = socket.create_server(('127.0.0.1', 0))
+        port = server.getsockname()[1]
+        server.close()
+        with pytest.raises(OSError):
+            SocketBackends().send(f'tcp://127.0.0.1:{port}', 'on', 5)
+
+
+class TestSocketTargetConfig(object):
+    def test_default_body(self, tmp_path):
+        config = Config(write_config(tmp_path, "switches:\n  1h: tcp://127.0.0.1:9000\n  2h:\n    url: unix:///run/pop.sock\n    body: 'light {onoff}'\n"))
+        first = config.get_target_for_switch(hue=1, saturation=2, brightness=3, kelvin=4, power=True)[0]
+        second = config.get_target_for_switch(hue=2, saturation=2, brightness=3, kelvin=4, power=False)[0]
+        assert (first.url, first.body) == ('tcp://127.0.0.1:9000', 'on 1 2 3 4')
+        assert (second.url, second.body) == ('unix:///run/pop.sock', 'light off')
+
+    def test_missing_port(self, tmp_path):
+        with pytest.raises(ConfigError, match='host and port'):
+            Config(write_config(tmp_path, 'switches:\n  1h: udp://127.0.0.1\n'))
+
+    def test_no_headers(self, tmp_path):
+        with pytest.raises(ConfigError, match='method or headers'):
+            Config(write_config(tmp_path, 'switches:\n  1h:\n    url: tcp://127.0.0.1:9000\n    method: POST\n'))
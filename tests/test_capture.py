@@ -0,0 +1,67 @@
+import pytest
+from pophttp import pophttp
+from pophttp.config import SwitchConfig
+from pophttp.capture import MAGIC, CaptureWriter, CountingDispatcher, ReplayClock, read_capture, replay
+from pophttp.tests.test_pophttp import build_action_msg_seq, build_idle_msg_seq
+
+TARGET = b'\x00' * 8
+SITE = b'\x00' * 6
+
+class Config(object):
+    lights = {}
+    default_light = True
+
+    def is_ip_allowed(self, ip):
+        return True
+
+    def get_target_for_switch(self, **kwargs):
+        return [SwitchConfig('http://example.com', None, None, {}, 5, None)]
+
+
+def write_capture(filename, msg_seq, **kwargs):
+    writer = CaptureWriter(filename, **kwargs)
+    for msg_time, bridge_addr, msg in sorted(msg_seq, key=lambda m: m[0]):
+        writer.write(bridge_addr, msg.encode(TARGET, SITE), now=100 + msg_time)
+    writer.close()
+
+
+class TestCapture(object):
+    def test_round_trip(self, tmp_path):
+        filename = str(tmp_path / 'capture')
+        _, msg_seq = build_action_msg_seq(bridge_addr=('10.0.0.1', 56700))
+        write_capture(filename, msg_seq + [(5, ('fe80::1', 56701), pophttp.lifx.Message.Light_Get())])
+        records = list(read_capture(filename))
+        assert len(records) == len(msg_seq) + 1
+        assert records[0][:2] == (100, ('10.0.0.1', 56700))
+        assert records[-1][1] == ('fe80::1', 56701)
+        assert pophttp.lifx.Message.decode(records[0][2]) == msg_seq[0][2]
+
+    def test_rotation(self, tmp_path):
+        filename = str(tmp_path / 'capture')
+        _, msg_seq = build_action_msg_seq()
+        write_capture(filename, msg_seq, max_bytes=200, backups=2)
+        files = sorted(p.name for p in tmp_path.iterdir())
+        assert files == ['capture', 'capture.1', 'capture.2']
+        assert all((tmp_path / f).stat().st_size <= 200 and (tmp_path / f).read_bytes().startswith(MAGIC) for f in files)
+
+    def test_partial_record_ignored(self, tmp_path):
+        filename = str(tmp_path / 'capture')
+        _, msg_seq = build_action_msg_seq()
+        write_capture(filename, msg_seq)
+        with open(filename, 'r+b') as capture_file:
+            capture_file.truncate(capture_file.seek(0, 2) - 3)
+        assert len(list(read_capture(filename))) == len(msg_seq) - 1
+
+    def test_replay(self, tmp_path):
+        filename = str(tmp_path / 'capture')
+        _, press_1 = build_action_msg_seq(start=0, on=True)
+        _, press_2 = build_action_msg_seq(start=10, on=False)
+        write_capture(filename, press_1 + build_idle_msg_seq(start=5) + press_2)
+
+        dispatcher = CountingDispatcher()
+        clock = ReplayClock()
+        handler = pophttp.MessageHandler(Config(), dispatcher, clock=clock)
+        stats = replay(read_capture(filename), handler, pophttp.process_datagram, clock)
+        assert dispatcher.actions == 2
+        assert stats['packets'] == stats['replies'] == len(press_1) + len(press_2) + 6
+        assert stats['captured_seconds'] == pytest.approx(press_2[-1][0])
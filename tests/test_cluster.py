@@ -0,0 +1,95 @@
+import socket
+import time
+import pytest
+from pophttp.cluster import Cluster
+from pophttp.config import ClusterConfig
+
+
+def free_ports(count):
+    socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(count)]
+    for sock in socks:
+        sock.bind(('127.0.0.1', 0))
+    ports = [sock.getsockname()[1] for sock in socks]
+    for sock in socks:
+        sock.close()
+    return ports
+
+
+def wait_for(condition, timeout=3):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def nodes():
+    ports = free_ports(3)
+    started = []
+
+    def start(count=3, lease=0.1):
+        for i in range(count):
+            config = ClusterConfig(f'node{i}', '127.0.0.1', ports[i], [('127.0.0.1', p) for p in ports[:count] if p != ports[i]], i, 0.05, 0.3, lease)
+            node = Cluster(config)
+            node.fired = []
+            node.start(lambda sender, trigger, node=node: node.fired.append((sender, trigger)))
+            started.append(node)
+        assert wait_for(lambda: started[0].active)
+        return started
+
+    yield start
+    for node in started:
+        node.stop()
+
+
+class TestCluster(object):
+    def test_one_active_node(self, nodes):
+        cluster = nodes()
+        assert [node.active for node in cluster] == [True, False, False]
+
+    def test_press_fired_once(self, nodes):
+        cluster = nodes()
+        claims = [node.claim('10.0.0.2', ('on', 'red')) for node in cluster]
+        assert claims == [True, False, False]
+        time.sleep(0.5)
+        assert [node.fired for node in cluster] == [[], [], []]
+        assert cluster[2].claim('10.0.0.3', ('on', 'red')) is False
+
+    def test_standby_fires_press_missed_by_active(self, nodes):
+        cluster = nodes()
+        assert cluster[2].claim('10.0.0.2', ('on', 'red')) is False
+        assert cluster[1].claim('10.0.0.2', ('on', 'red')) is False
+        assert wait_for(lambda: cluster[1].fired)
+        time.sleep(0.3)
+        assert cluster[1].fired == [('10.0.0.2', ('on', 'red'))]
+        assert cluster[2].fired == []
+
+    def test_failover(self, nodes):
+        cluster = nodes()
+        cluster[0].stop()
+        start = time.monotonic()
+        assert wait_for(lambda: cluster[1].active)
+        assert time.monotonic() - start < 0.6
+        assert not cluster[2].active
+        assert cluster[1].claim('10.0.0.2', ('off', 'blue')) is True
+
+    def test_dual_stack_node(self):
+        ports = free_ports(2)
+        # The first node listens on IPv6 and reaches the second over IPv4, which it sees as a mapped address
+        configs = [
+            ClusterConfig('node0', '::', ports[0], [('127.0.0.1', ports[1])], 0, 0.05, 0.3, 0.1),
+            ClusterConfig('node1', '127.0.0.1', ports[1], [('127.0.0.1', ports[0])], 1, 0.05, 0.3, 0.1),
+        ]
+        cluster = [Cluster(config) for config in configs]
+        try:
+            for node in cluster:
+                node.start(lambda sender, trigger: None)
+            assert wait_for(lambda: cluster[0].active)
+            assert cluster[0].claim('10.0.0.2', ('on', 'red')) is True
+            assert wait_for(lambda: cluster[1]._claims)
+            assert not cluster[1].active
+        finally:
+            for node in cluster:
+                node.stop()
@@ -0,0 +1,300 @@
+import pytest
+from pophttp.config import Config, ConfigError
+from pophttp.configwatch import ConfigReloader
+
+def write_config(tmp_path, text):
+    path = tmp_path / 'config.yml'
+    path.write_text(text)
+    return str(path)
+
+
+class TestSwitchMatching(object):
+    CONFIG = '''
+switches:
+  500h,500s,32768b,3612k: http://example.com/1?power={onoff}
+  500h,500s,32768b,3612k,on: http://example.com/2
+  500h,500s: http://example.com/3?hue={hue}
+  on: http://example.com/4
+  off: http://example.com/5
+'''
+
+    def test_matches_in_config_order(self, tmp_path):
+        config = Config(write_config(tmp_path, self.CONFIG))
+        targets = config.get_target_for_switch(hue=500, saturation=500, brightness=32768, kelvin=3612, power=True)
+        assert [t.url for t in targets] == [
+            'http://example.com/1?power=on',
+            'http://example.com/2',
+            'http://example.com/3?hue=500',
+            'http://example.com/4',
+        ]
+
+    def test_partial_filters(self, tmp_path):
+        config = Config(write_config(tmp_path, self.CONFIG))
+        targets = config.get_target_for_switch(hue=500, saturation=500, brightness=1, kelvin=3612, power=False)
+        assert [t.url for t in targets] == ['http://example.com/3?hue=500', 'http://example.com/5']
+
+    def test_default_url(self, tmp_path):
+        config = Config(write_config(tmp_path, 'default_url: http://example.com/default?power={onoff}\nswitches:\n  1h: http://example.com/1\n'))
+        targets = config.get_target_for_switch(hue=2, saturation=0, brightness=0, kelvin=0, power=False)
+        assert [t.url for t in targets] == ['http://example.com/default?power=off']
+
+    def test_unknown_filter_parameter(self, tmp_path):
+        with pytest.raises(ConfigError):
+            Config(write_config(tmp_path, 'switches:\n  500x: http://example.com\n'))
+
+
+class TestTemplates(object):
+    def test_unknown_placeholder(self, tmp_path):
+        with pytest.raises(ConfigError, match='hue2'):
+            Config(write_config(tmp_path, 'switches:\n  500h: http://example.com?hue={hue2}\n'))
+
+    def test_error_names_filter_as_written(self, tmp_path):
+        with pytest.raises(ConfigError, match=r"for switch filter '500h, on'\."):
+            Config(write_config(tmp_path, 'switches:\n  500h, on: http://example.com?hue={hue2}\n'))
+
+    def test_bad_body_template(self, tmp_path):
+        with pytest.raises(ConfigError):
+            Config(write_config(tmp_path, 'switches:\n  500h:\n    url: http://example.com\n    body: \'{"hue": {hue}\'\n'))
+
+    def test_rendered_with_endpoint(self, tmp_path):
+        config = Config(write_config(tmp_path, '''
+switches:
+  500h:
+    url: http://example.com/api/light?power={onoff}
+    body: '{{"hue": {hue}, "kelvin": {kelvin}}}'
+    headers:
+      Header-2: switch
+endpoints:
+  http://example.com/api:
+    method: PUT
+    timeout: 2
+    auth: bearer
+    token: ABC
+    headers:
+      Header-1: endpoint
+      Header-2: endpoint
+'''))
+        target, = config.get_target_for_switch(hue=500, saturation=1, brightness=2, kelvin=3500, power=False)
+        assert target.url == 'http://example.com/api/light?power=off'
+        assert target.body == '{"hue": 500, "kelvin": 3500}'
+        assert target.method == 'PUT'
+        assert target.timeout == 2
+        assert target.headers == {'Header-1': 'endpoint', 'Header-2': 'switch', 'Authorization': 'Bearer ABC'}
+
+    def test_rendered_requests_cached(self, tmp_path):
+        config = Config(write_config(tmp_path, 'switches:\n  500h: http://example.com?power={onoff}\n'))
+        for _ in range(3):
+            config.get_target_for_switch(hue=500, saturation=1, brightness=2, kelvin=3500, power=True)
+        assert config._render_targets.cache_info().hits == 2
+
+
+class TestReload(object):
+    def test_reload_swaps_config(self, tmp_path):
+        filename = write_config(tmp_path, 'switches:\n  1h: http://example.com/1\n')
+        applied = []
+        reloader = ConfigReloader(filename, applied.append)
+        (tmp_path / 'config.yml').write_text('switches:\n  1h: http://example.com/2\n')
+        assert reloader.reload()
+        assert [t.url for t in applied[0].get_target_for_switch(1, 0, 0, 0, True)] == ['http://example.com/2']
+
+    def test_bad_config_keeps_current(self, tmp_path):
+        filename = write_config(tmp_path, 'switches:\n  1h: http://example.com/1\n')
+        applied = []
+        current = Config(filename)
+        reloader = ConfigReloader(filename, applied.append, current)
+        (tmp_path / 'config.yml').write_text('switches:\n  1h: http://example.com/{bad}\n')
+        assert not reloader.reload()
+        (tmp_path / 'config.yml').write_text('switches: [\n')
+        assert not reloader.reload()
+        assert applied == []
+        assert reloader.config is current
+
+    @pytest.mark.parametrize('text', [
+        'switches:\n  50xh: http://example.com\n',
+        'switches:\n  - http://example.com\n',
+        "switches:\n  '': http://example.com\n",
+        'switches:\n  1h:\n    url: http://example.com\n    headers: [a, b]\n',
+    ])
+    def test_malformed_config(self, tmp_path, text):
+        with pytest.raises(ConfigError):
+            Config(write_config(tmp_path, text))
+
+    def test_watch_survives_bad_edit(self, tmp_path, mocker):
+        import time
+        filename = write_config(tmp_path, 'switches:\n  1h: http://example.com/1\n')
+        applied = []
+        reloader = ConfigReloader(filename, applied.append, Config(filename))
+        load = mocker.patch('pophttp.configwatch.Config.load', side_effect=[RuntimeError('unexpected'), Config(filename)])
+        reloader.watch(0.01)
+        (tmp_path / 'config.yml').write_text('switches:\n  50xh: http://example.com/2\n')
+        deadline = time.monotonic() + 5
+        while load.call_count < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        (tmp_path / 'config.yml').write_text('switches:\n  1h: http://example.com/3\n')
+        while not applied and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert load.call_count == 2
+        assert len(applied) == 1
+
+
+class TestIPFilter(object):
+    def test_default_allows_everything(self, tmp_path):
+        config = Config(write_config(tmp_path, 'switches: {}\n'))
+        assert config.is_ip_allowed('10.1.2.3') and config.is_ip_allowed('fe80::1')
+
+    def test_single_network(self, tmp_path):
+        config = Config(write_config(tmp_path, "ip_filter: '192.168.1.0/24'\n"))
+        assert config.is_ip_allowed('192.168.1.20')
+        assert not config.is_ip_allowed('192.168.2.20')
+        assert config.is_ip_allowed('::ffff:192.168.1.20')
+
+    def test_most_specific_wins(self, tmp_path):
+        config = Config(write_config(tmp_path, '''
+ip_filter:
+  allow: ['10.0.0.0/8', '10.1.1.1', 'fd00::/8']
+  deny: ['10.1.0.0/16']
+'''))
+        assert config.is_ip_allowed('10.2.0.1')
+        assert not config.is_ip_allowed('10.1.0.1')
+        assert config.is_ip_allowed('10.1.1.1')
+        assert config.is_ip_allowed('fd12::1')
+        assert not config.is_ip_allowed('2001:db8::1')
+        assert not config.is_ip_allowed('10.1.0.1')  # cached
+
+    def test_deny_only(self, tmp_path):
+        config = Config(write_config(tmp_path, "ip_filter:\n  deny: 10.0.0.5\n"))
+        assert config.is_ip_allowed('10.0.0.4') and not config.is_ip_allowed('10.0.0.5')
+
+    def test_bad_network(self, tmp_path):
+        with pytest.raises(ConfigError):
+            Config(write_config(tmp_path, "ip_filter: ['10.0.0.0/33']\n"))
+
+
+class TestRateLimits(object):
+    def test_endpoint_rate_limit_and_coalesce(self, tmp_path):
+        config = Config(write_config(tmp_path, '''
+switches:
+  1h: http://example.com/1?power={onoff}
+  2h: http://other.example.com/2
+endpoints:
+  http://example.com:
+    rate_limit: {rate: 0.5, burst: 3}
+    coalesce: true
+  http://other.example.com:
+    rate_limit: 5
+'''))
+        target, = config.get_target_for_switch(hue=1, saturation=0, brightness=0, kelvin=0, power=True)
+        assert (target.endpoint, target.rate_limit, target.coalesce) == ('http://example.com', (0.5, 3), True)
+        target, = config.get_target_for_switch(hue=2, saturation=0, brightness=0, kelvin=0, power=True)
+        assert (target.rate_limit, target.coalesce) == ((5.0, 5), False)
+
+    def test_bad_rate_limit(self, tmp_path):
+        with pytest.raises(ConfigError):
+            Config(write_config(tmp_path, 'endpoints:\n  http://example.com:\n    rate_limit: 0\n'))
+
+
+class TestSnapshot(object):
+    CONFIG = '''
+ip_filter: 10.0.0.0/8
+endpoints:
+  http://example.com:
+    headers:
+      X-Key: abc
+switches:
+  500h: http://example.com/1?power={onoff}
+'''
+
+    def test_loaded_from_snapshot(self, tmp_path, mocker):
+        filename = write_config(tmp_path, self.CONFIG)
+        snapshot = str(tmp_path / 'config.snapshot')
+        config = Config.load(filename, snapshot)
+        config.get_target_for_switch(hue=500, saturation=0, brightness=0, kelvin=0, power=True)
+
+        parse = mocker.patch('pophttp.config.yaml.load')
+        cached = Config.load(filename, snapshot)
+        assert not parse.called
+        targets = cached.get_target_for_switch(hue=500, saturation=0, brightness=0, kelvin=0, power=False)
+        assert [(t.url, t.headers) for t in targets] == [('http://example.com/1?power=off', {'X-Key': 'abc'})]
+        assert cached.is_ip_allowed('10.1.2.3') and not cached.is_ip_allowed('192.168.1.1')
+
+    def test_rebuilt_when_config_changes(self, tmp_path):
+        filename = write_config(tmp_path, self.CONFIG)
+        snapshot = str(tmp_path / 'config.snapshot')
+        Config.load(filename, snapshot)
+        (tmp_path / 'config.yml').write_text(self.CONFIG.replace('/1?', '/2?'))
+        config = Config.load(filename, snapshot)
+        assert config.get_target_for_switch(hue=500, saturation=0, brightness=0, kelvin=0, power=True)[0].url == 'http://example.com/2?power=on'
+
+    def test_damaged_snapshot_ignored(self, tmp_path):
+        filename = write_config(tmp_path, self.CONFIG)
+        snapshot = tmp_path / 'config.snapshot'
+        snapshot.write_bytes(b'not a pickle')
+        config = Config.load(filename, str(snapshot))
+        assert config.get_target_for_switch(hue=500, saturation=0, brightness=0, kelvin=0, power=True)[0].url == 'http://example.com/1?power=on'
+        assert Config.load(filename, str(snapshot)).default_url is None
+
+
+class TestCluster(object):
+    def test_cluster_config(self, tmp_path):
+        config = Config(write_config(tmp_path, '''
+cluster:
+  node: a
+  peers: [192.168.1.11, 'pophttp2:56710']
+  priority: 1
+'''))
+        assert config.cluster.node == 'a'
+        assert config.cluster.port == 56701
+        assert config.cluster.peers == [('192.168.1.11', 56701), ('pophttp2', 56710)]
+        assert (config.cluster.priority, config.cluster.heartbeat, config.cluster.failover, config.cluster.lease) == (1, 0.5, 2.0, 0.25)
+
+    def test_ipv6_peers(self, tmp_path):
+        config = Config(write_config(tmp_path, "cluster:\n  peers: ['fd00::2', '[fd00::3]:56710']\n"))
+        assert config.cluster.peers == [('fd00::2', 56701), ('fd00::3', 56710)]
+
+    def test_cluster_needs_peers(self, tmp_path):
+        with pytest.raises(ConfigError, match='peers'):
+            Config(write_config(tmp_path, 'cluster:\n  port: 56701\n'))
+
+    def test_failover_longer_than_heartbeat(self, tmp_path):
+        with pytest.raises(ConfigError, match='failover'):
+            Config(write_config(tmp_path, 'cluster:\n  peers: [10.0.0.2]\n  heartbeat: 2\n  failover: 1\n'))
+
+
+class TestLights(object):
+    LIGHTS = '''
+lights:
+  - mac: d0:73:d5:00:00:01
+    label: Kitchen
+    switches:
+      on: http://example.com/kitchen/on
+      off: http://example.com/kitchen/off
+  - mac: d0-73-d5-00-00-02
+    default_url: http://example.com/hall?power={onoff}
+'''
+
+    def test_lights(self, tmp_path):
+        config = Config(write_config(tmp_path, self.LIGHTS))
+        kitchen, hall = b'\xd0\x73\xd5\x00\x00\x01\x00\x00', b'\xd0\x73\xd5\x00\x00\x02\x00\x00'
+        assert [(light.target, light.label) for light in config.lights.values()] == [(kitchen, 'Kitchen'), (hall, 'Pop HTTP 2')]
+        assert not config.default_light
+        assert [t.url for t in config.get_target_for_switch(hue=1, saturation=2, brightness=3, kelvin=4, power=False, light=kitchen)] == ['http://example.com/kitchen/off']
+        assert [t.url for t in config.get_target_for_switch(hue=1, saturation=2, brightness=3, kelvin=4, power=True, light=hall)] == ['http://example.com/hall?power=on']
+        assert config.get_target_for_switch(hue=1, saturation=2, brightness=3, kelvin=4, power=True) == []
+        assert config.get_target_for_switch(hue=1, saturation=2, brightness=3, kelvin=4, power=True, light=bytes(8)) == []
+
+    def test_default_light_kept_for_top_level_switches(self, tmp_path):
+        config = Config(write_config(tmp_path, self.LIGHTS + 'switches:\n  on: http://example.com/all\n'))
+        assert config.default_light
+        assert [t.url for t in config.get_target_for_switch(hue=1, saturation=2, brightness=3, kelvin=4, power=True)] == ['http://example.com/all']
+
+    def test_duplicate_mac(self, tmp_path):
+        with pytest.raises(ConfigError, match='same mac'):
+            Config(write_config(tmp_path, self.LIGHTS + '  - mac: D0:73:D5:00:00:01\n    default_url: http://example.com\n'))
+
+    def test_unquoted_numeric_mac(self, tmp_path):
+        with pytest.raises(ConfigError, match='quoted'):
+            Config(write_config(tmp_path, 'lights:\n  - mac: 10:20:30:40:50:59\n    default_url: http://example.com\n'))
+
+    def test_light_needs_actions(self, tmp_path):
+        with pytest.raises(ConfigError, match='switches or a default_url'):
+            Config(write_config(tmp_path, 'lights:\n  - mac: d0:73:d5:00:00:01\n'))
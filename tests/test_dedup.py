@@ -0,0 +1,57 @@
+import multiprocessing
+import pytest
+from pophttp import lifx
+from pophttp.dedup import LastTrigger, RetransmitFilter, SharedLastTrigger
+
+def make_trigger(hue):
+    return (lifx.Message.Light_SetPower(level=lifx.DevicePower.ON, duration=1000),
+            lifx.Message.Light_SetColor(stream=0, hue=hue, saturation=0, brightness=0, kelvin=0, duration=1000))
+
+def claim_in_child(dedup, sender, hue, result):
+    result.value = dedup.claim(sender, make_trigger(hue))
+
+
+@pytest.mark.parametrize('dedup_type', [LastTrigger, SharedLastTrigger])
+class TestLastTrigger(object):
+    def test_other_sender_suppressed(self, dedup_type):
+        dedup = dedup_type()
+        assert dedup.claim('10.0.0.1', make_trigger(1))
+        assert not dedup.claim('10.0.0.2', make_trigger(1))
+        assert dedup.claim('10.0.0.1', make_trigger(1))
+        assert dedup.claim('10.0.0.2', make_trigger(2))
+        assert dedup.claim('10.0.0.1', make_trigger(1))
+
+
+def test_shared_between_processes():
+    dedup = SharedLastTrigger()
+    context = multiprocessing.get_context('fork')
+    result = context.Value('b', -1)
+    child = context.Process(target=claim_in_child, args=(dedup, '10.0.0.1', 1, result))
+    child.start()
+    child.join()
+    assert result.value == 1
+    assert not dedup.claim('10.0.0.2', make_trigger(1))
+
+
+class TestRetransmitFilter(object):
+    def test_same_payload_within_window(self):
+        retransmits = RetransmitFilter(window=5)
+        assert not retransmits.is_retransmit('10.0.0.1', 117, b'power', 0)
+        assert not retransmits.is_retransmit('10.0.0.1', 102, b'color', 0)
+        assert retransmits.is_retransmit('10.0.0.1', 117, b'power', 1)
+        assert retransmits.is_retransmit('10.0.0.1', 102, b'color', 4.9)
+        assert not retransmits.is_retransmit('10.0.0.2', 117, b'power', 1)
+        assert not retransmits.is_retransmit('10.0.0.1', 117, b'power', 5)
+
+    def test_new_payload_clears_sender(self):
+        retransmits = RetransmitFilter(window=5)
+        retransmits.is_retransmit('10.0.0.1', 117, b'on', 0)
+        retransmits.is_retransmit('10.0.0.1', 102, b'color', 0)
+        assert not retransmits.is_retransmit('10.0.0.1', 117, b'off', 1)
+        assert not retransmits.is_retransmit('10.0.0.1', 102, b'color', 1)
+
+    def test_forget(self):
+        retransmits = RetransmitFilter(window=5)
+        retransmits.is_retransmit('10.0.0.1', 117, b'on', 0)
+        retransmits.forget('10.0.0.1')
+        assert not retransmits.is_retransmit('10.0.0.1', 117, b'on', 1)
@@ -0,0 +1,120 @@
+import asyncio
+import threading
+from pophttp.config import RateLimit
+from pophttp.dispatch import Action, AsyncDispatcher, Dispatcher, Throttle, TokenBucket
+
+
+def make_action(url):
+    return Action('10.0.0.1', url, None, None, {}, 1)
+
+class BlockingExecutor(object):
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.executed = []
+
+    def __call__(self, action):
+        self.started.set()
+        self.release.wait(5)
+        self.executed.append(action.url)
+
+
+class TestDispatcher(object):
+    def test_actions_are_executed(self):
+        executed = []
+        dispatcher = Dispatcher(lambda action: executed.append(action.url), workers=2)
+        dispatcher.submit(make_action('http://example.com/1'))
+        dispatcher.submit(make_action('http://example.com/2'))
+        dispatcher.stop(5)
+        assert sorted(executed) == ['http://example.com/1', 'http://example.com/2']
+        assert dispatcher.stats()['completed'] == 2
+
+    def test_overflow_drop_oldest(self):
+        executor = BlockingExecutor()
+        dispatcher = Dispatcher(executor, workers=1, queue_size=2, overflow='drop-oldest')
+        dispatcher.submit(make_action('http://example.com/busy'))
+        executor.started.wait(5)
+        for i in range(3):
+            assert dispatcher.submit(make_action(f'http://example.com/{i}'))
+        assert dispatcher.depth == 2
+        executor.release.set()
+        dispatcher.stop(5)
+        assert executor.executed == ['http://example.com/busy', 'http://example.com/1', 'http://example.com/2']
+        assert dispatcher.stats()['dropped'] == 1
+
+    def test_overflow_reject(self):
+        executor = BlockingExecutor()
+        dispatcher = Dispatcher(executor, workers=1, queue_size=2, overflow='reject')
+        dispatcher.submit(make_action('http://example.com/busy'))
+        executor.started.wait(5)
+        results = [dispatcher.submit(make_action(f'http://example.com/{i}')) for i in range(3)]
+        assert results == [True, True, False]
+        executor.release.set()
+        dispatcher.stop(5)
+        assert executor.executed == ['http://example.com/busy', 'http://example.com/0', 'http://example.com/1']
+        assert dispatcher.stats()['rejected'] == 1
+
+
+class TestThrottle(object):
+    def test_token_bucket(self):
+        bucket = TokenBucket(RateLimit(rate=2, burst=2), now=0)
+        assert [bucket.take(0), bucket.take(0)] == [0, 0]
+        assert bucket.take(0) == 0.5
+        assert bucket.take(0.25) == 0.25
+        assert bucket.take(0.5) == 0
+
+    def test_rate_limited_endpoint_waits_without_blocking_others(self):
+        throttle = Throttle()
+        limited = [make_action(f'http://slow/{i}')._replace(endpoint='http://slow', rate_limit=RateLimit(1, 1)) for i in range(2)]
+        pending = limited + [make_action('http://fast/1')]
+        assert throttle.take_ready(pending, 0) == (limited[0], None)
+        assert throttle.take_ready(pending, 0)[0].url == 'http://fast/1'
+        assert throttle.take_ready(pending, 0.5) == (None, 0.5)
+        assert throttle.take_ready(pending, 1) == (limited[1], None)
+
+    def test_coalesce(self):
+        throttle = Throttle()
+        on = make_action('http://example.com/?power=on')._replace(coalesce_key=('http://example.com', 1, 2, 3, 4, 0))
+        off = make_action('http://example.com/?power=off')._replace(coalesce_key=on.coalesce_key)
+        pending = [on]
+        assert throttle.coalesce(pending, off)
+        assert pending == [off]
+        assert throttle.coalesce(pending, on._replace(attempt=1))
+        assert pending == [off]
+        assert not throttle.coalesce(pending, make_action('http://example.com/other'))
+        assert throttle.coalesced == 2
+
+
+class TestRateLimitedDispatch(object):
+    def test_thread_dispatcher_coalesces_queued(self):
+        executor = BlockingExecutor()
+        dispatcher = Dispatcher(executor, workers=1)
+        dispatcher.submit(make_action('http://example.com/busy'))
+        executor.started.wait(5)
+        for power in ('on', 'off', 'on'):
+            dispatcher.submit(make_action(f'http://example.com/?power={power}')._replace(coalesce_key=('switch',)))
+        executor.release.set()
+        dispatcher.stop(5)
+        assert executor.executed == ['http://example.com/busy', 'http://example.com/?power=on']
+        assert dispatcher.stats()['coalesced'] == 2
+
+    def test_async_dispatcher_rate_limit(self):
+        started = []
+
+        async def execute(action):
+            started.append((action.url, asyncio.get_event_loop().time()))
+
+        async def run():
+            dispatcher = AsyncDispatcher(execute)
+            limit = RateLimit(rate=20, burst=1)
+            for i in range(3):
+                dispatcher.submit(make_action(f'http://slow/{i}')._replace(endpoint='http://slow', rate_limit=limit, coalesce_key=('switch', i)))
+            dispatcher.submit(make_action('http://slow/1b')._replace(endpoint='http://slow', rate_limit=limit, coalesce_key=('switch', 1)))
+            await asyncio.sleep(0.2)
+            await dispatcher.stop()
+            return dispatcher.stats()
+
+        stats = asyncio.run(run())
+        assert [url for url, _ in started] == ['http://slow/0', 'http://slow/1b', 'http://slow/2']
+        assert started[2][1] - started[0][1] >= 0.09
+        assert stats['coalesced'] == 1 and stats['completed'] == 3
@@ -0,0 +1,81 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pophttp.httppool import ConnectionPool
+from pophttp.resolver import Resolver
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+        #Simulate the server timing out an idle keep-alive connection without telling the client
+        self.close_connection = self.server.drop_connections
+
+    def log_message(self, *args):
+        pass
+
+def start_server(drop_connections=False):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    server.connections = set()
+    server.drop_connections = drop_connections
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+class TestConnectionPool(object):
+    def test_connection_reused(self):
+        server, base_url = start_server()
+        pool = ConnectionPool()
+        responses = [pool.request('GET', f'{base_url}/{i}', timeout=5) for i in range(3)]
+        pool.close()
+        server.shutdown()
+        assert [r.code for r in responses] == [200, 200, 200]
+        assert [r.reused for r in responses] == [False, True, True]
+        assert len(server.connections) == 1
+
+    def test_reconnect_when_server_closed_connection(self):
+        server, base_url = start_server(drop_connections=True)
+        pool = ConnectionPool()
+        first = pool.request('GET', base_url + '/1', timeout=5)
+        second = pool.request('GET', base_url + '/2', timeout=5)
+        pool.close()
+        server.shutdown()
+        assert (first.code, second.code) == (200, 200)
+        assert not second.reused
+        assert len(server.connections) == 2
+
+    def test_prewarmed_connection_uses_resolver(self):
+        server, base_url = start_server()
+        resolver = Resolver()
+        resolver._cache[('pophttp-test.invalid', server.server_address[1])] = (['127.0.0.1'], float('inf'))
+        url = f'http://pophttp-test.invalid:{server.server_address[1]}/'
+        pool = ConnectionPool(resolver=resolver)
+        pool.prewarm(url, timeout=5)
+        pool.prewarm(url, timeout=5)
+        response = pool.request('GET', url, timeout=5)
+        pool.close()
+        server.shutdown()
+        assert response.code == 200
+        assert response.reused
+        assert len(server.connections) == 1
+
+    def test_prewarm_replaces_expiring_connection(self):
+        server, base_url = start_server()
+        pool = ConnectionPool()
+        pool.prewarm(base_url, timeout=5)
+        host_pool, _ = pool._host_pool(base_url)
+        first, _ = host_pool.idle[0]
+        pool.prewarm(base_url, timeout=5, margin=10)
+        assert [conn for conn, _ in host_pool.idle] == [first]
+        pool.prewarm(base_url, timeout=5, margin=host_pool.idle_timeout)
+        (second, _), = host_pool.idle
+        response = pool.request('GET', base_url, timeout=5)
+        pool.close()
+        server.shutdown()
+        assert second is not first and first.sock is None
+        assert response.reused
@@ -0,0 +1,58 @@
+import struct
+import pytest
+from pophttp import lifx
+
+TARGET = b'\x00' * 8
+SITE = b'\x00' * 6
+
+
+class TestDecode(object):
+    def test_round_trip(self):
+        msg = lifx.Message.Light_SetColor(stream=0, hue=24102, saturation=31097, brightness=32768, kelvin=3612, duration=1000)
+        packet = lifx.Message.decode(msg.encode(TARGET, SITE))
+        assert packet == msg
+        assert packet.header.code == lifx.Message.Light_SetColor.code
+        assert packet.hue == 24102
+
+    def test_string_fields_decoded(self):
+        msg = lifx.Message.Light_State(hue=0, saturation=655, brightness=65535, kelvin=2500, dim=0, power=65535, label='Pop HTTP', tags=0)
+        packet = lifx.Message.decode(bytearray(msg.encode(TARGET, SITE)))
+        assert packet.label.rstrip('\x00') == 'Pop HTTP'
+        assert packet.power == 65535
+
+    def test_unknown_packet(self):
+        data = bytearray(lifx.Message.Light_Get().encode(TARGET, SITE))
+        struct.pack_into('<H', data, 32, 9999)
+        assert lifx.Message.decode(data) is None
+
+    def test_wrong_length(self):
+        data = lifx.Message.Light_SetPower(level=0, duration=1000).encode(TARGET, SITE)
+        with pytest.raises(struct.error):
+            lifx.Message.decode(data[:-1])
+        with pytest.raises(struct.error):
+            lifx.Message.decode(data + b'\x00')
+
+
+class TestReplyTemplate(object):
+    @pytest.mark.parametrize('target, site', [('\x00' * 8, '\x00' * 6), (b'\xd0\x73\xd5\x01\x02\x03\x00\x00', b'LIFXV2')])
+    def test_matches_packet_encode(self, target, site):
+        msg = lifx.Message.Light_State(hue=0, saturation=655, brightness=65535, kelvin=2500, dim=0, power=65535, label='Pop HTTP', tags=0)
+        template = lifx.ReplyTemplate(msg)
+        expected = bytearray(msg.encode(target, site))
+        data = template.encode(target, site)
+        expected[23] = data[23] = 0
+        assert data == expected
+
+    def test_raw_and_decoded_addressing_match(self):
+        request = lifx.Message.decode(lifx.Message.Light_Get().encode(TARGET, SITE))
+        template = lifx.ReplyTemplate(lifx.Message.Device_Acknowledgment())
+        decoded = template.encode(request.header.target, request.header.site)
+        raw = template.encode(TARGET, SITE)
+        assert decoded[:23] == raw[:23] and struct.unpack_from('<H', raw, 2)[0] == 0x800
+
+    def test_sequence_advances(self):
+        template = lifx.ReplyTemplate(lifx.Message.Device_Acknowledgment())
+        first = lifx.Message.decode(template.encode(TARGET, SITE)).header.sequence
+        second = lifx.Message.decode(lifx.Message.Device_Acknowledgment().encode(TARGET, SITE)).header.sequence
+        third = lifx.Message.decode(template.encode(TARGET, SITE)).header.sequence
+        assert (second, third) == ((first + 1) & 0xFF, (first + 2) & 0xFF)
@@ -0,0 +1,82 @@
+import io
+import json
+import logging
+from pophttp import logs
+
+
+def make_record(msg, *args, **extra):
+    record = logging.LogRecord('pophttp', logging.INFO, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+class TestJsonFormatter(object):
+    def test_fields(self):
+        record = make_record('resp %d in %dms %s', 200, 12, 'http://example.com/', sender_ip='10.0.0.2', sender_port=56700,
+            url='http://example.com/', endpoint=None, code=200, latency_ms=12.3)
+        entry = json.loads(logs.JsonFormatter().format(record))
+        assert entry['message'] == 'resp 200 in 12ms http://example.com/'
+        assert entry['level'] == 'INFO'
+        assert entry['sender_ip'] == '10.0.0.2'
+        assert entry['code'] == 200
+        assert entry['latency_ms'] == 12.3
+        assert 'endpoint' not in entry
+
+    def test_no_sender(self):
+        entry = json.loads(logs.JsonFormatter().format(make_record('started', sender_ip='-')))
+        assert 'sender_ip' not in entry
+
+
+class TestRateLimitFilter(object):
+    def test_limits_by_key_and_sender(self, mocker):
+        now = mocker.patch('pophttp.logs.monotonic', return_value=100.0)
+        limit = logs.RateLimitFilter(interval=10)
+        poll = lambda ip: make_record('recv Light_Get', sender_ip=ip, rate_key='Light_Get')
+
+        assert limit.filter(poll('10.0.0.2'))
+        assert not limit.filter(poll('10.0.0.2'))
+        assert not limit.filter(poll('10.0.0.2'))
+        assert limit.filter(poll('10.0.0.3'))
+        assert limit.filter(make_record('resp 200', sender_ip='10.0.0.2'))
+
+        now.return_value = 110.0
+        record = poll('10.0.0.2')
+        assert limit.filter(record)
+        assert record.getMessage() == 'recv Light_Get (2 similar suppressed)'
+
+    def test_forgets_idle_senders(self, mocker):
+        now = mocker.patch('pophttp.logs.monotonic', return_value=100.0)
+        limit = logs.RateLimitFilter(interval=10, max_entries=2, ttl=60)
+        poll = lambda ip: make_record('recv Light_Get', sender_ip=ip, rate_key='Light_Get')
+
+        for ip in ('10.0.0.2', '10.0.0.3', '10.0.0.4'):
+            assert limit.filter(poll(ip))
+        assert [ip for _, ip in limit._seen] == ['10.0.0.3', '10.0.0.4']
+
+        now.return_value = 170.0
+        assert limit.filter(poll('10.0.0.5'))
+        assert [ip for _, ip in limit._seen] == ['10.0.0.5']
+
+
+class TestQueueLogging(object):
+    def test_formats_on_listener(self):
+        logger = logging.getLogger('pophttp.test_logs')
+        logger.propagate = False
+        stream = io.StringIO()
+        output = logs.QueueLogging(logger, logging.DEBUG, json_lines=True, stream=stream)
+        try:
+            class Formatted:
+                count = 0
+                def __str__(self):
+                    Formatted.count += 1
+                    return 'packet'
+
+            logger.debug('recv %s', Formatted(), extra=dict(sender_ip='10.0.0.2', switch='1h,2s,3b,4k,on'))
+        finally:
+            output.stop()
+            logger.removeHandler(output.handler)
+
+        assert Formatted.count == 1
+        entry = json.loads(stream.getvalue())
+        assert entry['message'] == 'recv packet'
+        assert entry['switch'] == '1h,2s,3b,4k,on'
@@ -0,0 +1,55 @@
+from urllib.request import urlopen
+from pophttp import metrics, pophttp
+from pophttp.lifx import Message as LifxMessage
+
+
+class TestMetrics(object):
+    def test_render(self):
+        registry = metrics.Registry()
+        counter = metrics.Counter('test_total', 'A counter', ('code',), registry=registry)
+        histogram = metrics.Histogram('test_seconds', 'A histogram', buckets=(0.1, 1), registry=registry)
+        metrics.Gauge('test_depth', 'A gauge', function=lambda: 3, registry=registry)
+        counter.inc('200')
+        counter.inc('200')
+        counter.inc('error')
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        assert registry.render() == '\n'.join([
+            '# HELP test_total A counter',
+            '# TYPE test_total counter',
+            'test_total{code="200"} 2',
+            'test_total{code="error"} 1',
+            '# HELP test_seconds A histogram',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1"} 2',
+            'test_seconds_bucket{le="+Inf"} 3',
+            'test_seconds_sum 5.55',
+            'test_seconds_count 3',
+            '# HELP test_depth A gauge',
+            '# TYPE test_depth gauge',
+            'test_depth 3',
+        ]) + '\n'
+
+    def test_server(self):
+        registry = metrics.Registry()
+        metrics.Counter('test_total', 'A counter', registry=registry).inc()
+        server = metrics.start_server('127.0.0.1', 0, registry)
+        with urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics', timeout=5) as resp:
+            body = resp.read().decode('utf-8')
+        server.shutdown()
+        assert 'test_total 1' in body
+
+    def test_handler_counts(self, mocker):
+        mocker.patch('pophttp.pophttp.MessageHandler.trigger_action')
+        hdlr = pophttp.MessageHandler(object())
+        triggers = metrics.triggers.value()
+        suppressed = metrics.messages_suppressed.value('retransmit')
+        power_msg = LifxMessage.Light_SetPower(level=65535, duration=1000)
+        color_msg = LifxMessage.Light_SetColor(stream=0, hue=1, saturation=2, brightness=3, kelvin=3500, duration=1000)
+        for _ in range(3):
+            hdlr.handle_msg('10.0.0.1', power_msg)
+            hdlr.handle_msg('10.0.0.1', color_msg)
+        assert metrics.triggers.value() == triggers + 1
+        assert metrics.messages_suppressed.value('retransmit') == suppressed + 4
@@ -1,3 +1,5 @@
+import json
+import pytest
 from pophttp.lifx import Message as LifxMessage
 from pophttp import pophttp
 try:
@@ -26,6 +28,9 @@ def replay_messages(handler, time_mock, msg_seq):
         handler.handle_msg(bridge_addr, msg)
 
 class FakeConfig(object):
+    lights = {}
+    default_light = True
+
     def get_urls(self, hue, saturation, brightness, kelvin, power):
         return ['http://example.com']
 
@@ -179,3 +184,221 @@ class TestMultiplleBridges(object):
             call(*expect_call_2)
         ])
         assert trigger_mock.call_count == 2
+
+
+class TestBridgeStateTable(object):
+    def test_expires_after_ttl(self):
+        table = pophttp.BridgeStateTable(max_entries=10, ttl=60)
+        table.get('10.0.0.1', 0)
+        table.get('10.0.0.2', 30)
+        table.get('10.0.0.2', 61)
+        assert '10.0.0.1' not in table
+        assert table.stats() == dict(entries=1, evictions=1)
+
+    def test_evicts_least_recently_seen(self):
+        table = pophttp.BridgeStateTable(max_entries=2, ttl=60)
+        table.get('10.0.0.1', 0)
+        table.get('10.0.0.2', 1)
+        table.get('10.0.0.1', 2)
+        table.get('10.0.0.3', 3)
+        assert '10.0.0.1' in table and '10.0.0.3' in table and '10.0.0.2' not in table
+        assert table.stats() == dict(entries=2, evictions=1)
+
+    def test_state_keeps_payloads(self, mocker):
+        mocker.patch('pophttp.pophttp.MessageHandler.trigger_action')
+        hdlr = pophttp.MessageHandler(FakeConfig())
+        (bridge_addr, power_msg, color_msg), _ = build_action_msg_seq()
+        hdlr.handle_msg(bridge_addr, power_msg)
+        state = hdlr.bridge_states.get(bridge_addr, 0)
+        assert state.power == power_msg.payload and state.color is None
+
+
+class TestProcessDatagram(object):
+    class Config(FakeConfig):
+        def is_ip_allowed(self, ip):
+            return True
+
+    def test_retransmits_acknowledged_without_decoding(self, mocker):
+        trigger_mock = mocker.patch('pophttp.pophttp.MessageHandler.trigger_action')
+        decode_spy = mocker.spy(pophttp.lifx.Message, 'decode')
+        hdlr = pophttp.MessageHandler(self.Config())
+        sent = []
+        expect_call, msg_seq = build_action_msg_seq()
+        for _, bridge_addr, msg in msg_seq:
+            pophttp.process_datagram(hdlr, msg.encode(b'\x00' * 8, b'\x00' * 6), bridge_addr, lambda data, address: sent.append(data))
+
+        bridge_addr, power_msg, color_msg = expect_call
+        trigger_mock.assert_called_once_with(bridge_addr[0], power_msg, color_msg)
+        assert decode_spy.call_count == 2
+        assert len(sent) == len(msg_seq)
+        assert all(pophttp.lifx.Message.decode(data).code == pophttp.lifx.Message.Device_Acknowledgment.code for data in sent)
+
+
+class TestServerLoop(object):
+    def test_batch_received_and_acknowledged(self, mocker):
+        import socket
+        import threading
+        trigger_mock = mocker.patch('pophttp.pophttp.MessageHandler.trigger_action')
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        bridge = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        bridge.bind(('127.0.0.1', 0))
+        bridge.settimeout(5)
+        batches = mocker.spy(pophttp.metrics.receive_batch_size, 'observe')
+
+        _, msg_seq = build_action_msg_seq()
+        for _, _, msg in msg_seq:
+            bridge.sendto(msg.encode(b'\x00' * 8, b'\x00' * 6), server.getsockname())
+        threading.Thread(target=pophttp.server_loop, args=(None, pophttp.MessageHandler(TestProcessDatagram.Config()), server, 64), daemon=True).start()
+        replies = [LifxMessage.decode(bridge.recv(4096)) for _ in msg_seq]
+
+        assert all(reply.code == LifxMessage.Device_Acknowledgment.code for reply in replies)
+        trigger_mock.assert_called_once()
+        assert batches.call_args_list[0][0][0] == len(msg_seq)
+
+    def test_dual_stack_socket(self, tmp_path, mocker):
+        import socket
+        import threading
+        from pophttp.config import Config
+        from pophttp.tests.test_config import write_config
+        mocker.patch('pophttp.pophttp.MessageHandler.trigger_action')
+        config = Config(write_config(tmp_path, "interface: '::'\nip_filter:\n  deny: ['::1']\n"))
+        server = pophttp.workers.udp_socket('::')
+        server.bind(('::', 0))
+        threading.Thread(target=pophttp.server_loop, args=(None, pophttp.MessageHandler(config), server, 64), daemon=True).start()
+
+        bridges = [socket.socket(family, socket.SOCK_DGRAM) for family in (socket.AF_INET6, socket.AF_INET)]
+        for bridge, ip in zip(bridges, ('::1', '127.0.0.1')):
+            bridge.settimeout(1)
+            bridge.sendto(LifxMessage.Light_Get().encode(b'\x00' * 8, b'\x00' * 6), (ip, server.getsockname()[1]))
+        assert LifxMessage.decode(bridges[1].recv(4096)).code == LifxMessage.Light_State.code
+        with pytest.raises(socket.timeout):
+            bridges[0].recv(4096)
+
+    def test_socket_buffers(self):
+        import socket
+        from pophttp.config import SocketConfig
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        pophttp.configure_socket(sock, SocketConfig(65536, 32768, 64))
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 65536
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) >= 32768
+        drops = pophttp.socket_drops(sock)
+        assert drops is None or drops == 0
+        sock.close()
+
+    def test_socket_buffer_capped_warning(self, mocker):
+        from pophttp.config import SocketConfig
+
+        class LimitedSocket(object):
+            # Like Linux without CAP_NET_ADMIN: the FORCE options are refused, the size is capped at 1MB and then doubled
+            def __init__(self):
+                self.sizes = {}
+
+            def setsockopt(self, level, option, size):
+                if option in (pophttp.SO_RCVBUFFORCE, pophttp.SO_SNDBUFFORCE):
+                    raise PermissionError()
+                self.sizes[option] = min(size, 1 << 20) * 2
+
+            def getsockopt(self, level, option):
+                return self.sizes[option]
+
+        mocker.patch.object(pophttp.sys, 'platform', 'linux')
+        warning = mocker.patch.object(pophttp.log, 'warning')
+        pophttp.configure_socket(LimitedSocket(), SocketConfig(1 << 20, None, 64))
+        warning.assert_not_called()
+        pophttp.configure_socket(LimitedSocket(), SocketConfig(3 << 19, None, 64))
+        assert warning.call_args[0][1:4] == ('receive', 1 << 20, 3 << 19)
+
+
+class TestVirtualLights(object):
+    KITCHEN = b'\xd0\x73\xd5\x00\x00\x01\x00\x00'
+    HALL = b'\xd0\x73\xd5\x00\x00\x02\x00\x00'
+
+    def handler(self, tmp_path, top_level=''):
+        from pophttp.config import Config
+        from pophttp.tests.test_config import write_config
+        return pophttp.MessageHandler(Config(write_config(tmp_path, top_level + '''
+lights:
+  - mac: d0:73:d5:00:00:01
+    label: Kitchen
+    default_url: http://example.com/kitchen
+  - mac: d0:73:d5:00:00:02
+    label: Hall
+    default_url: http://example.com/hall
+''')))
+
+    def test_discovery_answered_by_each_light(self, tmp_path):
+        for top_level, labels in (('', ['Kitchen', 'Hall']), ('default_url: http://example.com\n', ['Pop HTTP', 'Kitchen', 'Hall'])):
+            sent = []
+            pophttp.process_datagram(self.handler(tmp_path, top_level), LifxMessage.Light_Get().encode(b'\x00' * 8, b'\x00' * 6), ('10.0.0.1', 56700), lambda data, address: sent.append(data))
+            replies = [LifxMessage.decode(data) for data in sent]
+            assert [reply.label.rstrip('\x00') for reply in replies] == labels
+            assert [reply.header.target for reply in replies[-2:]] == [self.KITCHEN, self.HALL]
+
+    def test_targeted_request_answered_by_its_light(self, tmp_path):
+        sent = []
+        handler = self.handler(tmp_path)
+        for target in (self.HALL, b'\x01' * 8):
+            pophttp.process_datagram(handler, LifxMessage.Light_Get().encode(target, b'\x00' * 6), ('10.0.0.1', 56700), lambda data, address: sent.append(data))
+        assert [LifxMessage.decode(data).label.rstrip('\x00') for data in sent] == ['Hall']
+
+    def test_format_mac(self):
+        assert pophttp.format_mac(self.KITCHEN) == 'd0:73:d5:00:00:01'
+
+    def test_broadcast_press_ignored_without_default_light(self, tmp_path, mocker):
+        trigger_mock = mocker.patch('pophttp.pophttp.MessageHandler.trigger_action')
+        sent = []
+        handler = self.handler(tmp_path)
+        _, msg_seq = build_action_msg_seq()
+        for _, bridge_addr, msg in msg_seq:
+            pophttp.process_datagram(handler, msg.encode(b'\x00' * 8, b'\x00' * 6), bridge_addr, lambda data, address: sent.append(data))
+        assert sent == []
+        trigger_mock.assert_not_called()
+
+    def test_presses_on_different_lights_tracked_separately(self, tmp_path, mocker):
+        trigger_mock = mocker.patch('pophttp.pophttp.MessageHandler.trigger_action')
+        handler = self.handler(tmp_path)
+        (bridge_addr, power_msg, color_msg), _ = build_action_msg_seq()
+        for target, msg in ((self.KITCHEN, power_msg), (self.HALL, power_msg), (self.KITCHEN, color_msg), (self.HALL, color_msg)):
+            pophttp.process_datagram(handler, msg.encode(target, b'\x00' * 6), bridge_addr, lambda data, address: None)
+        assert trigger_mock.call_args_list == [
+            call(bridge_addr[0], power_msg, color_msg, self.KITCHEN),
+            call(bridge_addr[0], power_msg, color_msg, self.HALL),
+        ]
+
+    def test_lights_on_one_endpoint_not_coalesced(self, tmp_path, mocker):
+        from pophttp.config import Config
+        from pophttp.dispatch import Throttle
+        from pophttp.tests.test_config import write_config
+        pending = []
+        throttle = Throttle()
+        dispatcher = mocker.Mock(submit=lambda action: throttle.coalesce(pending, action) or pending.append(action))
+        handler = pophttp.MessageHandler(Config(write_config(tmp_path, '''
+lights:
+  - mac: d0:73:d5:00:00:01
+    default_url: http://ha.local/kitchen
+  - mac: d0:73:d5:00:00:02
+    default_url: http://ha.local/hall
+endpoints:
+  http://ha.local:
+    rate_limit: 1
+    coalesce: true
+''')), dispatcher)
+        (bridge_addr, power_msg, color_msg), _ = build_action_msg_seq()
+        for light in (self.KITCHEN, self.HALL, self.KITCHEN):
+            handler.trigger_action(bridge_addr[0], power_msg, color_msg, light)
+        assert [action.url for action in pending] == ['http://ha.local/kitchen', 'http://ha.local/hall']
+        assert throttle.coalesced == 1
+        # Actions waiting to be retried are kept in the JSON spool, along with their coalesce keys
+        json.dumps([action.coalesce_key for action in pending])
+
+def test_thread_engine_skips_asyncio():
+    import os
+    import subprocess
+    import sys
+    # asyncio & ssl are slow to import, so only the asyncio engine should load them
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable, '-c', 'import sys, pophttp; print(sorted({"asyncio", "ssl"} & set(sys.modules)))'],
+                         cwd=package_dir, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    assert out.strip() == '[]'
@@ -0,0 +1,78 @@
+import socket
+import threading
+from pophttp.config import Config
+from pophttp.resolver import Resolver
+from pophttp.tests.test_config import write_config
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def fake_resolver(mocker, results):
+    clock = FakeClock()
+    resolver = Resolver(ttl=60, clock=clock)
+    lookups = mocker.patch.object(resolver, '_getaddrinfo', side_effect=results)
+    return resolver, clock, lookups
+
+
+class TestResolver(object):
+    def test_cached(self, mocker):
+        resolver, clock, lookups = fake_resolver(mocker, [['10.0.0.5']])
+        resolver.prefetch([('lights.local', 80)])
+        clock.now = 30
+        assert resolver.resolve('lights.local', 80) == ['10.0.0.5']
+        assert lookups.call_count == 1
+
+    def test_expired_refreshed_in_background(self, mocker):
+        refreshed = threading.Event()
+        def results(host, port):
+            if lookups.call_count > 1:
+                refreshed.set()
+                return ['10.0.0.6']
+            return ['10.0.0.5']
+        resolver, clock, lookups = fake_resolver(mocker, results)
+        assert resolver.resolve('lights.local', 80) == ['10.0.0.5']
+        clock.now = 61
+        assert resolver.resolve('lights.local', 80) == ['10.0.0.5'] # The expired address is used while it is refreshed
+        assert refreshed.wait(2)
+        assert resolver.lookup('lights.local', 80) == ['10.0.0.6']
+
+    def test_failed_refresh_keeps_addresses(self, mocker):
+        def results(host, port):
+            if lookups.call_count > 1:
+                raise socket.gaierror('no answer')
+            return ['10.0.0.5']
+        resolver, clock, lookups = fake_resolver(mocker, results)
+        resolver.prefetch([('lights.local', 80)])
+        clock.now = 61
+        resolver.prefetch([('lights.local', 80)])
+        assert resolver.resolve('lights.local', 80) == ['10.0.0.5']
+
+    def test_tries_each_address(self, mocker):
+        resolver, _, _ = fake_resolver(mocker, [['10.0.0.5', '10.0.0.6']])
+        create_connection = mocker.patch('pophttp.resolver.socket.create_connection', side_effect=[ConnectionRefusedError(), 'sock'])
+        assert resolver.create_connection('lights.local', 80, 5) == 'sock'
+        assert [c[0][0] for c in create_connection.call_args_list] == [('10.0.0.5', 80), ('10.0.0.6', 80)]
+
+
+class TestWebhookHosts(object):
+    def test_hosts_from_config(self, tmp_path):
+        config = Config(write_config(tmp_path, '''
+default_url: https://hooks.example.com/default
+endpoints:
+  http://lights.local:8123: {}
+switches:
+  1h: http://lights.local:8123/api?power={onoff}
+  2h: http://{hue}.example.com/
+  3h: http://10.0.0.7/switch
+'''))
+        assert config.webhook_hosts() == [
+            ('http', '10.0.0.7', 80),
+            ('http', 'lights.local', 8123),
+            ('https', 'hooks.example.com', 443),
+        ]
@@ -0,0 +1,84 @@
+import threading
+from pophttp.config import RetryPolicy
+from pophttp.dispatch import Action
+from pophttp.retry import RetryQueue, Spool, backoff_delay
+
+POLICY = RetryPolicy(max_attempts=3, backoff=0.01, max_backoff=0.05, jitter=0, statuses=(503,))
+
+def make_action(url='http://example.com/1'):
+    return Action('10.0.0.1', url, 'POST', '{"on": true}', {'Header-1': 'Value-1'}, 5, POLICY)
+
+class Submitted(object):
+    def __init__(self):
+        self.actions = []
+        self.event = threading.Event()
+
+    def __call__(self, action):
+        self.actions.append(action)
+        self.event.set()
+
+
+class TestRetryQueue(object):
+    def test_backoff(self):
+        policy = POLICY._replace(backoff=1, max_backoff=5, jitter=0.5)
+        assert [backoff_delay(policy, a, rand=lambda: 0.5) for a in range(1, 5)] == [1, 2, 4, 5]
+        assert backoff_delay(policy, 1, rand=lambda: 0) == 0.5
+        assert backoff_delay(policy, 1, rand=lambda: 1) == 1.5
+
+    def test_failed_action_resubmitted(self):
+        submitted = Submitted()
+        queue = RetryQueue()
+        queue.start(submitted)
+        queue.completed(make_action(), failed=True)
+        assert submitted.event.wait(5)
+        assert submitted.actions[0].attempt == 1
+        assert submitted.actions[0].url == 'http://example.com/1'
+
+    def test_gives_up_after_max_attempts(self):
+        submitted = Submitted()
+        queue = RetryQueue()
+        queue.start(submitted)
+        queue.completed(make_action()._replace(attempt=2), failed=True)
+        assert queue.pending == 0
+        assert not submitted.event.wait(0.1)
+
+    def test_spool_synced_off_the_calling_thread(self, tmp_path, mocker):
+        import threading
+        synced = []
+        mocker.patch('pophttp.retry.os.fsync', side_effect=lambda fd: synced.append(threading.current_thread().name))
+        queue = RetryQueue(str(tmp_path / 'retry.spool'))
+        queue.start(lambda action: None)
+        synced.clear() # The compaction when the spool is loaded
+        queue.completed(make_action(), failed=True)
+        queue.spool.close()
+        assert synced == ['retry-spool']
+
+    def test_pending_retry_written_on_close(self, tmp_path):
+        spool_filename = str(tmp_path / 'retry.spool')
+        queue = RetryQueue(spool_filename)
+        queue.start(lambda action: None)
+        queue.completed(make_action(), failed=True)
+        queue.close()
+        (_, _, pending), = queue._heap
+        assert [action for _, action in Spool(spool_filename).load()] == [pending]
+
+    def test_spool_survives_restart(self, tmp_path):
+        spool_filename = str(tmp_path / 'retry.spool')
+        queue = RetryQueue(spool_filename)
+        queue.start(lambda action: None)
+        for i in range(1, 4):
+            queue.completed(make_action(f'http://example.com/{i}'), failed=True)
+        pending = dict((action.url, action) for _, _, action in queue._heap)
+        #Before the restart action 2 is retried successfully and action 3 runs out of attempts
+        queue.completed(pending['http://example.com/2'], failed=False)
+        queue.completed(pending['http://example.com/3']._replace(attempt=2), failed=True)
+        queue.spool.close()
+
+        restored = Spool(spool_filename).load()
+        assert [action for _, action in restored] == [pending['http://example.com/1']]
+
+        submitted = Submitted()
+        RetryQueue(spool_filename).start(submitted)
+        assert submitted.event.wait(5)
+        assert submitted.actions == [pending['http://example.com/1']]
+        assert submitted.actions[0].retry == POLICY
@@ -0,0 +1,39 @@
+import os
+import socket
+import sys
+import threading
+from pophttp import pophttp
+from pophttp.config import Config
+from pophttp.simulator import LoadGenerator, StubHttpServer
+from pophttp.tests.test_config import write_config
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks')
+
+
+def test_load_generator(tmp_path):
+    stub = StubHttpServer()
+    config = Config(write_config(tmp_path, f'interface: 127.0.0.1\ndefault_url: "{stub.url_template()}"\n'))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    threading.Thread(target=pophttp.server_loop, args=(None, pophttp.MessageHandler(config), sock, 64), daemon=True).start()
+
+    load = LoadGenerator(sock.getsockname(), bridges=2, rate=4, poll_interval=0.2, seed=1)
+    load.run(0.5)
+    stats = load.report(stub)
+    stub.close()
+    assert stats['presses'] > 0
+    assert stats['replies'] == stats['packets_sent']
+    assert stats['webhooks'] == stats['presses']
+
+
+def test_bench_server_starts_pophttp(tmp_path, monkeypatch):
+    sys.path.insert(0, BENCHMARKS)
+    try:
+        import bench_server
+    finally:
+        sys.path.remove(BENCHMARKS)
+    # pophttp's output is only unbuffered if start_pophttp asks for it
+    monkeypatch.delenv('PYTHONUNBUFFERED', raising=False)
+    proc = bench_server.start_pophttp(write_config(tmp_path, 'interface: 127.0.0.1\n'), 'thread', timeout=30)
+    proc.terminate()
+    proc.wait()
@@ -0,0 +1,64 @@
+import pstats
+import threading
+from pophttp import pophttp
+from pophttp.tracing import Profiler, Trace, stage_latency
+from pophttp.tests.test_capture import Config
+from pophttp.tests.test_pophttp import build_action_msg_seq
+
+
+class TestTrace(object):
+    def test_stages(self):
+        trace = Trace(start=0)
+        trace.marks = [('ip_filter', 0.001), ('decode', 0.003)]
+        action_trace = trace.branch()
+        action_trace.marks.append(('dispatch', 0.010))
+        assert trace.elapsed('dispatch') is None
+        assert action_trace.elapsed('dispatch') == 0.010
+        assert action_trace.format_stages() == 'ip_filter 1.00ms, decode 2.00ms, dispatch 7.00ms'
+
+    def test_press_traced_to_response(self, mocker):
+        mocker.patch.object(pophttp, 'trace_packets', True)
+        log_press = mocker.patch('pophttp.tracing.log_press')
+        completed = []
+        dispatcher = mocker.Mock(submit=lambda action: (completed.append(action), pophttp.action_completed(action, 200)))
+        handler = pophttp.MessageHandler(Config(), dispatcher)
+        dispatches = stage_latency.value('dispatch')
+        _, msg_seq = build_action_msg_seq()
+        for _, bridge_addr, msg in msg_seq[:2]:
+            pophttp.process_datagram(handler, msg.encode(b'\x00' * 8, b'\x00' * 6), bridge_addr, lambda data, address: None)
+
+        assert len(completed) == 1
+        trace = completed[0].trace
+        assert [stage for stage, _ in trace.marks] == ['ip_filter', 'decode', 'ack', 'match', 'dispatch', 'response']
+        log_press.assert_called_once_with(trace, '10.0.0.1', 'http://example.com')
+        assert stage_latency.value('dispatch') == dispatches + 1
+
+
+def test_profiler_dumps_while_running(tmp_path):
+    profiler = Profiler(str(tmp_path / 'profile'))
+    profiler.start()
+    try:
+        thread = threading.Thread(target=sorted, args=([3, 2, 1],))
+        thread.start()
+        thread.join()
+        profiler.dump()
+    finally:
+        profiler.stop()
+    functions = [name for _, _, name in pstats.Stats(str(tmp_path / 'profile')).stats]
+    assert '<built-in method builtins.sorted>' in functions
+
+
+def test_threads_run_while_profiling(tmp_path):
+    profiler = Profiler(str(tmp_path / 'profile'))
+    profiler.start()
+    ran = []
+    try:
+        threads = [threading.Thread(target=ran.append, args=(i,)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        profiler.dump()
+    finally:
+        profiler.stop()
+    assert sorted(ran) == [0, 1, 2]
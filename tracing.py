@@ -0,0 +1,154 @@
+'''
+Opt-in tracing of how long each packet and switch press spends in each stage of pophttp, and a profiler that can be
+dumped while the server is running.
+'''
+
+import cProfile
+import logging
+import pstats
+import signal
+import sys
+import threading
+from time import perf_counter
+try:
+    import metrics
+except ImportError:
+    from . import metrics
+
+
+log = logging.getLogger('pophttp')
+
+STAGE_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+stage_latency = metrics.Histogram('pophttp_trace_stage_seconds', 'Time spent in each stage of handling a packet or press, when tracing is enabled', ('stage',), buckets=STAGE_BUCKETS)
+
+
+class Trace:
+    '''
+    Timestamps from a monotonic clock for each stage a packet goes through, starting when it was received. The time
+    since the previous stage is recorded in the stage_latency histogram.
+    '''
+    __slots__ = ('start', 'marks')
+
+    def __init__(self, start=None, marks=None):
+        self.start = perf_counter() if start is None else start
+        self.marks = [] if marks is None else marks
+
+    def mark(self, stage):
+        now = perf_counter()
+        previous = self.marks[-1][1] if self.marks else self.start
+        self.marks.append((stage, now))
+        stage_latency.observe(now - previous, stage)
+
+    def branch(self):
+        '''A copy to follow one of the actions a press triggers, since each is dispatched separately'''
+        return Trace(self.start, list(self.marks))
+
+    def elapsed(self, stage):
+        '''Seconds from receiving the packet to the last time `stage` was marked, or None'''
+        for name, when in reversed(self.marks):
+            if name == stage:
+                return when - self.start
+        return None
+
+    def format_stages(self):
+        previous = self.start
+        stages = []
+        for name, when in self.marks:
+            stages.append(f'{name} {(when - previous) * 1000:.2f}ms')
+            previous = when
+        return ', '.join(stages)
+
+
+def log_packet(trace, sender_ip, packet_type):
+    log.debug('trace %s: %s', packet_type, trace.format_stages(), extra=dict(sender_ip=sender_ip))
+
+
+def log_press(trace, sender_ip, url):
+    '''The summary for a press once the response for one of its actions has been received'''
+    ack = trace.elapsed('ack')
+    dispatch = trace.elapsed('dispatch')
+    response = trace.elapsed('response')
+    log.info('trace recv->ack %s, recv->dispatch %s, dispatch->response %s %s',
+        _format_ms(ack),
+        _format_ms(dispatch),
+        _format_ms(response - dispatch if response is not None and dispatch is not None else None),
+        url,
+        extra=dict(sender_ip=sender_ip)
+    )
+
+
+def _format_ms(seconds):
+    return f'{seconds * 1000:.2f}ms' if seconds is not None else '-'
+
+
+class _Snapshot:
+    '''The stats so far from a profiler that is still running, in the form pstats.Stats loads them from'''
+    def __init__(self, profile):
+        profile.snapshot_stats()
+        self.stats = profile.stats
+
+    def create_stats(self):
+        pass
+
+
+class Profiler:
+    '''
+    Runs cProfile on the thread that starts it and on every thread started after that, and writes the combined stats
+    to `filename` with `dump`, which can be done as often as needed while profiling continues.
+    From Python 3.12 cProfile uses sys.monitoring, which sees every thread and only allows one profiler to be enabled,
+    so a single profile is used for the whole process. Before that each thread has its own.
+    '''
+    PER_THREAD = sys.version_info < (3, 12)
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._profiles = []
+        self._lock = threading.Lock()
+
+    def _enable(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        with self._lock:
+            self._profiles.append(profile)
+
+    def _start_thread(self, frame, event, arg):
+        # Only used to get the profiler enabled from each new thread
+        sys.setprofile(None)
+        try:
+            self._enable()
+        except ValueError as err:
+            # Never stop the thread from running because it couldn't be profiled
+            log.warning('unable to profile thread %s: %s', threading.current_thread().name, err, extra=dict(sender_ip='-'))
+
+    def start(self):
+        if self.PER_THREAD:
+            threading.setprofile(self._start_thread)
+        self._enable()
+
+    def stop(self):
+        '''Stop profiling this thread and any new threads'''
+        if self.PER_THREAD:
+            threading.setprofile(None)
+            sys.setprofile(None)
+        else:
+            with self._lock:
+                for profile in self._profiles:
+                    profile.disable()
+
+    def dump(self):
+        with self._lock:
+            snapshots = [_Snapshot(p) for p in self._profiles]
+        # pstats refuses an empty profile, such as a thread that hasn't called anything yet
+        snapshots = [s for s in snapshots if s.stats]
+        if not snapshots:
+            log.warning('nothing has been profiled yet to write to %s', self.filename, extra=dict(sender_ip='-'))
+            return
+        stats = pstats.Stats(*snapshots)
+        stats.dump_stats(self.filename)
+        if self.PER_THREAD:
+            log.warning('profile of %d threads written to %s', len(snapshots), self.filename, extra=dict(sender_ip='-'))
+        else:
+            log.warning('profile written to %s', self.filename, extra=dict(sender_ip='-'))
+
+    def install_signal_handler(self, signum):
+        signal.signal(signum, lambda signum, frame: self.dump())
@@ -0,0 +1,116 @@
+'''
+Running the server in several processes that share the UDP port with SO_REUSEPORT, so it can use more than 1 core.
+'''
+
+import ctypes
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import struct
+try:
+    from dedup import SharedLastTrigger
+except ImportError:
+    from .dedup import SharedLastTrigger
+
+
+log = logging.getLogger('pophttp')
+
+SO_ATTACH_REUSEPORT_CBPF = 51
+SKF_NET_OFF = -0x100000
+
+BPF_LD_W_ABS = 0x20
+BPF_ALU_MOD_K = 0x94
+BPF_RET_A = 0x16
+
+
+def attach_ip_steering(sock, count):
+    '''
+    Attach a classic BPF program to the SO_REUSEPORT group that picks the socket from the packet's source IPv4 address
+    modulo the number of sockets, so each bridge is always handled by the same worker. On a dual stack socket IPv6
+    packets are picked by the 32 bits at the same offset, which are part of their source address
+    '''
+    program = [
+        (BPF_LD_W_ABS, 0, 0, (SKF_NET_OFF + 12) & 0xFFFFFFFF),  # A = source address from the IPv4 header
+        (BPF_ALU_MOD_K, 0, 0, count),                           # A = A % count
+        (BPF_RET_A, 0, 0, 0),                                   # use socket number A
+    ]
+    filters = ctypes.create_string_buffer(b''.join(struct.pack('HBBI', *instruction) for instruction in program))
+    fprog = struct.pack('@HP', len(program), ctypes.addressof(filters))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, fprog)
+
+
+def udp_socket(address):
+    '''
+    A UDP socket for listening on `address`. An IPv6 address gets a dual stack socket so IPv4 bridges can still send
+    to it, and their addresses are received as IPv4 mapped IPv6 addresses
+    '''
+    if ':' in address:
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        return sock
+    return socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+
+
+def bind_reuseport_sockets(address, port, count):
+    socks = []
+    for _ in range(count):
+        sock = udp_socket(address)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((address, port))
+        socks.append(sock)
+    try:
+        attach_ip_steering(socks[0], count)
+    except OSError as err:
+        # Without the program the kernel still sends each source address & port to the same socket, which is enough
+        # as long as a bridge keeps using the same source port
+        log.warning('unable to route bridges to workers by IP address, falling back to routing by address and port: %s', err, extra=dict(sender_ip='-'))
+    return socks
+
+
+def run_workers(socks, run_worker):
+    '''
+    Fork a process for each socket from bind_reuseport_sockets, running `run_worker(index, sock, trigger_dedup)` with
+    a SharedLastTrigger shared by all of them. Returns when any worker exits, after stopping the others.
+    '''
+    trigger_dedup = SharedLastTrigger()
+    context = multiprocessing.get_context('fork')
+    procs = [context.Process(target=_worker_main, args=(run_worker, i, sock, trigger_dedup), name=f'pophttp-worker-{i}') for i, sock in enumerate(socks)]
+    for proc in procs:
+        proc.start()
+    for sock in socks:
+        sock.close()
+
+    def forward(signum, frame):
+        for proc in procs:
+            if proc.pid is not None and proc.is_alive():
+                os.kill(proc.pid, signum)
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    for name in ('SIGHUP', 'SIGUSR1'):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), forward)
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        ready = multiprocessing.connection.wait([proc.sentinel for proc in procs])
+        for proc in procs:
+            if proc.sentinel in ready:
+                log.error('worker %s exited with code %s, stopping', proc.name, proc.exitcode, extra=dict(sender_ip='-'))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.join()
+
+
+def _worker_main(run_worker, index, sock, trigger_dedup):
+    # Ctrl+C is sent to all of the processes, so leave it to the parent to stop the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run_worker(index, sock, trigger_dedup)